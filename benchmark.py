@@ -1,16 +1,466 @@
+from argparse import ArgumentParser
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
 import timeit
+import tracemalloc
 
-# No transfers      : 19051 -> 18111
-# Single transfer   : 19051 -> 18129
-# Equally optimal   : 59039 -> 54589
-# Loops             : 11389 -> 11381
-# LS                : 19051 -> 03381
-# Tim               : 18129 -> 10199
-# Skipped stops     : 59119 -> 63091
+import geo
+import graph
+
+# Route pairs from route.main()
+SCENARIOS = [
+    ('No transfers', ['19051'], '18111'),
+    ('Single transfer', ['19051'], '18129'),
+    ('Equally optimal', ['59039'], '54589'),
+    ('Loops', ['11389'], '11381'),
+    ('LS', ['19051'], '03381'),
+    ('Tim', ['18129'], '10199'),
+    ('Skipped stops', ['59119'], '63091'),
+    ('Optimality', ['07319'], '57111'),
+]
+
+# Options
+DEFAULT_PAIRS = 100
+DEFAULT_SEED = 0
+DEFAULT_TOLERANCE = 0.1
+
+# Random coordinates are jittered up to this many degrees around a stop
+COORDS_JITTER = 0.002
+
+# Transfer penalties swept with A* against one Pareto search
+SWEPT_PENALTIES = [1, 2, 3, 5, 10, 20]
+
+# Origins also routed to every stop with route_many against one isochrone
+ROUTE_MANY_ORIGINS = 5
+
+# Percentiles reported for every stage
+PERCENTILES = [50, 95, 99]
+
+# Stages are compared against a baseline on these statistics
+COMPARED = ['p50', 'p95']
+
+# Graph formats started from by the suite, those not built are skipped
+STARTUP_FORMATS = [('bundle', graph.BUNDLE_PATH),
+                   ('pickle', graph.GRAPH_PATH)]
+
+# Run in a fresh interpreter: load the graph, look up a stop and expand it,
+# then report elapsed seconds and peak RSS
+STARTUP_SNIPPET = '''
+import resource, time
+start = time.perf_counter()
+import geo
+import graph
+network = graph.load({path!r})
+network.successors(network.stop_index[network.stop_codes[0]])
+elapsed = time.perf_counter() - start
+print(elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''
+
+
+def percentile(samples, q):
+    # Nearest-rank percentile of samples
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+def summarize(samples):
+    summary = {'count': len(samples),
+               'mean': sum(samples) / len(samples) if samples else None}
+    for q in PERCENTILES:
+        summary['p{}'.format(q)] = percentile(samples, q) if samples else None
+    return summary
+
+
+def timed(function, *args):
+    # Result of function and its wall time in ms
+    start = time.perf_counter()
+    result = function(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def workload(network, pairs, seed):
+    """
+    Scenario pairs plus a seeded sample of random stop pairs and coordinate
+    pairs jittered around random stops
+    """
+    rng = random.Random(seed)
+    stop_codes = list(network.stop_codes)
+    stop_pairs = [(origin_codes, goal_code)
+                  for _, origin_codes, goal_code in SCENARIOS
+                  if goal_code in network.stop_index and all(
+                      code in network.stop_index for code in origin_codes)]
+    for _ in range(pairs):
+        origin_code, goal_code = rng.sample(stop_codes, 2)
+        stop_pairs.append(([origin_code], goal_code))
+
+    coords_pairs = []
+    for _ in range(pairs):
+        coords_pairs.append(tuple(
+            tuple(value + rng.uniform(-COORDS_JITTER, COORDS_JITTER)
+                  for value in network.coordinates(code))
+            for code in rng.sample(stop_codes, 2)))
+    return stop_pairs, coords_pairs
+
+
+def benchmark_startup(number, path=None):
+    # Startup times in ms and the peak RSS in MB of loading path
+    path = path or graph.default_path()
+    samples = []
+    max_rss = 0
+    for _ in range(number):
+        output = subprocess.check_output(
+            [sys.executable, '-c', STARTUP_SNIPPET.format(path=path)])
+        elapsed, rss = output.split()
+        samples.append(float(elapsed) * 1000)
+        max_rss = max(max_rss, int(rss))
+    return samples, max_rss / 1024
+
+
+def benchmark_suite(number, pairs, seed):
+    """
+    Time each stage of answering queries, returns the summary of every stage
+    """
+    stages = {}
+    for name, path in STARTUP_FORMATS:
+        if os.path.exists(path):
+            samples, max_rss = benchmark_startup(number, path)
+            stage = stages['startup ' + name] = summarize(samples)
+            stage['rss_mb'] = max_rss
+            stage['file_mb'] = os.path.getsize(path) / 1024 ** 2
+
+    import route
+
+    network, router = route.network, route.router
+    stop_pairs, coords_pairs = workload(network, pairs, seed)
+    heuristic, search, postprocess, nodes = [], [], [], []
+    unreachable = 0
+    for origin_codes, goal_code in stop_pairs:
+        goals = {network.stop_index[goal_code]}
+        for _ in range(number):
+            context, elapsed = timed(route.SearchContext, network,
+                                     network.coordinates(goal_code))
+            heuristic.append(elapsed)
+            node, elapsed = timed(next, router.search(
+                context, origin_codes, goals), None)
+            search.append(elapsed)
+            nodes.append(context.stats.expanded)
+            if node is None:
+                unreachable += 1
+                continue
+            _, elapsed = timed(router.finish, node)
+            postprocess.append(elapsed)
+    stages['heuristic'] = summarize(heuristic)
+    stages['search'] = summarize(search)
+    stages['search']['nodes'] = summarize(nodes)
+    stages['search']['unreachable'] = unreachable
+    stages['postprocess'] = summarize(postprocess)
+
+    nearby, coords = [], []
+    for origin, goal in coords_pairs:
+        for _ in range(number):
+            for lat, lon in [origin, goal]:
+                nearby.append(timed(network.stops_within, lat, lon,
+                                    route.NEARBY_STOPS_RADIUS)[1])
+            try:
+                coords.append(timed(router.route_coords, origin, goal)[1])
+            except route.NoRouteError:
+                pass
+    stages['nearby'] = summarize(nearby)
+    stages['coords'] = summarize(coords)
+
+    return {
+        'meta': {'version': network.version, 'pairs': len(stop_pairs),
+                 'coords_pairs': len(coords_pairs), 'number': number,
+                 'seed': seed, 'python': platform.python_version()},
+        'stages': stages,
+    }
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Return the (stage, statistic, baseline, current) of every compared
+    statistic, including expanded nodes and startup RSS, that grew by more
+    than tolerance
+    """
+    regressions = []
+    for stage, summary in results['stages'].items():
+        base = baseline['stages'].get(stage)
+        if base is None:
+            continue
+        checks = [(statistic, base.get(statistic), summary.get(statistic))
+                  for statistic in COMPARED]
+        if 'nodes' in summary and 'nodes' in base:
+            checks += [('nodes ' + statistic, base['nodes'].get(statistic),
+                        summary['nodes'].get(statistic))
+                       for statistic in COMPARED]
+        checks.append(('rss_mb', base.get('rss_mb'), summary.get('rss_mb')))
+        for statistic, before, after in checks:
+            if before is not None and after is not None and \
+                    after > before * (1 + tolerance):
+                regressions.append((stage, statistic, before, after))
+    return regressions
+
+
+def print_suite(results, baseline=None):
+    print('{:<15s} {:>6s} {:>9s} {:>9s} {:>9s} {:>9s}'.format(
+        'Stage', 'Count', 'Mean', 'p50', 'p95', 'p99'))
+    for stage, summary in results['stages'].items():
+        line = '{:<15s} {:>6d}'.format(stage, summary['count'])
+        for statistic in ['mean'] + ['p{}'.format(q) for q in PERCENTILES]:
+            value = summary[statistic]
+            line += ' {:>7.3f}ms'.format(value) if value is not None \
+                else ' {:>9s}'.format('-')
+        if baseline is not None and stage in baseline['stages'] and \
+                baseline['stages'][stage].get('p50'):
+            line += ' | p50 {:+.1f}%'.format(
+                (summary['p50'] / baseline['stages'][stage]['p50'] - 1) * 100)
+        print(line)
+    for stage, summary in results['stages'].items():
+        if 'rss_mb' in summary:
+            print('{:<15s} {:>8.1f}MB peak RSS | {:>8.1f}MB file'.format(
+                stage, summary['rss_mb'], summary['file_mb']))
+    search = results['stages']['search']
+    print('Nodes expanded: mean {:.0f}, p50 {}, p95 {}, p99 {}, '
+          '{} unreachable'.format(search['nodes']['mean'],
+                                  search['nodes']['p50'],
+                                  search['nodes']['p95'],
+                                  search['nodes']['p99'],
+                                  search['unreachable']))
+
+
+def benchmark_memory(number):
+    import route
+
+    # Peak memory traced while searching, above what was live before
+    tracemalloc.start()
+    total = 0
+    for name, origin_codes, goal_code in SCENARIOS:
+        context = route.SearchContext(
+            route.network, route.network.coordinates(goal_code))
+        route.router.dijkstra(context, origin_codes, {goal_code})
+        peaks = []
+        for _ in range(number):
+            tracemalloc.reset_peak()
+            baseline, _ = tracemalloc.get_traced_memory()
+            route.router.dijkstra(context, origin_codes, {goal_code})
+            peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+        peak = sum(peaks) / number
+        total += peak
+        print('{:<16s} {} -> {} : {:>8.1f}KB peak'.format(
+            name, ' '.join(origin_codes), goal_code, peak / 1024))
+    tracemalloc.stop()
+    print('{:<16s} {:>25.1f}KB'.format('Total', total / 1024))
+
+def benchmark_bidirectional(number):
+    import route
+
+    # Forward A* against the bidirectional state search on the scenario pairs
+    network, router = route.network, route.router
+    # The state search only rides, it would race an A* that walks
+    if network.num_footpaths:
+        exit('The bidirectional search does not walk, build the graph '
+             'without footpaths with to-pickle.py -w 0')
+    # Build the state graph outside the timings
+    network.states
+    print('{:<16s} {:>9s} {:>7s} {:>8s} | {:>9s} {:>7s} {:>8s}'.format(
+        'Scenario', 'A*', 'nodes', 'cost', 'Bidir', 'nodes', 'cost'))
+    totals = [0.0, 0.0]
+    for name, origin_codes, goal_code in SCENARIOS:
+        line = '{:<16s}'.format(name)
+        for i, search in enumerate([router.dijkstra, router.bidirectional]):
+            elapsed = []
+            for _ in range(number):
+                context = router.context(network.coordinates(goal_code))
+                solution, search_time = timed(search, context, origin_codes,
+                                              {goal_code})
+                elapsed.append(search_time)
+            totals[i] += min(elapsed)
+            line += ' {}{:>7.2f}ms {:>7d} {:>8.2f}'.format(
+                '|' if i else '', min(elapsed), context.stats.expanded,
+                solution.best_cost)
+        print(line)
+    print('{:<16s} {:>7.2f}ms {:>17s} {:>7.2f}ms'.format(
+        'Total', totals[0], '|', totals[1]))
+
+def benchmark_pareto(number):
+    import route
+
+    # One Pareto search against an A* search per swept transfer penalty,
+    # counting the penalties whose A* route the frontier matches or beats
+    router = route.router
+    print('{:<16s} {:>9s} {:>6s} | {:>9s} {:>7s}'.format(
+        'Scenario', 'Pareto', 'routes', 'Sweep', 'covered'))
+    totals = [0.0, 0.0]
+    for name, origin_codes, goal_code in SCENARIOS:
+        frontier, pareto_time = min(
+            (timed(router.frontier_codes, origin_codes, goal_code)
+             for _ in range(number)), key=lambda result: result[1])
+        sweep_time = 0.0
+        covered = 0
+        for transfer_penalty in SWEPT_PENALTIES:
+            elapsed = []
+            for _ in range(number):
+                context = router.context(
+                    router.network.coordinates(goal_code),
+                    transfer_penalty=transfer_penalty)
+                solution, search_time = timed(router.dijkstra, context,
+                                              origin_codes, {goal_code})
+                elapsed.append(search_time)
+            sweep_time += min(elapsed)
+            covered += min(
+                pareto.best_dist + transfer_penalty * pareto.transfers
+                for pareto in frontier) <= solution.best_cost + 1e-9
+        totals[0] += pareto_time
+        totals[1] += sweep_time
+        print('{:<16s} {:>7.2f}ms {:>6d} | {:>7.2f}ms {:>4d}/{}'.format(
+            name, pareto_time, len(frontier), sweep_time, covered,
+            len(SWEPT_PENALTIES)))
+    print('{:<16s} {:>7.2f}ms {:>6s} | {:>7.2f}ms'.format(
+        'Total', totals[0], '', totals[1]))
+
+def benchmark_alternatives(number):
+    import route
+
+    # Alternative routes against the single A* route on the scenario pairs
+    router = route.router
+    print('{:<16s} {:>9s} {:>6s} {:>11s} | {:>9s}'.format(
+        'Scenario', 'Alts', 'routes', 'cost', 'A*'))
+    totals = [0.0, 0.0]
+    for name, origin_codes, goal_code in SCENARIOS:
+        solutions, alternatives_time = min(
+            (timed(router.alternatives_codes, origin_codes, goal_code)
+             for _ in range(number)), key=lambda result: result[1])
+        search_time = min(
+            timed(router.dijkstra, router.context(
+                router.network.coordinates(goal_code)), origin_codes,
+                  {goal_code})[1] for _ in range(number))
+        totals[0] += alternatives_time
+        totals[1] += search_time
+        print('{:<16s} {:>7.2f}ms {:>6d} {:>5.1f}-{:<5.1f} | {:>7.2f}ms'.format(
+            name, alternatives_time, len(solutions), solutions[0].best_cost,
+            solutions[-1].best_cost, search_time))
+    print('{:<16s} {:>7.2f}ms {:>6s} {:>11s} | {:>7.2f}ms'.format(
+        'Total', totals[0], '', '', totals[1]))
+
+def benchmark_isochrone(number, origins, seed):
+    import route
+
+    # One-to-all searches from random origins, against route_many to every
+    # stop on the first few, which builds a solution per stop
+    router = route.router
+    stop_codes = list(router.network.stop_codes)
+    origin_codes = random.Random(seed).sample(stop_codes, origins)
+    elapsed = []
+    start = time.perf_counter()
+    for origin_code in origin_codes:
+        elapsed.append(min(timed(router.isochrone_codes, [origin_code])[1]
+                           for _ in range(number)))
+    total = time.perf_counter() - start
+    summary = summarize(elapsed)
+    print('Isochrone  {:>8.2f}ms p50 {:>8.2f}ms p95 | {:.0f} origins/s'
+          .format(summary['p50'], summary['p95'],
+                  len(origin_codes) * number / total))
+    many = []
+    for origin_code in origin_codes[:ROUTE_MANY_ORIGINS]:
+        start = time.perf_counter()
+        list(router.route_many([origin_code], stop_codes))
+        many.append((time.perf_counter() - start) * 1000)
+    print('Route many {:>8.2f}ms p50 over {} origins, isochrone {:.2f}ms'
+          .format(percentile(many, 50), len(many),
+                  percentile(elapsed[:ROUTE_MANY_ORIGINS], 50)))
+
+def benchmark_geo(number):
+    network = graph.load()
+    latitudes, longitudes = network.latitudes, network.longitudes
+    lat_list, lon_list = latitudes.tolist(), longitudes.tolist()
+    lat, lon = lat_list[0], lon_list[0]
+    size = 100
+
+    timings = [
+        ('Scalar 1xN', len(lat_list), lambda: [
+            geo.distance(lat, lon, stop_lat, stop_lon)
+            for stop_lat, stop_lon in zip(lat_list, lon_list)]),
+        ('Array 1xN', len(lat_list), lambda: geo.distances(
+            lat, lon, latitudes, longitudes)),
+        ('Scalar MxN', size * len(lat_list), lambda: [
+            [geo.distance(origin_lat, origin_lon, stop_lat, stop_lon)
+             for stop_lat, stop_lon in zip(lat_list, lon_list)]
+            for origin_lat, origin_lon in zip(lat_list[:size],
+                                              lon_list[:size])]),
+        ('Array MxN', size * len(lat_list), lambda: geo.distance_matrix(
+            latitudes[:size], longitudes[:size], latitudes, longitudes)),
+    ]
+    for name, pairs, function in timings:
+        elapsed = timeit.timeit(function, number=number) / number
+        print('{:<12s} {:>9d} pairs : {:>9.3f}ms | {:>7.2f}M pairs/s'.format(
+            name, pairs, elapsed * 1000, pairs / elapsed / 1e6))
 
 def main():
-    number = 10
-    print(timeit.timeit("dijkstra('59039', '54589')", setup="from route import dijkstra", number=number) / number)
+    parser = ArgumentParser(description='Benchmarks the bus router')
+    parser.add_argument(
+        '-n', '--number', default=3, type=int,
+        help="number of runs of each query")
+    parser.add_argument(
+        '-p', '--pairs', default=DEFAULT_PAIRS, type=int,
+        help="number of random stop pairs and coordinate pairs")
+    parser.add_argument(
+        '-s', '--seed', default=DEFAULT_SEED, type=int,
+        help="seed of the random pairs")
+    parser.add_argument(
+        '-o', '--output', metavar='PATH',
+        help="write the suite results as JSON")
+    parser.add_argument(
+        '-b', '--baseline', metavar='PATH',
+        help="JSON results to compare against, exits 1 on a regression")
+    parser.add_argument(
+        '--tolerance', default=DEFAULT_TOLERANCE, type=float,
+        help="fraction a compared statistic may grow by over the baseline")
+    parser.add_argument(
+        'mode', nargs='?', default='suite',
+        choices=['suite', 'memory', 'bidirectional', 'pareto',
+                 'alternatives', 'isochrone', 'geo'],
+        help="latency of every query stage, peak search memory on the "
+             "scenario pairs, forward against bidirectional search, one "
+             "Pareto search against a transfer penalty sweep or alternative "
+             "routes against one route on them, one-to-all searches from "
+             "PAIRS origins, or distance throughput")
+    args = parser.parse_args()
+
+    if args.mode == 'suite':
+        baseline = None
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        results = benchmark_suite(args.number, args.pairs, args.seed)
+        print_suite(results, baseline)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+        if baseline is not None:
+            regressions = compare(results, baseline, args.tolerance)
+            for stage, statistic, before, after in regressions:
+                print('Regression: {} {} {:.3f} -> {:.3f}'.format(
+                    stage, statistic, before, after))
+            if regressions:
+                exit(1)
+    elif args.mode == 'memory':
+        benchmark_memory(args.number)
+    elif args.mode == 'bidirectional':
+        benchmark_bidirectional(args.number)
+    elif args.mode == 'pareto':
+        benchmark_pareto(args.number)
+    elif args.mode == 'alternatives':
+        benchmark_alternatives(args.number)
+    elif args.mode == 'isochrone':
+        benchmark_isochrone(args.number, args.pairs, args.seed)
+    elif args.mode == 'geo':
+        benchmark_geo(args.number)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,98 @@
+from collections import OrderedDict
+import json
+import sqlite3
+import threading
+
+# Options
+DEFAULT_MAXSIZE = 1024
+
+
+class RouteCache:
+    """
+    LRU cache of serialized routes, optionally backed by a sqlite store
+
+    Keys include the dataset version, and stored entries of other versions
+    are dropped when the store is opened, so a rebuilt dataset never serves
+    stale routes.
+    """
+
+    def __init__(self, version, maxsize=DEFAULT_MAXSIZE, path=None):
+        self.version = version
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            with self.db:
+                self.db.execute('CREATE TABLE IF NOT EXISTS routes ('
+                                'key TEXT PRIMARY KEY, version TEXT, '
+                                'value TEXT)')
+                self.db.execute('DELETE FROM routes WHERE version != ?',
+                                (version,))
+
+    def reset(self, version):
+        # Switch to a new dataset version, dropping every route of the old one
+        with self.lock:
+            self.version = version
+            self.entries.clear()
+            if self.db is not None:
+                with self.db:
+                    self.db.execute('DELETE FROM routes WHERE version != ?',
+                                    (version,))
+
+    def key(self, mode, origin, goal, transfer_penalty, radius=None):
+        # Origin codes are a set, order and duplicates don't change the route
+        if mode == 'codes':
+            origin = sorted(set(origin))
+        return json.dumps([self.version, mode, origin, goal,
+                           float(transfer_penalty), radius])
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            if self.db is not None:
+                row = self.db.execute(
+                    'SELECT value FROM routes WHERE key = ? AND version = ?',
+                    (key, self.version)).fetchone()
+                if row is not None:
+                    value = json.loads(row[0])
+                    self._insert(key, value)
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        # A route searched for before a reset() is of the old dataset, its
+        # key still carries the version it was computed for
+        with self.lock:
+            if json.loads(key)[0] != self.version:
+                return
+            self._insert(key, value)
+            if self.db is not None:
+                with self.db:
+                    self.db.execute(
+                        'INSERT OR REPLACE INTO routes VALUES (?, ?, ?)',
+                        (key, self.version, json.dumps(value)))
+
+    def _insert(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        return {'version': self.version, 'size': len(self.entries),
+                'maxsize': self.maxsize, 'hits': self.hits,
+                'misses': self.misses}
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
@@ -1,30 +1,58 @@
+from argparse import ArgumentParser
+
 import pandas as pd
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
+
+# Options
+DB_PATH = 'sqlite:///sg-bus-router.db'
+CHUNK_SIZE = 5000
+
+# Route rows at bus stops missing from bus_stops
+REJECTED_WHERE = ('BusStopCode NOT IN (SELECT BusStopCode FROM bus_stops) '
+                  'OR BusStopCode IS NULL')
+
+
+def clean_routes(chunks, stop_codes, rejected=None):
+    """
+    Clean bus route rows one chunk at a time
+
+    NULL distances are filled with 0 and rows at bus stops missing from
+    stop_codes are dropped, appended to rejected if given. Yields the
+    cleaned chunks.
+    """
+    for chunk in chunks:
+        valid = chunk.BusStopCode.isin(stop_codes)
+        if rejected is not None and not valid.all():
+            rejected.append(chunk[~valid])
+        yield chunk[valid].fillna({'Distance': 0.0})
 
-print('Loading tables')
-db_conn = create_engine('sqlite:///sg-bus-router.db')
-rt = pd.read_sql_table(table_name='bus_routes', con=db_conn)
-bs = pd.read_sql_table(table_name='bus_stops', con=db_conn)
 
 def main():
-    # Fill NULL distances with 0
-    print('Filling NA distances with 0.0')
-    rt.fillna(value=0.0, inplace=True)
-
-    # Find rows that are not mutually present
-    print('Searching for invalid rows')
-    rt.reset_index(inplace=True)
-    merged = rt.reset_index().merge(bs, on='BusStopCode', how='left')
-    invalid_rows = rt[merged.isnull().any(axis=1)]
-    if not invalid_rows.empty:
-        print('Found invalid rows')
-        print(invalid_rows)
-        new_rt = rt[~merged.isnull().any(axis=1)]
-        print('Saving cleaned bus_routes table')
-        new_rt.to_sql(name='bus_routes', con=db_conn, if_exists='replace',
-                      index=False)
-    else:
-        print('No invalid rows found')
+    parser = ArgumentParser(
+        description='Drops invalid bus route rows and fills NULL distances')
+    parser.add_argument(
+        '-c', '--chunk-size', default=CHUNK_SIZE, type=int,
+        help="number of route rows cleaned at a time")
+    args = parser.parse_args()
+
+    # The table is cleaned in place, only rejected rows are read out, a
+    # chunk at a time, to be reported
+    db_conn = create_engine(DB_PATH)
+    rejected = 0
+    print('Cleaning bus_routes')
+    with db_conn.begin() as conn:
+        for chunk in pd.read_sql_query(
+                'SELECT * FROM bus_routes WHERE ' + REJECTED_WHERE,
+                con=conn, chunksize=args.chunk_size):
+            if not rejected:
+                print('Rejected rows at unknown bus stops')
+            print(chunk)
+            rejected += len(chunk)
+        conn.execute(text('DELETE FROM bus_routes WHERE ' + REJECTED_WHERE))
+        conn.execute(text(
+            'UPDATE bus_routes SET Distance = 0.0 WHERE Distance IS NULL'))
+        count = conn.execute(text('SELECT COUNT(*) FROM bus_routes')).scalar()
+    print('Kept {} rows, rejected {}'.format(count, rejected))
 
 if __name__ == '__main__':
     main()
@@ -1,10 +1,13 @@
-import requests
-from time import sleep
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import json
+import time
 
 import pandas as pd
-from sqlalchemy import create_engine
-
-from keys import api_key
+import requests
+from requests.adapters import HTTPAdapter
+from sqlalchemy import create_engine, text
+from urllib3.util.retry import Retry
 
 # Variables
 API_PATHS = ['BusStops', 'BusRoutes']
@@ -13,40 +16,159 @@ DB_TABLES = ['bus_stops', 'bus_routes']
 # Options
 DB_PATH = 'sqlite:///sg-bus-router.db'
 LOG_INTERVAL = 1000
+WORKERS = 4
+RETRIES = 5
+BACKOFF_FACTOR = 0.5
+TIMEOUT = 30
+# Seconds after which checkpointed pages are downloaded again, DataMall
+# updates its tables and pages of two updates don't make one table
+CHECKPOINT_MAX_AGE = 24 * 60 * 60
 
 # Constants
 API_URL_FORMAT = 'http://datamall2.mytransport.sg/ltaodataservice/{}'
 API_JSON_KEY = 'value'
+PAGE_SIZE = 500
+CHECKPOINT_TABLE = 'download_checkpoints'
+RETRY_STATUSES = [429, 500, 502, 503, 504]
 
-def main():
-    db_conn = create_engine(DB_PATH)
-    headers = {
+
+def make_session(api_key, workers=WORKERS, retries=RETRIES,
+                 backoff_factor=BACKOFF_FACTOR):
+    """
+    Session pooling a connection per worker, retrying failed pages with
+    exponential backoff
+    """
+    session = requests.Session()
+    session.headers.update({
         'AccountKey': api_key,
         'Accept': 'application/json'
-    }
+    })
+    adapter = HTTPAdapter(
+        pool_connections=1, pool_maxsize=workers,
+        max_retries=Retry(total=retries, backoff_factor=backoff_factor,
+                          status_forcelist=RETRY_STATUSES))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def fetch_page(session, url, skip):
+    response = session.get(url, params={'$skip': skip}, timeout=TIMEOUT)
+    response.raise_for_status()
+    return response.json()[API_JSON_KEY]
+
+
+def load_checkpoint(db_conn, api_path, max_age=CHECKPOINT_MAX_AGE):
+    # Pages of api_path fetched by an earlier, interrupted run, all of them
+    # dropped once the first is older than max_age seconds
+    with db_conn.begin() as conn:
+        conn.execute(text(
+            'CREATE TABLE IF NOT EXISTS {} (api_path TEXT, skip INTEGER, '
+            'saved REAL, data TEXT, PRIMARY KEY (api_path, skip))'.format(
+                CHECKPOINT_TABLE)))
+        rows = conn.execute(text(
+            'SELECT skip, saved, data FROM {} WHERE api_path = '
+            ':api_path'.format(CHECKPOINT_TABLE)),
+            {'api_path': api_path}).fetchall()
+        if any(saved < time.time() - max_age for _, saved, _ in rows):
+            print('Discarding {} pages of {} older than {}s'.format(
+                len(rows), api_path, max_age))
+            delete_checkpoint(conn, api_path)
+            return {}
+        return {skip: json.loads(data) for skip, _, data in rows}
+
+
+def save_checkpoint(db_conn, api_path, skip, data_chunk):
+    with db_conn.begin() as conn:
+        conn.execute(text(
+            'INSERT OR REPLACE INTO {} VALUES (:api_path, :skip, :saved, '
+            ':data)'.format(CHECKPOINT_TABLE)),
+            {'api_path': api_path, 'skip': skip, 'saved': time.time(),
+             'data': json.dumps(data_chunk)})
+
 
-    for i in range(len(API_PATHS)):
-        params = {
-            '$skip': 0
-        }
-        url = API_URL_FORMAT.format(API_PATHS[i])
+def delete_checkpoint(conn, api_path):
+    conn.execute(text(
+        'DELETE FROM {} WHERE api_path = :api_path'.format(
+            CHECKPOINT_TABLE)), {'api_path': api_path})
 
+
+def download_table(session, db_conn, api_path, db_table, workers=WORKERS,
+                   url_format=API_URL_FORMAT, page_size=PAGE_SIZE,
+                   max_age=CHECKPOINT_MAX_AGE):
+    """
+    Download every page of api_path into db_table
+
+    Pages are fetched workers at a time until one comes back short. Each is
+    checkpointed as it arrives so an interrupted download resumes where it
+    left off, unless its pages are older than max_age seconds. The table is
+    replaced in a single transaction once all pages are in.
+    """
+    url = url_format.format(api_path)
+    pages = load_checkpoint(db_conn, api_path, max_age)
+    if pages:
+        print('Resuming {} from {} pages'.format(api_path, len(pages)))
+
+    skip = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
         while True:
-            data_chunk = requests.get(
-                url=url, headers=headers, params=params).json()[API_JSON_KEY]
-            if len(data_chunk) == 0:
-                break
-            df = pd.DataFrame(data_chunk)
-            df.to_sql(name=DB_TABLES[i], con=db_conn, if_exists='append',
-                      index=False)
+            window = [skip + i * page_size for i in range(workers)]
+            futures = {executor.submit(fetch_page, session, url, page_skip):
+                       page_skip for page_skip in window
+                       if page_skip not in pages}
+            # Checkpoint every page that arrived before giving up on a window
+            errors = []
+            for future in as_completed(futures):
+                try:
+                    data_chunk = future.result()
+                except requests.RequestException as e:
+                    errors.append(e)
+                    continue
+                pages[futures[future]] = data_chunk
+                save_checkpoint(db_conn, api_path, futures[future], data_chunk)
+            if errors:
+                raise errors[0]
 
             # Log progress
-            params['$skip'] += len(data_chunk)
-            if params['$skip'] % LOG_INTERVAL == 0:
-                print('Downloaded {}'.format(params['$skip']))
+            downloaded = sum(len(pages[page_skip]) for page_skip in window)
+            if (skip + downloaded) // LOG_INTERVAL > skip // LOG_INTERVAL:
+                print('Downloaded {} {}'.format(skip + downloaded, api_path))
+
+            last_pages = [page_skip for page_skip in window
+                          if len(pages[page_skip]) < page_size]
+            if last_pages:
+                break
+            skip += workers * page_size
 
-            # # Avoid triggering rate limits
-            # sleep(1)
+    rows = [row for page_skip in sorted(pages) if page_skip <= last_pages[0]
+            for row in pages[page_skip]]
+    with db_conn.begin() as conn:
+        pd.DataFrame(rows).to_sql(name=db_table, con=conn,
+                                  if_exists='replace', index=False)
+        delete_checkpoint(conn, api_path)
+    return len(rows)
+
+
+def main():
+    from keys import api_key
+
+    parser = ArgumentParser(
+        description='Downloads bus stops and routes from DataMall')
+    parser.add_argument(
+        '-w', '--workers', default=WORKERS, type=int,
+        help="number of pages fetched concurrently")
+    parser.add_argument(
+        '-a', '--max-age', default=CHECKPOINT_MAX_AGE, type=float,
+        help="seconds after which pages of an interrupted download are "
+             "fetched again")
+    args = parser.parse_args()
+
+    db_conn = create_engine(DB_PATH)
+    session = make_session(api_key, args.workers)
+    for api_path, db_table in zip(API_PATHS, DB_TABLES):
+        count = download_table(session, db_conn, api_path, db_table,
+                               args.workers, max_age=args.max_age)
+        print('Saved {} {}'.format(count, api_path))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,23 @@
+import graph
+
+
+def route_tables(rows):
+    """
+    rt_idx and rt_bs tables of graph.compile_graph() holding the
+    (ServiceNo, StopSequence, BusStopCode, Distance) rows in order
+    """
+    rt_idx = {
+        idx: {'ServiceNo': service_no, 'StopSequence': stop_sequence,
+              'BusStopCode': bus_stop_code, 'Distance': distance}
+        for idx, (service_no, stop_sequence, bus_stop_code,
+                  distance) in enumerate(rows)}
+    rt_bs = {}
+    for idx, row in rt_idx.items():
+        rt_bs.setdefault(row['BusStopCode'], {})[idx] = row
+    return rt_idx, rt_bs
+
+
+def make_network(rows, bs):
+    # Graph of the route rows between the bus stops of bs
+    rt_idx, rt_bs = route_tables(rows)
+    return graph.compile_graph(rt_idx, rt_bs, bs)
@@ -1,8 +1,14 @@
-from math import radians, cos, sin, asin, sqrt
+from collections import defaultdict
+from math import radians, degrees, cos, sin, asin, sqrt, floor
+
+import numpy as np
 
 # Earth equatorial radius in km based on WGS-84 geoid
 EARTH_RADIUS = 6378.137
 
+# Side of a spatial grid cell in km
+GRID_CELL_SIZE = 0.5
+
 def _equirectangular(lat1, lon1, lat2, lon2):
     lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
     x = (lon2 - lon1) * cos(0.5 * (lat2 + lat1))
@@ -25,5 +31,113 @@ def _haversine(lat1, lon1, lat2, lon2):
     km = EARTH_RADIUS * c
     return km
 
+def _equirectangular_array(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, [lat1, lon1, lat2, lon2])
+    x = (lon2 - lon1) * np.cos(0.5 * (lat2 + lat1))
+    y = lat2 - lat1
+    return EARTH_RADIUS * np.sqrt(x * x + y * y)
+
+def _haversine_array(lat1, lon1, lat2, lon2):
+    """
+    Haversine distance over NumPy arrays, broadcasting like any ufunc
+    """
+    lon1, lat1, lon2, lat2 = map(np.radians, [lon1, lat1, lon2, lat2])
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = np.sin(dlat / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2)**2
+    return EARTH_RADIUS * 2 * np.arcsin(np.sqrt(a))
+
 def distance(lat1, lon1, lat2, lon2):
     return _haversine(lat1, lon1, lat2, lon2)
+
+def distances(lat, lon, latitudes, longitudes):
+    # Distances from one point to each of N points
+    return _haversine_array(lat, lon, np.asarray(latitudes, dtype=np.float64),
+                            np.asarray(longitudes, dtype=np.float64))
+
+def distance_matrix(latitudes1, longitudes1, latitudes2, longitudes2):
+    # M x N distances between each of M points and each of N points
+    latitudes1 = np.asarray(latitudes1, dtype=np.float64)[:, np.newaxis]
+    longitudes1 = np.asarray(longitudes1, dtype=np.float64)[:, np.newaxis]
+    return _haversine_array(latitudes1, longitudes1,
+                            np.asarray(latitudes2, dtype=np.float64),
+                            np.asarray(longitudes2, dtype=np.float64))
+
+
+class GridIndex:
+    """
+    Buckets points into square cells of an equirectangular projection so that
+    radius queries only visit the cells around the query point
+    """
+
+    def __init__(self, latitudes, longitudes, cell_size=GRID_CELL_SIZE):
+        self.latitudes = np.asarray(latitudes, dtype=np.float64)
+        self.longitudes = np.asarray(longitudes, dtype=np.float64)
+        self.cell_size = cell_size
+        if len(self.latitudes):
+            self.ref_cos = cos(radians(
+                0.5 * (self.latitudes.min() + self.latitudes.max())))
+        else:
+            self.ref_cos = 1.0
+        self.cells = defaultdict(list)
+        for i, (lat, lon) in enumerate(zip(self.latitudes.tolist(),
+                                           self.longitudes.tolist())):
+            x, y = self._project(lat, lon)
+            self.cells[(floor(x / cell_size), floor(y / cell_size))].append(i)
+
+    def _project(self, lat, lon):
+        return (EARTH_RADIUS * radians(lon) * self.ref_cos,
+                EARTH_RADIUS * radians(lat))
+
+    def within(self, lat, lon, radius):
+        """
+        Return (index, distance) of every point within radius km of lat, lon
+        """
+        x, y = self._project(lat, lon)
+        # Widen the east-west extent by how much the projection overstates
+        # longitude spans away from the reference latitude
+        lat_span = degrees(radius / EARTH_RADIUS)
+        min_cos = min(cos(radians(lat - lat_span)),
+                      cos(radians(lat + lat_span)))
+        x_radius = radius * max(1.0, self.ref_cos / min_cos) * 1.001
+        y_radius = radius * 1.001
+
+        cell_size = self.cell_size
+        candidates = []
+        for cx in range(floor((x - x_radius) / cell_size),
+                        floor((x + x_radius) / cell_size) + 1):
+            for cy in range(floor((y - y_radius) / cell_size),
+                            floor((y + y_radius) / cell_size) + 1):
+                candidates.extend(self.cells.get((cx, cy), ()))
+        if not candidates:
+            return []
+
+        candidates = np.array(candidates)
+        candidate_distances = distances(lat, lon, self.latitudes[candidates],
+                                        self.longitudes[candidates])
+        is_nearby = candidate_distances <= radius
+        return list(zip(candidates[is_nearby].tolist(),
+                        candidate_distances[is_nearby].tolist()))
+
+
+def rasterize(latitudes, longitudes, values, cell_size=GRID_CELL_SIZE):
+    """
+    Least of the values at the points in each square cell of cell_size km
+
+    Returns the latitudes of the cell rows and the longitudes of the cell
+    columns, at their centres, and the rows x columns grid of values, inf
+    in cells without a point.
+    """
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    lat_step = degrees(cell_size / EARTH_RADIUS)
+    lon_step = lat_step / cos(radians(
+        0.5 * (latitudes.min() + latitudes.max())))
+    rows = np.floor((latitudes - latitudes.min()) / lat_step).astype(int)
+    columns = np.floor((longitudes - longitudes.min()) / lon_step).astype(
+        int)
+    grid = np.full((rows.max() + 1, columns.max() + 1), np.inf)
+    np.minimum.at(grid, (rows, columns), values)
+    return (latitudes.min() + (np.arange(grid.shape[0]) + 0.5) * lat_step,
+            longitudes.min() + (np.arange(grid.shape[1]) + 0.5) * lon_step,
+            grid)
@@ -0,0 +1,612 @@
+import hashlib
+import os
+import pickle
+import struct
+
+import numpy as np
+
+import geo
+
+GRAPH_PATH = 'graph.pkl'
+BUNDLE_PATH = 'graph.bin'
+
+# Stops within this many km of each other are joined by footpaths
+WALK_RADIUS = 0.2
+
+# Bits per word of the packed service bitsets
+WORD_BITS = 64
+
+# Bundle layout: header, section table, then 8-byte aligned sections
+BUNDLE_MAGIC = b'SGBR'
+BUNDLE_VERSION = 1
+BUNDLE_HEADER = struct.Struct('<4sII')  # magic, version, number of sections
+BUNDLE_SECTION = struct.Struct('<16s4sQQ')  # name, dtype, offset, count
+BUNDLE_ALIGNMENT = 8
+
+
+class Graph:
+    """
+    Integer indexed transit graph
+
+    Stops and services are mapped to dense integers. Edges are stored in
+    compressed sparse row form: the successors of stop i are
+    indices[indptr[i]:indptr[i + 1]], with the distance travelled and a
+    packed bitset of services running along each edge. Footpaths to the
+    stops within walk_radius of each stop are stored the same way, none
+    unless built with with_footpaths().
+    """
+
+    def __init__(self, stop_codes, latitudes, longitudes, service_nos, indptr,
+                 indices, distances, service_masks, walk_radius=0.0,
+                 walk_indptr=None, walk_indices=None, walk_distances=None):
+        self.stop_codes = stop_codes
+        self.latitudes = latitudes
+        self.longitudes = longitudes
+        self.service_nos = service_nos
+        self.indptr = indptr
+        self.indices = indices
+        self.distances = distances
+        self.service_masks = service_masks
+        if walk_indptr is None:
+            walk_indptr = np.zeros(len(stop_codes) + 1, dtype=np.int32)
+            walk_indices = np.zeros(0, dtype=np.int32)
+            walk_distances = np.zeros(0, dtype=np.float64)
+        self.walk_radius = walk_radius
+        self.walk_indptr = walk_indptr
+        self.walk_indices = walk_indices
+        self.walk_distances = walk_distances
+        self._init_lookups()
+
+    def _init_lookups(self):
+        self._stop_index = None
+        self._service_index = None
+        self._grid = None
+        self._version = None
+        self._successors = [None] * len(self.stop_codes)
+        self._footpaths = [None] * len(self.stop_codes)
+        self._predecessors = None
+        self._states = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_stop_index']
+        del state['_service_index']
+        del state['_grid']
+        del state['_version']
+        del state['_successors']
+        del state['_footpaths']
+        del state['_predecessors']
+        del state['_states']
+        return state
+
+    def __setstate__(self, state):
+        # Pickles from before footpaths have none
+        if 'walk_indptr' not in state:
+            state.update(walk_radius=0.0, walk_indptr=np.zeros(
+                len(state['stop_codes']) + 1, dtype=np.int32),
+                walk_indices=np.zeros(0, dtype=np.int32),
+                walk_distances=np.zeros(0, dtype=np.float64))
+        self.__dict__.update(state)
+        self._init_lookups()
+
+    @property
+    def stop_index(self):
+        if self._stop_index is None:
+            self._stop_index = {code: i for i, code in
+                                enumerate(self.stop_codes)}
+        return self._stop_index
+
+    @property
+    def service_index(self):
+        if self._service_index is None:
+            self._service_index = {service_no: i for i, service_no in
+                                   enumerate(self.service_nos)}
+        return self._service_index
+
+    @property
+    def grid(self):
+        if self._grid is None:
+            self._grid = geo.GridIndex(self.latitudes.tolist(),
+                                       self.longitudes.tolist())
+        return self._grid
+
+    @property
+    def version(self):
+        # Content hash of the graph, identical for a pickle and a bundle
+        if self._version is None:
+            digest = hashlib.sha1()
+            for strings in [self.stop_codes, self.service_nos]:
+                digest.update('\0'.join(strings).encode('utf-8'))
+            arrays = [self.latitudes, self.longitudes, self.indptr,
+                      self.indices, self.distances, self.service_masks]
+            # Graphs without footpaths keep the hash they had before them
+            if self.num_footpaths:
+                arrays += [np.array([self.walk_radius]), self.walk_indptr,
+                           self.walk_indices, self.walk_distances]
+            for array in arrays:
+                digest.update(np.ascontiguousarray(array).tobytes())
+            self._version = digest.hexdigest()[:16]
+        return self._version
+
+    @property
+    def states(self):
+        if self._states is None:
+            self._states = StateGraph(self)
+        return self._states
+
+    @property
+    def num_stops(self):
+        return len(self.stop_codes)
+
+    @property
+    def num_edges(self):
+        return len(self.indices)
+
+    @property
+    def num_footpaths(self):
+        return len(self.walk_indices)
+
+    def coordinates(self, bus_stop_code):
+        stop = self.stop_index[bus_stop_code]
+        return float(self.latitudes[stop]), float(self.longitudes[stop])
+
+    def stops_within(self, lat, lon, radius):
+        # Stops within radius km of lat, lon mapped to their distance
+        return dict(self.grid.within(lat, lon, radius))
+
+    def service_mask(self, edge):
+        return int.from_bytes(
+            self.service_masks[edge].astype('<u8').tobytes(), 'little')
+
+    def successors(self, stop):
+        # Adjacency of each stop is materialized once, on first expansion,
+        # as (next_stop, distance, services mask) tuples
+        adjacency = self._successors[stop]
+        if adjacency is None:
+            start, end = int(self.indptr[stop]), int(self.indptr[stop + 1])
+            adjacency = [
+                (next_stop, distance, self.service_mask(edge))
+                for edge, next_stop, distance in zip(
+                    range(start, end), self.indices[start:end].tolist(),
+                    self.distances[start:end].tolist())]
+            self._successors[stop] = adjacency
+        return adjacency
+
+    def predecessors(self, stop):
+        # (previous_stop, distance, services mask) of the edges into stop,
+        # indexed for every stop on first use
+        predecessors = self._predecessors
+        if predecessors is None:
+            predecessors = [[] for _ in range(self.num_stops)]
+            for previous_stop in range(self.num_stops):
+                for next_stop, distance, services in self.successors(
+                        previous_stop):
+                    predecessors[next_stop].append(
+                        (previous_stop, distance, services))
+            self._predecessors = predecessors
+        return predecessors[stop]
+
+    def footpaths(self, stop):
+        # (next_stop, distance) of the stops within walking distance
+        footpaths = self._footpaths[stop]
+        if footpaths is None:
+            start, end = int(self.walk_indptr[stop]), int(
+                self.walk_indptr[stop + 1])
+            footpaths = list(zip(self.walk_indices[start:end].tolist(),
+                                 self.walk_distances[start:end].tolist()))
+            self._footpaths[stop] = footpaths
+        return footpaths
+
+    def successor_rows(self):
+        """
+        Expand the edges into one (stop, next_stop, distance, service id) row
+        per service running along them, as arrays
+        """
+        bits = np.unpackbits(
+            np.ascontiguousarray(self.service_masks, dtype='<u8').view(
+                np.uint8), axis=1, bitorder='little')
+        edges, services = np.nonzero(bits)
+        stops = np.repeat(np.arange(self.num_stops), np.diff(self.indptr))
+        return (stops[edges], self.indices[edges].astype(np.int64),
+                self.distances[edges], services)
+
+    def encode_services(self, service_nos):
+        mask = 0
+        for service_no in service_nos:
+            mask |= 1 << self.service_index[service_no]
+        return mask
+
+    def decode_services(self, mask):
+        services = set()
+        while mask:
+            lowest_bit = mask & -mask
+            services.add(self.service_nos[lowest_bit.bit_length() - 1])
+            mask ^= lowest_bit
+        return services
+
+
+class StateGraph:
+    """
+    Graph of (stop, service) states, searchable in both directions
+
+    Nodes below num_stops are the stops themselves, the others are riding a
+    service at a stop. Boarding leads from a stop to its states, alighting
+    leads back for free and riding follows an edge between two states of one
+    service. Boarding costs are left to the search so that one state graph
+    serves every transfer penalty.
+    """
+
+    def __init__(self, graph):
+        stops, next_stops, distances, services = graph.successor_rows()
+        num_stops = graph.num_stops
+        num_services = max(1, len(graph.service_nos))
+        tails = stops * num_services + services
+        heads = next_stops * num_services + services
+        keys = np.unique(np.concatenate([tails, heads]))
+        state_stops = keys // num_services
+
+        self.num_stops = num_stops
+        self.node_stops = list(range(num_stops)) + state_stops.tolist()
+        stop_ptr = (np.concatenate([[0], np.cumsum(np.bincount(
+            state_stops, minlength=num_stops))]) + num_stops).tolist()
+        self.stop_states = [range(start, end) for start, end in
+                            zip(stop_ptr, stop_ptr[1:])]
+        self.rides = [[] for _ in range(len(keys))]
+        self.reverse_rides = [[] for _ in range(len(keys))]
+        for tail, head, distance in zip(
+                (np.searchsorted(keys, tails) + num_stops).tolist(),
+                (np.searchsorted(keys, heads) + num_stops).tolist(),
+                distances.tolist()):
+            self.rides[tail - num_stops].append((head, distance))
+            self.reverse_rides[head - num_stops].append((tail, distance))
+
+    @property
+    def num_nodes(self):
+        return len(self.node_stops)
+
+
+def compile_graph(rt_idx, rt_bs, bs):
+    """
+    Compile the bus route and bus stop dicts into a Graph
+
+    The next stop of each service at a stop is the following bus route row
+    if it continues the same stop sequence.
+    """
+    stop_codes = sorted(bs)
+    stop_index = {code: i for i, code in enumerate(stop_codes)}
+    service_nos = sorted({row['ServiceNo'] for row in rt_idx.values()})
+    service_index = {service_no: i for i, service_no in enumerate(service_nos)}
+
+    # One successor row per service running along each edge
+    stops, next_stops, distances, services = [], [], [], []
+    for bus_stop_code in stop_codes:
+        stop = stop_index[bus_stop_code]
+        for idx, current_service_stop in rt_bs.get(bus_stop_code, {}).items():
+            next_service_stop = rt_idx.get(idx + 1)
+            if next_service_stop is None or next_service_stop[
+                    'StopSequence'] != current_service_stop['StopSequence'] + 1:
+                continue
+            next_stop = stop_index.get(next_service_stop['BusStopCode'])
+            if next_stop is None:
+                continue
+            stops.append(stop)
+            next_stops.append(next_stop)
+            distances.append(next_service_stop['Distance'] -
+                             current_service_stop['Distance'])
+            services.append(service_index[next_service_stop['ServiceNo']])
+
+    return compile_successors(
+        stop_codes, [bs[code]['Latitude'] for code in stop_codes],
+        [bs[code]['Longitude'] for code in stop_codes], service_nos,
+        stops, next_stops, distances, services)
+
+
+def compile_routes(stop_codes, latitudes, longitudes, route_stop_codes,
+                   route_service_nos, route_sequences, route_distances):
+    """
+    Compile bus route columns into a Graph without per-row Python work
+
+    Each route row is followed by the next stop of its service if the next
+    row continues the same stop sequence. Rows at stops missing from
+    stop_codes are dropped.
+    """
+    return compile_route_chunks(
+        stop_codes, latitudes, longitudes,
+        [(route_stop_codes, route_service_nos, route_sequences,
+          route_distances)])
+
+
+def compile_route_chunks(stop_codes, latitudes, longitudes, chunks):
+    """
+    Compile chunks of bus route columns into a Graph, as compile_routes()
+    does their concatenation
+
+    Each chunk is reduced to its successor rows before the next is read, the
+    last row of a chunk carrying over to the first of the next one.
+    """
+    stop_index = {code: i for i, code in enumerate(stop_codes)}
+    successors = []
+    service_nos = set()
+    last_row = None
+    for chunk in chunks:
+        chunk = [np.asarray(column) for column in chunk]
+        service_nos.update(chunk[1].astype(str).tolist())
+        if last_row is not None:
+            chunk = [np.concatenate([last, column])
+                     for last, column in zip(last_row, chunk)]
+        successors.append(_route_successors(stop_index, *chunk))
+        last_row = [column[-1:] for column in chunk]
+    stops, next_stops, distances, row_service_nos = [
+        np.concatenate(columns) for columns in zip(*successors)]
+    service_nos = np.array(sorted(service_nos), dtype=str)
+    return compile_successors(
+        stop_codes, latitudes, longitudes, service_nos.tolist(), stops,
+        next_stops, distances, np.searchsorted(service_nos, row_service_nos))
+
+
+def patch_routes(network, stop_codes, latitudes, longitudes, route_stop_codes,
+                 route_service_nos, route_sequences, route_distances,
+                 removed_service_nos=()):
+    """
+    Recompile only the services in the route columns onto network
+
+    Edges of every other service are carried over from network unless they
+    touch a stop missing from stop_codes or run a removed service. Edges
+    shared with a recompiled service take its distance.
+    """
+    stop_index = {code: i for i, code in enumerate(stop_codes)}
+    replaced = set(route_service_nos) | set(removed_service_nos)
+    old_service_nos = np.asarray(network.service_nos, dtype=str)
+    kept_services = np.array([service_no not in replaced
+                              for service_no in old_service_nos], dtype=bool)
+
+    # Successor rows of unchanged services, renumbered to the new stops
+    renumbered = np.array([stop_index.get(code, -1)
+                           for code in network.stop_codes], dtype=np.int64)
+    old_stops, old_next_stops, old_distances, old_services = \
+        network.successor_rows()
+    old_stops, old_next_stops = renumbered[old_stops], renumbered[
+        old_next_stops]
+    kept = kept_services[old_services] & (old_stops >= 0) & (
+        old_next_stops >= 0)
+
+    stops, next_stops, distances, row_service_nos = _route_successors(
+        stop_index, route_stop_codes, route_service_nos, route_sequences,
+        route_distances)
+    service_nos = np.unique(np.concatenate([
+        old_service_nos[kept_services],
+        np.asarray(route_service_nos, dtype=str)]))
+    return compile_successors(
+        stop_codes, latitudes, longitudes, service_nos.tolist(),
+        np.concatenate([old_stops[kept], stops]),
+        np.concatenate([old_next_stops[kept], next_stops]),
+        np.concatenate([old_distances[kept], distances]),
+        np.searchsorted(service_nos, np.concatenate([
+            old_service_nos[old_services[kept]], row_service_nos])))
+
+
+def _route_successors(stop_index, route_stop_codes, route_service_nos,
+                      route_sequences, route_distances):
+    # (stop, next_stop, distance, service number) of each route row that
+    # continues into the next one
+    stops = np.fromiter((stop_index.get(code, -1) for code in
+                         route_stop_codes), dtype=np.int64,
+                        count=len(route_stop_codes))
+    service_nos = np.asarray(route_service_nos, dtype=str)
+    sequences = np.asarray(route_sequences, dtype=np.int64)
+    distances = np.asarray(route_distances, dtype=np.float64)
+
+    rows = np.flatnonzero((sequences[1:] == sequences[:-1] + 1) &
+                          (stops[:-1] >= 0) & (stops[1:] >= 0))
+    return (stops[rows], stops[rows + 1], distances[rows + 1] -
+            distances[rows], service_nos[rows + 1])
+
+
+def compile_successors(stop_codes, latitudes, longitudes, service_nos, stops,
+                       next_stops, distances, services):
+    """
+    Compile successor rows into a Graph
+
+    Row i runs service services[i] from stops[i] to next_stops[i], all
+    indices into stop_codes and service_nos. Rows sharing an edge merge their
+    services and keep the distance of the last one.
+    """
+    num_stops = len(stop_codes)
+    num_words = max(1, -(-len(service_nos) // WORD_BITS))
+    keys = (np.asarray(stops, dtype=np.int64) * num_stops +
+            np.asarray(next_stops, dtype=np.int64))
+    services = np.asarray(services, dtype=np.int64)
+
+    # Unique over the reversed rows finds the last row of each edge
+    edge_keys, reversed_rows = np.unique(keys[::-1], return_index=True)
+    last_rows = len(keys) - 1 - reversed_rows
+    edges = np.searchsorted(edge_keys, keys)
+
+    indptr = np.zeros(num_stops + 1, dtype=np.int32)
+    indptr[1:] = np.cumsum(np.bincount(edge_keys // num_stops,
+                                       minlength=num_stops))
+    service_masks = np.zeros((len(edge_keys), num_words), dtype=np.uint64)
+    np.bitwise_or.at(service_masks, (edges, services // WORD_BITS),
+                     np.left_shift(np.uint64(1),
+                                   (services % WORD_BITS).astype(np.uint64)))
+
+    return Graph(list(stop_codes), np.asarray(latitudes, dtype=np.float64),
+                 np.asarray(longitudes, dtype=np.float64), list(service_nos),
+                 indptr, (edge_keys % num_stops).astype(np.int32),
+                 np.asarray(distances, dtype=np.float64)[last_rows],
+                 service_masks)
+
+
+def compile_footpaths(latitudes, longitudes, radius=WALK_RADIUS):
+    """
+    Footpaths between every pair of distinct points within radius km of
+    each other, as (indptr, indices, distances) in compressed sparse row
+    form, found through a spatial grid rather than all pairs
+    """
+    grid = geo.GridIndex(latitudes, longitudes)
+    indptr = np.zeros(len(grid.latitudes) + 1, dtype=np.int32)
+    indices, distances = [], []
+    for stop, (lat, lon) in enumerate(zip(grid.latitudes.tolist(),
+                                          grid.longitudes.tolist())):
+        nearby = sorted((other, distance) for other, distance in
+                        grid.within(lat, lon, radius) if other != stop)
+        indices.extend(other for other, _ in nearby)
+        distances.extend(distance for _, distance in nearby)
+        indptr[stop + 1] = len(indices)
+    return (indptr, np.array(indices, dtype=np.int32),
+            np.array(distances, dtype=np.float64))
+
+
+def with_footpaths(graph, radius=WALK_RADIUS):
+    # The graph with footpaths within radius km instead of its own, none if
+    # radius is 0
+    footpaths = (None, None, None)
+    if radius > 0:
+        footpaths = compile_footpaths(graph.latitudes, graph.longitudes,
+                                      radius)
+    return Graph(graph.stop_codes, graph.latitudes, graph.longitudes,
+                 graph.service_nos, graph.indptr, graph.indices,
+                 graph.distances, graph.service_masks, radius, *footpaths)
+
+
+class StringTable:
+    """
+    Read-only sequence of strings backed by an offsets array and a blob of
+    concatenated UTF-8 bytes
+    """
+
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [string.encode('utf-8') for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype='<u4')
+        np.cumsum([len(string) for string in encoded], out=offsets[1:])
+        data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        return cls(offsets, data)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('string table index out of range')
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode(
+            'utf-8')
+
+    def __iter__(self):
+        data = self.data.tobytes()
+        offsets = self.offsets.tolist()
+        for start, end in zip(offsets, offsets[1:]):
+            yield data[start:end].decode('utf-8')
+
+
+def _bundle_sections(graph):
+    stop_codes = StringTable.from_strings(graph.stop_codes)
+    service_nos = StringTable.from_strings(graph.service_nos)
+    return [
+        ('latitudes', graph.latitudes.astype('<f8')),
+        ('longitudes', graph.longitudes.astype('<f8')),
+        ('indptr', graph.indptr.astype('<i4')),
+        ('indices', graph.indices.astype('<i4')),
+        ('distances', graph.distances.astype('<f8')),
+        ('service_masks', graph.service_masks.astype('<u8').ravel()),
+        ('stop_offsets', stop_codes.offsets),
+        ('stop_codes', stop_codes.data),
+        ('service_offsets', service_nos.offsets),
+        ('service_nos', service_nos.data),
+        ('walk_radius', np.array([graph.walk_radius], dtype='<f8')),
+        ('walk_indptr', graph.walk_indptr.astype('<i4')),
+        ('walk_indices', graph.walk_indices.astype('<i4')),
+        ('walk_distances', graph.walk_distances.astype('<f8')),
+    ]
+
+
+def save_bundle(graph, path=BUNDLE_PATH):
+    """
+    Write the graph as a versioned binary bundle that load_bundle() can
+    memory-map without parsing
+    """
+    sections = _bundle_sections(graph)
+    offset = BUNDLE_HEADER.size + BUNDLE_SECTION.size * len(sections)
+    table = []
+    for name, array in sections:
+        offset += -offset % BUNDLE_ALIGNMENT
+        table.append(BUNDLE_SECTION.pack(
+            name.encode('ascii'), array.dtype.str.encode('ascii'), offset,
+            array.size))
+        offset += array.nbytes
+
+    # Write to a temporary file first so readers never see a partial bundle
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(BUNDLE_HEADER.pack(BUNDLE_MAGIC, BUNDLE_VERSION,
+                                   len(sections)))
+        f.write(b''.join(table))
+        for name, array in sections:
+            f.write(b'\0' * (-f.tell() % BUNDLE_ALIGNMENT))
+            f.write(array.tobytes())
+    os.replace(tmp_path, path)
+
+
+def load_bundle(path=BUNDLE_PATH):
+    buffer = np.memmap(path, dtype=np.uint8, mode='r')
+    magic, version, num_sections = BUNDLE_HEADER.unpack_from(buffer, 0)
+    if magic != BUNDLE_MAGIC:
+        raise ValueError('{} is not a graph bundle'.format(path))
+    if version != BUNDLE_VERSION:
+        raise ValueError('{} has bundle version {}, expected {}'.format(
+            path, version, BUNDLE_VERSION))
+
+    sections = {}
+    for i in range(num_sections):
+        name, dtype, offset, count = BUNDLE_SECTION.unpack_from(
+            buffer, BUNDLE_HEADER.size + BUNDLE_SECTION.size * i)
+        sections[name.rstrip(b'\0').decode('ascii')] = np.frombuffer(
+            buffer, dtype=np.dtype(dtype.rstrip(b'\0').decode('ascii')),
+            count=count, offset=offset)
+
+    service_nos = StringTable(sections['service_offsets'],
+                              sections['service_nos'])
+    num_words = max(1, -(-len(service_nos) // WORD_BITS))
+    # Bundles from before footpaths have none
+    footpaths = [0.0, None, None, None]
+    if 'walk_indptr' in sections:
+        footpaths = [float(sections['walk_radius'][0]),
+                     sections['walk_indptr'], sections['walk_indices'],
+                     sections['walk_distances']]
+    return Graph(
+        StringTable(sections['stop_offsets'], sections['stop_codes']),
+        sections['latitudes'], sections['longitudes'], service_nos,
+        sections['indptr'], sections['indices'], sections['distances'],
+        sections['service_masks'].reshape(-1, num_words), *footpaths)
+
+
+def save(graph, path=GRAPH_PATH):
+    with open(path, 'wb') as f:
+        pickle.dump(graph, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def default_path():
+    # The bundle if one was built, else the pickle
+    return BUNDLE_PATH if os.path.exists(BUNDLE_PATH) else GRAPH_PATH
+
+
+def load(path=None):
+    """
+    Load a graph bundle or pickle, detected by its leading bytes
+
+    Without a path, the bundle is preferred over the pickle if it exists.
+    """
+    if path is None:
+        path = default_path()
+    with open(path, 'rb') as f:
+        magic = f.read(len(BUNDLE_MAGIC))
+        if magic != BUNDLE_MAGIC:
+            f.seek(0)
+            return pickle.load(f)
+    return load_bundle(path)
@@ -0,0 +1,252 @@
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
+import math
+import os
+import random
+import shutil
+import time
+
+import numpy as np
+
+MATRIX_PATH = 'matrix'
+META_FILE = 'meta.json'
+COSTS_FILE = 'costs.npy'
+TRANSFERS_FILE = 'transfers.npy'
+
+# Origins searched per shard, each shard is checkpointed once written
+SHARD_SIZE = 100
+
+# Transfers of unreachable stops, more transfers are saturated below it
+UNREACHABLE = 255
+
+# Router of a build worker process
+_router = None
+
+
+class CostMatrix:
+    """
+    Cost and transfers of the cheapest route between every pair of stops
+
+    costs[origin, stop] is the float32 cost of route.py's search from origin
+    to stop, inf if unreachable, and transfers[origin, stop] its transfers.
+    The arrays are memory-mapped, a lookup only reads the pages it needs.
+    """
+
+    def __init__(self, version, transfer_penalty, walk_weight, costs,
+                 transfers):
+        self.version = version
+        self.transfer_penalty = transfer_penalty
+        self.walk_weight = walk_weight
+        self.costs = costs
+        self.transfers = transfers
+
+    def lookup(self, origins, goal):
+        """
+        Return (cost, transfers) of the cheapest route from any of the origin
+        stops to goal, None if there is none
+        """
+        best = None
+        for origin in origins:
+            cost = float(self.costs[origin, goal])
+            if cost < math.inf and (best is None or cost < best[0]):
+                best = (cost, int(self.transfers[origin, goal]))
+        return best
+
+
+def _shard_done(path, start):
+    return os.path.join(path, 'shard-{:05d}.done'.format(start))
+
+
+def _init_worker(network, walk_weight):
+    # The graph is sent once per worker rather than with every shard
+    global _router
+    import route
+
+    _router = route.Router(network, walk_weight=walk_weight)
+
+
+def _search_shard(path, start, end, transfer_penalty):
+    # Write the rows of origins start to end - 1, then mark them done
+    router = _router
+    network = router.network
+    costs = np.load(os.path.join(path, COSTS_FILE), mmap_mode='r+')
+    transfers = np.load(os.path.join(path, TRANSFERS_FILE), mmap_mode='r+')
+    for origin in range(start, end):
+        isochrone = router.isochrone(
+            router.context(transfer_penalty=transfer_penalty),
+            [network.stop_codes[origin]])
+        costs[origin] = isochrone.cost
+        transfers[origin] = np.where(
+            isochrone.transfers < 0, UNREACHABLE,
+            np.minimum(isochrone.transfers, UNREACHABLE - 1))
+    costs.flush()
+    transfers.flush()
+    del costs, transfers
+    open(_shard_done(path, start), 'w').close()
+    return end - start
+
+
+def build(network, transfer_penalty, walk_weight, path=MATRIX_PATH,
+          workers=None):
+    """
+    Search from every stop over a pool of workers processes, one per core by
+    default, and write the cost matrix to the path directory, replacing it
+    once complete
+
+    Shards written by an interrupted build of the same graph and parameters
+    are kept, so running it again resumes where it left off.
+    """
+    num_stops = network.num_stops
+    meta = {'version': network.version, 'transfer_penalty': transfer_penalty,
+            'walk_weight': walk_weight}
+    tmp_path = path + '.tmp'
+    try:
+        with open(os.path.join(tmp_path, META_FILE)) as f:
+            resumed = json.load(f) == meta
+    except (FileNotFoundError, ValueError):
+        resumed = False
+    if not resumed:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for name, dtype in [(COSTS_FILE, '<f4'), (TRANSFERS_FILE, 'u1')]:
+            np.lib.format.open_memmap(
+                os.path.join(tmp_path, name), mode='w+', dtype=dtype,
+                shape=(num_stops, num_stops)).flush()
+        with open(os.path.join(tmp_path, META_FILE), 'w') as f:
+            json.dump(meta, f)
+
+    shards = [(start, min(start + SHARD_SIZE, num_stops))
+              for start in range(0, num_stops, SHARD_SIZE)
+              if not os.path.exists(_shard_done(tmp_path, start))]
+    searched = num_stops - sum(end - start for start, end in shards)
+    if searched:
+        print('Resuming with {} of {} origins searched'.format(
+            searched, num_stops))
+
+    start_time = time.perf_counter()
+    done = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(network, walk_weight)) as executor:
+        futures = [executor.submit(_search_shard, tmp_path, start, end,
+                                   transfer_penalty)
+                   for start, end in shards]
+        for future in as_completed(futures):
+            done += future.result()
+            elapsed = time.perf_counter() - start_time
+            print('Searched {} of {} origins, {:.0f}s remaining'.format(
+                searched + done, num_stops,
+                elapsed / done * (num_stops - searched - done)))
+
+    for start in range(0, num_stops, SHARD_SIZE):
+        os.remove(_shard_done(tmp_path, start))
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+
+
+def load(path=MATRIX_PATH):
+    with open(os.path.join(path, META_FILE)) as f:
+        meta = json.load(f)
+    return CostMatrix(
+        meta['version'], meta['transfer_penalty'], meta['walk_weight'],
+        np.load(os.path.join(path, COSTS_FILE), mmap_mode='r'),
+        np.load(os.path.join(path, TRANSFERS_FILE), mmap_mode='r'))
+
+
+def check(number, seed):
+    """
+    Compare matrix lookups with the A* search of route.py on random stop
+    pairs
+    """
+    import route
+
+    cost_matrix = route.router.cost_matrix
+    if cost_matrix is None:
+        exit('No cost matrix matching the graph, run matrix.py build')
+    network = route.network
+    transfer_penalty = cost_matrix.transfer_penalty
+    rng = random.Random(seed)
+    counts = {'same': 0, 'better': 0, 'worse': 0, 'unreachable': 0,
+              'mismatch': 0}
+    lookup_time = search_time = 0.0
+    for _ in range(number):
+        origin, goal = rng.sample(list(network.stop_codes), 2)
+        start = time.perf_counter()
+        try:
+            cost, _ = route.router.cost_codes([origin], goal,
+                                              transfer_penalty)
+        except route.NoRouteError:
+            cost = None
+        lookup_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        try:
+            expected = route.router.dijkstra(
+                route.router.context(network.coordinates(goal),
+                                     transfer_penalty=transfer_penalty),
+                [origin], {goal}).best_cost
+        except route.NoRouteError:
+            expected = None
+        search_time += time.perf_counter() - start
+        if cost is None or expected is None:
+            counts['unreachable' if cost is expected else 'mismatch'] += 1
+        elif abs(cost - expected) < 1e-4:
+            counts['same'] += 1
+        elif cost < expected:
+            counts['better'] += 1
+        else:
+            counts['worse'] += 1
+
+    print('Against route.dijkstra : {same} same, {better} cheaper, {worse} '
+          'costlier, {unreachable} unreachable, {mismatch} '
+          'mismatched'.format(**counts))
+    print('Mean query time        : {:.4f}ms lookup, {:.3f}ms '
+          'dijkstra'.format(lookup_time / number * 1000,
+                            search_time / number * 1000))
+    return counts['mismatch'] == 0
+
+
+def main():
+    import route
+
+    parser = ArgumentParser(
+        description='Precomputes the cost between every pair of stops')
+    parser.add_argument(
+        '-t', '--transfer-penalty', default=route.TRANSFER_PENALTY,
+        type=float, help="transfer penalty the matrix is built for")
+    subparsers = parser.add_subparsers(help='mode', dest='mode')
+    subparsers.required = True
+    buildparser = subparsers.add_parser(
+        'build', help='search from every stop and save')
+    buildparser.add_argument(
+        '-f', '--force', action='store_true',
+        help="rebuild even if the saved matrix matches the graph")
+    buildparser.add_argument(
+        '-w', '--workers', type=int,
+        help="number of worker processes, one per core by default")
+    checkparser = subparsers.add_parser(
+        'check', help='compare lookups with searches on random stop pairs')
+    checkparser.add_argument(
+        '-n', '--number', default=200, type=int, help="number of pairs")
+    checkparser.add_argument(
+        '-s', '--seed', default=0, type=int, help="random seed")
+    args = parser.parse_args()
+
+    if args.mode == 'build':
+        saved = route.router.cost_matrix
+        if not args.force and saved is not None and \
+                saved.transfer_penalty == args.transfer_penalty and \
+                saved.walk_weight == route.router.walk_weight:
+            print('Cost matrix is up to date')
+            return
+        start = time.perf_counter()
+        build(route.network, args.transfer_penalty, route.router.walk_weight,
+              MATRIX_PATH, args.workers)
+        print('Built cost matrix for {} stops in {:.1f}s'.format(
+            route.network.num_stops, time.perf_counter() - start))
+    elif args.mode == 'check':
+        if not check(args.number, args.seed):
+            exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,346 @@
+from argparse import ArgumentParser
+import heapq
+import json
+import math
+import os
+import random
+import shutil
+import time
+
+import numpy as np
+
+PATTERNS_PATH = 'patterns'
+META_FILE = 'meta.json'
+VIA_FILE = 'via.npy'
+SERVICES_FILE = 'services.npy'
+
+# Progress is reported every this many origins while building
+LOG_INTERVAL = 500
+
+
+def build_state_graph(network, transfer_penalty):
+    """
+    Expand the graph into (stop, service) states
+
+    States 0 to num_stops - 1 are the stops themselves. Riding service s from
+    stop u to v is an arc between their (stop, s) states costing the edge
+    distance, boarding s at u is an arc from stop u costing transfer_penalty
+    and alighting is a free arc back to the stop. A route from an origin stop
+    then costs its distance plus the penalty for every boarding, one more than
+    the transfers Edge.calculate_cost() charges for.
+
+    Returns (state_services, out_arcs), out_arcs holding the (head, cost) arcs
+    of each state.
+    """
+    state_services = [-1] * network.num_stops
+    states = {}
+    arcs = {}
+
+    def state(stop, service):
+        key = (stop, service)
+        if key not in states:
+            states[key] = len(state_services)
+            state_services.append(service)
+        return states[key]
+
+    for stop in range(network.num_stops):
+        for next_stop, distance, services in network.successors(stop):
+            while services:
+                lowest_bit = services & -services
+                service = lowest_bit.bit_length() - 1
+                services ^= lowest_bit
+                tail, head = state(stop, service), state(next_stop, service)
+                arcs[(tail, head)] = distance
+                arcs[(stop, tail)] = transfer_penalty
+                arcs[(head, next_stop)] = 0.0
+
+    out_arcs = [[] for _ in state_services]
+    for (tail, head), cost in arcs.items():
+        out_arcs[tail].append((head, cost))
+    return state_services, out_arcs
+
+
+def one_to_all(num_stops, state_services, out_arcs, origin):
+    """
+    Exact search from origin over the state graph
+
+    Returns the cost of every state and, for every stop, the stop its last
+    leg was boarded at and the service of that leg, -1 if unreached.
+    """
+    costs = [math.inf] * len(out_arcs)
+    leg_starts = [-1] * len(out_arcs)
+    via = [-1] * num_stops
+    via_services = [-1] * num_stops
+    costs[origin] = 0.0
+    via[origin] = origin
+    queue = [(0.0, origin)]
+    while queue:
+        cost, state = heapq.heappop(queue)
+        if cost > costs[state]:
+            continue
+        for head, arc_cost in out_arcs[state]:
+            next_cost = cost + arc_cost
+            if next_cost >= costs[head]:
+                continue
+            costs[head] = next_cost
+            if state < num_stops:
+                # Boarding
+                leg_starts[head] = state
+            elif head < num_stops:
+                # Alighting
+                via[head] = leg_starts[state]
+                via_services[head] = state_services[state]
+            else:
+                leg_starts[head] = leg_starts[state]
+            heapq.heappush(queue, (next_cost, head))
+    return costs, via, via_services
+
+
+def ride_stops(network, board, service, alight):
+    # Stops from board to alight along the shortest ride on service
+    bit = 1 << service
+    costs = {board: 0.0}
+    previous = {board: None}
+    queue = [(0.0, board)]
+    while queue:
+        cost, stop = heapq.heappop(queue)
+        if stop == alight:
+            break
+        if cost > costs[stop]:
+            continue
+        for next_stop, distance, services in network.successors(stop):
+            if services & bit and cost + distance < costs.get(next_stop,
+                                                               math.inf):
+                costs[next_stop] = cost + distance
+                previous[next_stop] = stop
+                heapq.heappush(queue, (cost + distance, next_stop))
+    stops = [alight]
+    while previous[stops[-1]] is not None:
+        stops.append(previous[stops[-1]])
+    return stops[::-1]
+
+
+def _index_dtype(size):
+    # Smallest unsigned type that holds indices below size and a sentinel
+    return np.dtype('<u2') if size < 0xFFFF else np.dtype('<u4')
+
+
+class TransferPatterns:
+    """
+    Optimal transfer stops between every pair of stops
+
+    via[origin, stop] is where the last leg of the cheapest route from origin
+    to stop was boarded, riding services[origin, stop]. Following via back
+    from the goal yields the legs of the route, the unreachable sentinel marks
+    stops that cannot be reached.
+
+    This is a last-leg table over all pairs rather than the transfer pattern
+    DAGs of Bast et al., and it is exact in the (stop, service) states.
+    route.py's search keeps one label per stop with the services of its ride
+    in, so it misses routes that reach a stop dearer on a better service and
+    costs more on some pairs. Routes only follow the table when asked to.
+    """
+
+    def __init__(self, version, transfer_penalty, via, services):
+        self.version = version
+        self.transfer_penalty = transfer_penalty
+        self.via = via
+        self.services = services
+        self.unreachable = np.iinfo(via.dtype).max
+
+    def legs(self, origin, goal):
+        """
+        Return the (board stop, service, alight stop) legs of the cheapest
+        route from origin to goal, None if there is none
+        """
+        via = self.via[origin]
+        services = self.services[origin]
+        legs = []
+        stop = goal
+        while stop != origin:
+            board = int(via[stop])
+            if board == self.unreachable:
+                return None
+            legs.append((board, int(services[stop]), stop))
+            stop = board
+        return legs[::-1]
+
+    def stops(self, network, origin, goal):
+        # Stops along the cheapest route from origin to goal, None if none
+        legs = self.legs(origin, goal)
+        if legs is None:
+            return None
+        stops = [origin]
+        for board, service, alight in legs:
+            stops.extend(ride_stops(network, board, service, alight)[1:])
+        return stops
+
+
+def build(network, transfer_penalty, path=PATTERNS_PATH):
+    """
+    Run an exact search from every stop and write the transfer patterns to
+    the path directory, replacing it once complete
+    """
+    state_services, out_arcs = build_state_graph(network, transfer_penalty)
+    num_stops = network.num_stops
+    stop_dtype = _index_dtype(num_stops)
+    service_dtype = _index_dtype(len(network.service_nos))
+
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    via = np.lib.format.open_memmap(
+        os.path.join(tmp_path, VIA_FILE), mode='w+', dtype=stop_dtype,
+        shape=(num_stops, num_stops))
+    services = np.lib.format.open_memmap(
+        os.path.join(tmp_path, SERVICES_FILE), mode='w+',
+        dtype=service_dtype, shape=(num_stops, num_stops))
+
+    start = time.perf_counter()
+    for origin in range(num_stops):
+        _, origin_via, origin_services = one_to_all(
+            num_stops, state_services, out_arcs, origin)
+        origin_via = np.array(origin_via)
+        origin_via[origin_via < 0] = np.iinfo(stop_dtype).max
+        via[origin] = origin_via
+        services[origin] = np.maximum(origin_services, 0)
+        if (origin + 1) % LOG_INTERVAL == 0:
+            elapsed = time.perf_counter() - start
+            print('Searched {} of {} origins, {:.0f}s remaining'.format(
+                origin + 1, num_stops,
+                elapsed / (origin + 1) * (num_stops - origin - 1)))
+    via.flush()
+    services.flush()
+    del via, services
+
+    with open(os.path.join(tmp_path, META_FILE), 'w') as f:
+        json.dump({'version': network.version,
+                   'transfer_penalty': transfer_penalty}, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+
+
+def load(path=PATTERNS_PATH):
+    with open(os.path.join(path, META_FILE)) as f:
+        meta = json.load(f)
+    return TransferPatterns(
+        meta['version'], meta['transfer_penalty'],
+        np.load(os.path.join(path, VIA_FILE), mmap_mode='r'),
+        np.load(os.path.join(path, SERVICES_FILE), mmap_mode='r'))
+
+
+def exact_cost(network, state_services, out_arcs, transfer_penalty, origin,
+               goal):
+    # Cost of the cheapest route in the state graph, in the route.py model
+    costs, _, _ = one_to_all(network.num_stops, state_services, out_arcs,
+                             origin)
+    if origin == goal or costs[goal] == math.inf:
+        return 0.0 if origin == goal else None
+    return costs[goal] - transfer_penalty
+
+
+def check(number, seed):
+    """
+    Compare the routes found through the patterns with exact state graph
+    costs and with the A* search of route.py on random stop pairs
+
+    Passes when every route costs exactly what the state graph does. The
+    table being exact, routes cheaper than the A* search's are reported but
+    expected.
+    """
+    import route
+
+    patterns = route.router.patterns
+    if patterns is None:
+        exit('No transfer patterns matching the graph, run patterns.py build')
+    network = route.network
+    transfer_penalty = patterns.transfer_penalty
+    state_services, out_arcs = build_state_graph(network, transfer_penalty)
+    rng = random.Random(seed)
+    counts = {'exact': 0, 'mismatch': 0, 'unreachable': 0, 'same': 0,
+              'better': 0, 'worse': 0}
+    patterns_time = search_time = 0.0
+    for _ in range(number):
+        origin, goal = rng.sample(list(network.stop_codes), 2)
+        expected = exact_cost(network, state_services, out_arcs,
+                              transfer_penalty, network.stop_index[origin],
+                              network.stop_index[goal])
+        start = time.perf_counter()
+        try:
+            cost = route.router.route_codes([origin], goal,
+                                            transfer_penalty,
+                                            use_patterns=True).best_cost
+        except route.NoRouteError:
+            cost = None
+        patterns_time += time.perf_counter() - start
+        if cost is None or expected is None:
+            counts['exact' if cost is expected else 'mismatch'] += 1
+            counts['unreachable'] += 1
+            continue
+        counts['exact' if abs(cost - expected) < 1e-9 else 'mismatch'] += 1
+
+        start = time.perf_counter()
+        solution = route.router.dijkstra(
+            route.SearchContext(network, network.coordinates(goal),
+                                transfer_penalty=transfer_penalty),
+            [origin], {goal})
+        search_time += time.perf_counter() - start
+        if abs(solution.best_cost - cost) < 1e-9:
+            counts['same'] += 1
+        elif cost < solution.best_cost:
+            counts['better'] += 1
+        else:
+            counts['worse'] += 1
+
+    print('Exact state graph costs : {exact} matched, {mismatch} mismatched, '
+          '{unreachable} unreachable'.format(**counts))
+    print('Against route.dijkstra  : {same} same, {better} cheaper, '
+          '{worse} costlier'.format(**counts))
+    print('Mean query time         : {:.3f}ms patterns, {:.3f}ms '
+          'dijkstra'.format(patterns_time / number * 1000,
+                            search_time / number * 1000))
+    return counts['mismatch'] == 0
+
+
+def main():
+    import route
+
+    parser = ArgumentParser(
+        description='Precomputes transfer patterns for codes queries')
+    parser.add_argument(
+        '-t', '--transfer-penalty', default=route.TRANSFER_PENALTY,
+        type=float, help="transfer penalty the patterns are built for")
+    subparsers = parser.add_subparsers(help='mode', dest='mode')
+    subparsers.required = True
+    buildparser = subparsers.add_parser(
+        'build', help='search from every stop and save')
+    buildparser.add_argument(
+        '-f', '--force', action='store_true',
+        help="rebuild even if the saved patterns match the graph")
+    checkparser = subparsers.add_parser(
+        'check', help='compare pattern routes on random stop pairs')
+    checkparser.add_argument(
+        '-n', '--number', default=200, type=int, help="number of pairs")
+    checkparser.add_argument(
+        '-s', '--seed', default=0, type=int, help="random seed")
+    args = parser.parse_args()
+
+    if args.mode == 'build':
+        if route.network.num_footpaths:
+            exit('Transfer patterns do not walk, build the graph without '
+                 'footpaths with to-pickle.py -w 0')
+        saved = route.router.patterns
+        if not args.force and saved is not None and \
+                saved.transfer_penalty == args.transfer_penalty:
+            print('Transfer patterns are up to date')
+            return
+        start = time.perf_counter()
+        build(route.network, args.transfer_penalty, PATTERNS_PATH)
+        print('Built transfer patterns for {} stops in {:.1f}s'.format(
+            route.network.num_stops, time.perf_counter() - start))
+    elif args.mode == 'check':
+        if not check(args.number, args.seed):
+            exit(1)
+
+if __name__ == '__main__':
+    main()
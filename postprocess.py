@@ -91,3 +91,80 @@ def permissive_route(route):
                 route[i].services &= most_restrictive_services
             else:
                 most_restrictive_services = route[i].services
+
+
+# Transfer policies of refine_route()
+LATEST_TRANSFER = 'latest'
+EARLIEST_TRANSFER = 'earliest'
+PERMISSIVE = 'permissive'
+
+
+def refine_route(route, policy=PERMISSIVE):
+    """
+    Narrow the services of each edge of route in place
+
+    Services are integer bitmasks over the graph's service ids, and the
+    result matches latest_transfer(), earliest_transfer() or
+    permissive_route() on the equivalent sets. One forward pass records the
+    services each leg started with, one reverse pass applies the policy.
+    """
+    if not route:
+        return
+
+    # Forward pass: services of the first edge of each edge's leg
+    leg_start_services = []
+    start_services = route[0].services
+    for edge in route:
+        if edge.has_transferred:
+            start_services = edge.services
+        leg_start_services.append(start_services)
+
+    # Reverse pass, end_services is None until the end of a leg is reached
+    end_services = None
+    next_start_services = None
+    latest_reference = earliest_reference = (leg_start_services[-1] &
+                                             route[-1].services)
+    for i in range(len(route) - 1, -1, -1):
+        edge = route[i]
+        services = edge.services
+        forward_services = services & leg_start_services[i]
+        if end_services is None:
+            end_services = services
+            most_restrictive = None
+            if next_start_services is None:
+                # Final leg, the goal is its reference
+                next_start_services = forward_services
+        leg_services = forward_services & end_services
+
+        if policy == LATEST_TRANSFER:
+            # The edge before a transfer becomes the reference, left as is
+            if latest_reference is None:
+                latest_reference = forward_services
+                services = forward_services
+            else:
+                services = forward_services & latest_reference
+                if edge.has_transferred:
+                    latest_reference = None
+        elif policy == EARLIEST_TRANSFER:
+            if not services & earliest_reference:
+                earliest_reference = forward_services
+            services &= earliest_reference
+        elif policy == PERMISSIVE:
+            # Keep services continuing into the next leg, then remove
+            # 'spikes' of them in the middle of a leg
+            if not edge.has_transferred:
+                services &= leg_services | next_start_services
+            else:
+                services = leg_services
+            if most_restrictive is None or bin(services).count('1') < bin(
+                    most_restrictive).count('1'):
+                most_restrictive = services
+            else:
+                services &= most_restrictive
+        else:
+            raise ValueError('Unknown transfer policy {!r}'.format(policy))
+        edge.services = services
+
+        if edge.has_transferred:
+            next_start_services = leg_services
+            end_services = None
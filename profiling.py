@@ -0,0 +1,100 @@
+from collections import Counter
+from contextlib import contextmanager
+import cProfile
+import io
+import pstats
+import signal
+import sys
+
+# Options
+SAMPLE_INTERVAL = 0.001
+TOP = 25
+
+PROFILERS = ['cprofile', 'sample']
+
+
+class Sampler:
+    """
+    Statistical profiler counting the functions on the stack every interval
+    seconds of CPU time
+
+    Sampling runs off a profiling timer signal so it only sees the main
+    thread, but costs little enough to leave the search timings meaningful.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples = 0
+        self.own = Counter()
+        self.total = Counter()
+
+    def sample(self, signum, frame):
+        self.samples += 1
+        self.own[self.label(frame)] += 1
+        # Count each function once per sample, however deep it recurses
+        seen = set()
+        while frame is not None:
+            label = self.label(frame)
+            if label not in seen:
+                seen.add(label)
+                self.total[label] += 1
+            frame = frame.f_back
+
+    @staticmethod
+    def label(frame):
+        code = frame.f_code
+        return '{}:{}({})'.format(code.co_filename, code.co_firstlineno,
+                                  code.co_name)
+
+    def start(self):
+        self.previous = signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self.previous)
+
+    def report(self, top=TOP):
+        lines = ['{} samples every {:g}ms'.format(self.samples,
+                                                  self.interval * 1000),
+                 '{:>7s} {:>7s}  function'.format('own%', 'total%')]
+        if not self.samples:
+            return lines[0]
+        for label, total in self.total.most_common(top):
+            lines.append('{:>6.1f}% {:>6.1f}%  {}'.format(
+                self.own[label] / self.samples * 100,
+                total / self.samples * 100, label))
+        return '\n'.join(lines)
+
+
+@contextmanager
+def profile(profiler='cprofile', output=None, top=TOP, stream=sys.stderr):
+    """
+    Profile the enclosed block with cProfile or the sampler
+
+    The top functions are printed to stream on exit, and cProfile stats are
+    also dumped to output for pstats or snakeviz when given.
+    """
+    if profiler == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield profiler
+        finally:
+            profiler.disable()
+            if output is not None:
+                profiler.dump_stats(output)
+            report = io.StringIO()
+            pstats.Stats(profiler, stream=report).sort_stats(
+                'cumulative').print_stats(top)
+            print(report.getvalue(), file=stream)
+    elif profiler == 'sample':
+        sampler = Sampler()
+        sampler.start()
+        try:
+            yield sampler
+        finally:
+            sampler.stop()
+            print(sampler.report(top), file=stream)
+    else:
+        raise ValueError('Unknown profiler {}'.format(profiler))
@@ -1,50 +1,191 @@
 from argparse import ArgumentParser
-from collections import defaultdict
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import contextlib
+import copy
+import csv
 from functools import total_ordering
 import heapq
+from itertools import chain, count
+import json
 import logging
 import math
-import pickle
+import os
 from pprint import pprint
+import sys
+import time
+
+import numpy as np
 
 import geo
+import graph
+import matrix
+import patterns
 import postprocess
+import profiling
 
 # Features
 # TODO: Filter out buses that are outside of current availability
-# TODO: Add custom exceptions instead of exit()
 
 # Parameters
 TRANSFER_PENALTY = 5
 NEARBY_STOPS_RADIUS = 0.3
+MAX_TRANSFERS = 6
+# Cost per km walked along footpaths between nearby stops
+WALK_WEIGHT = 2.0
+# Alternative routes cost at most 1 + MAX_DETOUR times the cheapest and
+# share at most MAX_OVERLAP of their distance with each other
+ALTERNATIVES = 3
+MAX_DETOUR = 0.3
+MAX_OVERLAP = 0.5
 
-# Constants
-FROM_ORIGIN_KEY = 'DistanceFromOrigin'
-TO_GOAL_KEY = 'DistanceToGoal'
+# Dense per stop arrays of a one-to-all search, inf and -1 where unreached,
+# with the stats of the search
+Isochrone = namedtuple('Isochrone', ['cost', 'distance', 'transfers',
+                                     'parent', 'stats'])
+
+def _dataset_files():
+    # Identity of the graph, transfer patterns and cost matrix files, which
+    # updates replace atomically
+    files = []
+    for path in [graph.default_path(),
+                 os.path.join(patterns.PATTERNS_PATH, patterns.META_FILE),
+                 os.path.join(matrix.MATRIX_PATH, matrix.META_FILE)]:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            files.append(None)
+            continue
+        files.append((path, stat.st_ino, stat.st_mtime_ns))
+    return files
 
 # Load data
-with open('rt_idx.pkl',
-          'rb') as a, open('rt_bs.pkl',
-                           'rb') as b, open('bs.pkl',
-                                            'rb') as c:
-    rt_idx = pickle.load(a)
-    rt_bs = pickle.load(b)
-    bs = pickle.load(c)
+dataset_files = _dataset_files()
+start = time.perf_counter()
+network = graph.load()
+load_time = time.perf_counter() - start
+
+class NoRouteError(Exception):
+    pass
+
+class SearchStats:
+    """
+    Counters and timings of the searches of one query
+
+    popped counts labels taken off the frontier, expanded the stops settled
+    among them, relaxed the edges tried towards unsettled stops and
+    heuristic the stops whose distance to the goal was looked up.
+    frontier_max is the largest the frontier grew. Timings are in seconds,
+    load is how long the router's graph took to load.
+    """
+    __slots__ = ('popped', 'expanded', 'relaxed', 'frontier_max',
+                 'heuristic', 'load_time', 'heuristic_time', 'search_time',
+                 'postprocess_time')
+
+    def __init__(self):
+        self.popped = 0
+        self.expanded = 0
+        self.relaxed = 0
+        self.frontier_max = 0
+        self.heuristic = 0
+        self.load_time = 0.0
+        self.heuristic_time = 0.0
+        self.search_time = 0.0
+        self.postprocess_time = 0.0
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return ('{} popped | {} expanded | {} relaxed | {} frontier max | '
+                '{} heuristic\n'
+                'load {:.2f}ms | heuristic {:.2f}ms | search {:.2f}ms | '
+                'postprocess {:.2f}ms').format(
+                    self.popped, self.expanded, self.relaxed,
+                    self.frontier_max, self.heuristic,
+                    self.load_time * 1000, self.heuristic_time * 1000,
+                    self.search_time * 1000, self.postprocess_time * 1000)
+
+class SearchContext:
+    """
+    State of a single query, shared by the nodes and edges of its search
+
+    to_goal holds the distance of every stop to the goal, all zeros without
+    a goal. from_origin maps origin stops to their distance from the origin
+    coordinates, it is None when searching from the origin stops themselves.
+    Footpaths cost walk_weight per km. stats accumulates over the searches
+    in this context.
+    """
+
+    def __init__(self, network, goal=None, from_origin=None,
+                 transfer_penalty=TRANSFER_PENALTY, walk_weight=WALK_WEIGHT):
+        start = time.perf_counter()
+        self.network = network
+        if goal is None:
+            self.to_goal = [0.0] * network.num_stops
+        else:
+            goal_lat, goal_lon = goal
+            self.to_goal = geo.distances(goal_lat, goal_lon,
+                                         network.latitudes,
+                                         network.longitudes).tolist()
+        self.from_origin = from_origin
+        self.transfer_penalty = transfer_penalty
+        self.walk_weight = walk_weight
+        self.stats = SearchStats()
+        self.stats.heuristic_time = time.perf_counter() - start
 
 @total_ordering
 class Node:
+    """
+    Best label found for a stop
+
+    The route is kept as a pointer to the edge it arrives by, whose source
+    node points to the edge before it, and is only materialized on request.
+    """
+    __slots__ = ('context', 'stop', 'h_dist', 'best_dist', 'best_cost',
+                 'best_metric', 'edge', 'hops', 'last_transfer_index',
+                 '_best_route')
 
-    def __init__(self, bus_stop_code, best_cost=math.inf, best_dist=math.inf,
-                 last_transfer_index=-1):
-        self.bus_stop_code = bus_stop_code
-        self.bus_stop = bs[self.bus_stop_code]
-        self.h_dist = bs[self.bus_stop_code][TO_GOAL_KEY]
+    def __init__(self, context, stop, best_cost=math.inf, best_dist=math.inf,
+                 last_transfer_index=-1, edge=None):
+        self.context = context
+        self.stop = stop
+        self.h_dist = context.to_goal[stop]
         self.best_dist = best_dist
         self.best_cost = best_cost
         self.best_metric = self.best_cost + self.h_dist
-        self.best_route = []
+        self.edge = edge
+        self.hops = edge.source.hops + 1 if edge is not None else 0
         self.last_transfer_index = last_transfer_index
-        self.services = rt_bs[self.bus_stop_code]
+        self._best_route = None
+
+    @property
+    def best_route(self):
+        if self._best_route is not None:
+            return self._best_route
+        route = []
+        edge = self.edge
+        while edge is not None:
+            route.append(edge)
+            edge = edge.source.edge
+        route.reverse()
+        return route
+
+    @best_route.setter
+    def best_route(self, route):
+        self._best_route = route
+
+    @property
+    def bus_stop_code(self):
+        return self.context.network.stop_codes[self.stop]
+
+    @property
+    def stats(self):
+        return self.context.stats
+
+    @property
+    def transfers(self):
+        return sum(edge.has_transferred for edge in self.best_route)
 
     def __lt__(self, other):
         return self.best_metric < other.best_metric
@@ -60,20 +201,34 @@ class Node:
 
 
 class Edge:
-    def __init__(self, source, services, dest, distance):
+    """
+    Ride between consecutive stops, or a walk along a footpath
+
+    Walks run no services and any service may be boarded after them. A walk
+    after a ride is the transfer, so its label already carries the penalty.
+    """
+    __slots__ = ('source', 'dest', 'has_transferred', 'distance', 'services',
+                 '_services', 'cost', 'walk')
+
+    def __init__(self, source, services, dest, distance, walk=False):
         self.source = source
         self.dest = dest
         self.has_transferred = False
         self.distance = distance
         self.services = services
+        self.walk = walk
         self._services = self.get_best_route_common_services(services) # For routing algorithm
         self.cost = self.calculate_cost()
-        self.update_dest_distance_cost_route()
 
     def get_best_route_common_services(self, services):
-        if not self.source.best_route:
+        last_edge = self.source.edge
+        if self.walk:
+            if last_edge is not None and last_edge._services != -1:
+                self.has_transferred = True
+            return -1
+        if last_edge is None:
             return services
-        common_services = services & self.source.best_route[-1]._services
+        common_services = services & last_edge._services
         if not common_services:
             self.has_transferred = True
             return services
@@ -81,10 +236,12 @@ class Edge:
 
     def calculate_cost(self):
         cost = self.distance
+        if self.walk:
+            cost *= self.source.context.walk_weight
         # if self.distance:
         #     cost += 1/self.distance
         if self.has_transferred:
-            cost += TRANSFER_PENALTY
+            cost += self.source.context.transfer_penalty
 
         if cost < 0:
             print('ERROR: Negative edge cost')
@@ -94,123 +251,1093 @@ class Edge:
         return cost
 
     def update_dest_distance_cost_route(self):
+        # Returns a new label for dest if this edge improves on it, else None
         new_dist = self.source.best_dist + self.distance
         new_cost = self.source.best_cost + self.cost
         new_metric = new_cost + self.dest.h_dist
         if new_metric < self.dest.best_metric:
-            self.dest.best_cost = new_cost
-            self.dest.best_dist = new_dist
-            self.dest.best_metric = new_metric
-            self.dest.best_route = self.source.best_route + [self]
             if self.has_transferred:
-                self.dest.last_transfer_index = len(self.dest.best_route) - 1
+                last_transfer_index = self.source.hops
             else:
-                self.dest.last_transfer_index = self.source.last_transfer_index
+                last_transfer_index = self.source.last_transfer_index
+            self.dest = Node(self.dest.context, self.dest.stop, new_cost,
+                             new_dist, last_transfer_index, self)
+            return self.dest
+        return None
 
     def __repr__(self):
+        services = self.services
+        # Services are bitmasks during the search
+        if self.walk:
+            services = 'walk'
+        elif isinstance(services, int):
+            services = self.source.context.network.decode_services(services)
         return '< {} --> {} > {:>1s} {:>4.1f} | {:>4.1f}km | {}'.format(
             self.source.bus_stop_code, self.dest.bus_stop_code,
             '*' if self.has_transferred else '', self.cost,
-            self.distance, self.services)
+            self.distance, services)
 
 
-def precalculate_distances(lat, lon, dest_key):
-    for bus_stop_code, bus_stop_data in bs.items():
-        stop_lon, stop_lat = bus_stop_data[
-            'Longitude'], bus_stop_data['Latitude']
-        bs[bus_stop_code][dest_key] = geo.distance(
-            lat, lon, stop_lat, stop_lon)
+class Router:
+    """
+    Routes queries against a shared, read-only graph
 
-def discover_next_stops(node):
-    next_stops = defaultdict(lambda: defaultdict(set))
-    # Discover next stop of each service
-    for idx, current_service_stop in node.services.items():
-        try:
-            next_service_stop = rt_idx[idx + 1]
-        except KeyError:
-            print('INFO: Reached end of dataframe')
-            continue
-        if next_service_stop[
-            'StopSequence'] == current_service_stop['StopSequence'] + 1:
-            next_service_stop_code = next_service_stop['BusStopCode']
-            next_stops[next_service_stop_code]['services'].add(
-                next_service_stop['ServiceNo'])
-            next_stops[
-                next_service_stop_code]['distance'] = next_service_stop[
-                    'Distance'] - current_service_stop['Distance']
-    return next_stops
-
-def find_nearby_stops(bs_dict, dist_key, radius):
-    nearby_stops = []
-    for bus_stop_code, bus_stop_data in bs_dict.items():
-        if bus_stop_data[dist_key] <= radius:
-            nearby_stops.append(bus_stop_code)
-    return nearby_stops
-
-def dijkstra(origin_codes, goal_codes):
-    traversal_queue = []
-    nodes = {}
-    optimal_nodes = set()
-
-    # Initialize origin nodes
-    for origin_code in origin_codes:
-        origin = Node(
-            origin_code, bs[origin_code].get(FROM_ORIGIN_KEY, 0),
-            bs[origin_code].get(FROM_ORIGIN_KEY, 0), 0)
-        traversal_queue.append(origin)
-
-    # Dijkstra iterations
-    while traversal_queue:
-        current_node = heapq.heappop(traversal_queue)
-        nodes[current_node.bus_stop_code] = current_node
-        optimal_nodes.add(current_node.bus_stop_code)
-
-        logging.info(current_node)
-
-        next_service_stops = discover_next_stops(current_node)
-
-        # Create next nodes
-        for (next_bus_stop_code,
-             next_bus_stop_info) in next_service_stops.items():
-            # Already optimal, ignore
-            if next_bus_stop_code in optimal_nodes:
+    All per-query state lives in a SearchContext and the search's own locals,
+    so one Router can serve many threads without locking. Codes queries may
+    opt into the transfer pattern table, and their costs alone are read from
+    the cost matrix, when these were built for their transfer penalty.
+    """
+
+    def __init__(self, network, transfer_patterns=None, load_time=0.0,
+                 walk_weight=WALK_WEIGHT, cost_matrix=None):
+        self.network = network
+        self.patterns = transfer_patterns
+        self.load_time = load_time
+        self.walk_weight = walk_weight
+        self.cost_matrix = cost_matrix
+
+    def context(self, goal=None, from_origin=None,
+                transfer_penalty=TRANSFER_PENALTY):
+        context = SearchContext(self.network, goal, from_origin,
+                                transfer_penalty, self.walk_weight)
+        context.stats.load_time = self.load_time
+        return context
+
+    def route_coords(self, origin, goal, radius=NEARBY_STOPS_RADIUS,
+                     transfer_penalty=TRANSFER_PENALTY, bidirectional=False):
+        # Route between stops within radius of the origin and goal coordinates
+        origin_lat, origin_lon = origin
+        goal_lat, goal_lon = goal
+        from_origin = self.network.stops_within(origin_lat, origin_lon, radius)
+        goals = self.network.stops_within(goal_lat, goal_lon, radius)
+        context = self.context(goal, from_origin, transfer_penalty)
+        stop_codes = self.network.stop_codes
+        origin_codes = [stop_codes[stop] for stop in from_origin]
+        if bidirectional:
+            self.check_rides_only('The bidirectional search')
+            search = self.bidirectional
+        else:
+            search = self.dijkstra
+        return search(context, origin_codes,
+                      {stop_codes[stop] for stop in goals})
+
+    def check_rides_only(self, engine):
+        # Engines riding buses alone cannot answer on a graph with footpaths
+        if self.network.num_footpaths:
+            raise ValueError(
+                '{} does not walk, build the graph without footpaths with '
+                'to-pickle.py -w 0'.format(engine))
+
+    def matches_matrix(self, transfer_penalty):
+        # Whether the cost matrix answers cost queries at transfer_penalty
+        cost_matrix = self.cost_matrix
+        return cost_matrix is not None and \
+            cost_matrix.transfer_penalty == transfer_penalty and \
+            cost_matrix.walk_weight == self.walk_weight
+
+    def check_codes(self, bus_stop_codes):
+        for bus_stop_code in bus_stop_codes:
+            if bus_stop_code not in self.network.stop_index:
+                raise NoRouteError('Unknown bus stop code {}'.format(
+                    bus_stop_code))
+
+    def route_codes(self, origin_codes, goal_code,
+                    transfer_penalty=TRANSFER_PENALTY, bidirectional=False,
+                    use_patterns=False):
+        # use_patterns follows the transfer pattern table, which must have
+        # been built for the transfer penalty. Its routes are exact in the
+        # (stop, service) states so may cost less than the search's. The
+        # bidirectional search and the table raise ValueError on graphs with
+        # footpaths
+        self.check_codes([goal_code] + list(origin_codes))
+        context = self.context(self.network.coordinates(goal_code),
+                               transfer_penalty=transfer_penalty)
+        if bidirectional:
+            self.check_rides_only('The bidirectional search')
+            return self.bidirectional(context, origin_codes, {goal_code})
+        if use_patterns:
+            self.check_rides_only('Transfer patterns')
+            if self.patterns is None or \
+                    self.patterns.transfer_penalty != transfer_penalty:
+                raise ValueError(
+                    'No transfer patterns for transfer penalty {}, run '
+                    'patterns.py build -t {}'.format(transfer_penalty,
+                                                     transfer_penalty))
+            goal = self.network.stop_index[goal_code]
+            solutions = []
+            for code in origin_codes:
+                stops = self.patterns.stops(
+                    self.network, self.network.stop_index[code], goal)
+                if stops is not None:
+                    solutions.append(self.replay(context, stops))
+            if not solutions:
+                raise NoRouteError('No route from {} to {}'.format(
+                    ', '.join(origin_codes), goal_code))
+            return min(solutions, key=lambda solution: solution.best_cost)
+        return self.dijkstra(context, origin_codes, {goal_code})
+
+    def cost_codes(self, origin_codes, goal_code,
+                   transfer_penalty=TRANSFER_PENALTY):
+        """
+        Return (cost, transfers) of the cheapest route from the origin stops
+        to the goal stop
+
+        Read from the cost matrix when it matches the transfer penalty and
+        walk weight, else the route is searched for as the matrix was.
+        expand_codes() expands the route itself.
+        """
+        self.check_codes([goal_code] + list(origin_codes))
+        if self.matches_matrix(transfer_penalty):
+            stop_index = self.network.stop_index
+            result = self.cost_matrix.lookup(
+                [stop_index[origin_code] for origin_code in origin_codes],
+                stop_index[goal_code])
+            if result is None:
+                raise NoRouteError('No route from {} to {}'.format(
+                    ', '.join(origin_codes), goal_code))
+            return result
+        solution = self.expand_codes(origin_codes, goal_code,
+                                     transfer_penalty)
+        return solution.best_cost, solution.transfers
+
+    def expand_codes(self, origin_codes, goal_code,
+                     transfer_penalty=TRANSFER_PENALTY):
+        """
+        Route from the origin stops to the goal stop with the search the cost
+        matrix is built with, without a heuristic, so its cost and transfers
+        are those of cost_codes()
+        """
+        self.check_codes([goal_code] + list(origin_codes))
+        return self.dijkstra(self.context(transfer_penalty=transfer_penalty),
+                             origin_codes, {goal_code})
+
+    def frontier_coords(self, origin, goal, radius=NEARBY_STOPS_RADIUS,
+                        transfer_penalty=TRANSFER_PENALTY,
+                        max_transfers=MAX_TRANSFERS):
+        # Pareto optimal routes between stops within radius of the origin
+        # and goal coordinates
+        origin_lat, origin_lon = origin
+        goal_lat, goal_lon = goal
+        from_origin = self.network.stops_within(origin_lat, origin_lon, radius)
+        goals = self.network.stops_within(goal_lat, goal_lon, radius)
+        context = self.context(goal, from_origin, transfer_penalty)
+        stop_codes = self.network.stop_codes
+        return self.pareto(context, [stop_codes[stop] for stop in from_origin],
+                           {stop_codes[stop] for stop in goals},
+                           max_transfers)
+
+    def frontier_codes(self, origin_codes, goal_code,
+                       transfer_penalty=TRANSFER_PENALTY,
+                       max_transfers=MAX_TRANSFERS):
+        self.check_codes([goal_code] + list(origin_codes))
+        context = self.context(self.network.coordinates(goal_code),
+                               transfer_penalty=transfer_penalty)
+        return self.pareto(context, origin_codes, {goal_code}, max_transfers)
+
+    def isochrone_coords(self, origin, radius=NEARBY_STOPS_RADIUS,
+                         transfer_penalty=TRANSFER_PENALTY,
+                         max_cost=math.inf):
+        # Reach of every stop from the stops within radius of the origin
+        origin_lat, origin_lon = origin
+        from_origin = self.network.stops_within(origin_lat, origin_lon, radius)
+        context = self.context(from_origin=from_origin,
+                               transfer_penalty=transfer_penalty)
+        stop_codes = self.network.stop_codes
+        return self.isochrone(context,
+                              [stop_codes[stop] for stop in from_origin],
+                              max_cost)
+
+    def isochrone_codes(self, origin_codes, transfer_penalty=TRANSFER_PENALTY,
+                        max_cost=math.inf):
+        self.check_codes(origin_codes)
+        return self.isochrone(self.context(transfer_penalty=transfer_penalty),
+                              origin_codes, max_cost)
+
+    def isochrone(self, context, origin_codes, max_cost=math.inf,
+                  reverse=False, goals=(), max_detour=0.0):
+        """
+        Cost, distance and transfers of the route to every stop costing at
+        most max_cost, with the stop before it on that route
+
+        Runs the search of route.py to exhaustion over flat lists instead of
+        nodes and edges, so without a goal in the context the costs match
+        route_many's without building any route. With one, stops are left
+        unreached once their cost plus distance to the goal exceeds max_cost.
+        Parents lead back to an origin, walks included. With reverse the
+        search runs against the edges, giving the routes from every stop to
+        the origins and the stop after each stop on them. Once the first of
+        the goal stops is settled, max_cost is lowered to 1 + max_detour
+        times its cost.
+        """
+        network = self.network
+        stats = context.stats
+        start = time.perf_counter()
+        transfer_penalty = context.transfer_penalty
+        walk_weight = context.walk_weight
+        from_origin = context.from_origin
+        to_goal = context.to_goal
+        arcs = network.predecessors if reverse else network.successors
+        num_stops = network.num_stops
+        costs = [math.inf] * num_stops
+        dists = [math.inf] * num_stops
+        transfers = [-1] * num_stops
+        parents = [-1] * num_stops
+        # Services common to the ride into each stop, -1 for any service
+        # after an origin or a walk
+        arrived = [-1] * num_stops
+        walked = bytearray(num_stops)
+        settled = bytearray(num_stops)
+        queue = []
+        tie_breaker = count()
+        popped = expanded = relaxed = 0
+
+        for origin_code in origin_codes:
+            stop = network.stop_index[origin_code]
+            origin_dist = from_origin[stop] if from_origin is not None else 0
+            if costs[stop] <= origin_dist:
+                continue
+            costs[stop] = dists[stop] = origin_dist
+            transfers[stop] = 0
+            heapq.heappush(queue, (origin_dist + to_goal[stop],
+                                   next(tie_breaker), origin_dist, stop))
+        frontier_max = max(stats.frontier_max, len(queue))
+
+        while queue:
+            metric, _, cost, stop = heapq.heappop(queue)
+            popped += 1
+            if settled[stop] or cost > costs[stop]:
+                continue
+            if metric > max_cost:
+                break
+            settled[stop] = 1
+            expanded += 1
+            if stop in goals:
+                max_cost = min(max_cost, cost * (1 + max_detour))
+                goals = ()
+            dist = dists[stop]
+            services = arrived[stop]
+            transferred = transfers[stop] + 1
+
+            for next_stop, distance, edge_services in arcs(stop):
+                if settled[next_stop]:
+                    continue
+                relaxed += 1
+                common = edge_services & services
+                if common:
+                    next_cost = cost + distance
+                    next_transfers = transferred - 1
+                else:
+                    common = edge_services
+                    next_cost = cost + (distance + transfer_penalty)
+                    next_transfers = transferred
+                next_metric = next_cost + to_goal[next_stop]
+                if next_cost < costs[next_stop] and next_metric <= max_cost:
+                    costs[next_stop] = next_cost
+                    dists[next_stop] = dist + distance
+                    transfers[next_stop] = next_transfers
+                    parents[next_stop] = stop
+                    arrived[next_stop] = common
+                    walked[next_stop] = 0
+                    heapq.heappush(queue, (next_metric, next(tie_breaker),
+                                           next_cost, next_stop))
+
+            # Walks are not chained, and after a ride they are the transfer
+            if walked[stop]:
                 continue
+            for next_stop, distance in network.footpaths(stop):
+                if settled[next_stop]:
+                    continue
+                relaxed += 1
+                next_cost = distance * walk_weight
+                next_transfers = transferred - 1
+                if services != -1:
+                    next_cost += transfer_penalty
+                    next_transfers = transferred
+                next_cost = cost + next_cost
+                next_metric = next_cost + to_goal[next_stop]
+                if next_cost < costs[next_stop] and next_metric <= max_cost:
+                    costs[next_stop] = next_cost
+                    dists[next_stop] = dist + distance
+                    transfers[next_stop] = next_transfers
+                    parents[next_stop] = stop
+                    arrived[next_stop] = -1
+                    walked[next_stop] = 1
+                    heapq.heappush(queue, (next_metric, next(tie_breaker),
+                                           next_cost, next_stop))
+            if len(queue) > frontier_max:
+                frontier_max = len(queue)
 
-            # Check if node already exists
-            if next_bus_stop_code in nodes:
-                next_node = nodes[next_bus_stop_code]
+        stats.popped += popped
+        stats.expanded += expanded
+        stats.relaxed += relaxed
+        stats.frontier_max = frontier_max
+        # Stops left in the queue beyond a lowered max_cost are unreached
+        unreached = np.frombuffer(settled, dtype=np.uint8) == 0
+        isochrone = Isochrone(np.array(costs), np.array(dists),
+                              np.array(transfers, dtype=np.int32),
+                              np.array(parents, dtype=np.int32), stats)
+        isochrone.cost[unreached] = math.inf
+        isochrone.distance[unreached] = math.inf
+        isochrone.transfers[unreached] = -1
+        isochrone.parent[unreached] = -1
+        stats.search_time += time.perf_counter() - start
+        return isochrone
+
+    def alternatives_coords(self, origin, goal, radius=NEARBY_STOPS_RADIUS,
+                            transfer_penalty=TRANSFER_PENALTY,
+                            k=ALTERNATIVES, max_detour=MAX_DETOUR,
+                            max_overlap=MAX_OVERLAP):
+        # Alternative routes between stops within radius of the origin and
+        # goal coordinates
+        origin_lat, origin_lon = origin
+        goal_lat, goal_lon = goal
+        from_origin = self.network.stops_within(origin_lat, origin_lon, radius)
+        goals = self.network.stops_within(goal_lat, goal_lon, radius)
+        context = self.context(goal, from_origin, transfer_penalty)
+        stop_codes = self.network.stop_codes
+        return self.alternatives(
+            context, [stop_codes[stop] for stop in from_origin],
+            {stop_codes[stop] for stop in goals}, k, max_detour, max_overlap)
+
+    def alternatives_codes(self, origin_codes, goal_code,
+                           transfer_penalty=TRANSFER_PENALTY, k=ALTERNATIVES,
+                           max_detour=MAX_DETOUR, max_overlap=MAX_OVERLAP):
+        self.check_codes([goal_code] + list(origin_codes))
+        context = self.context(self.network.coordinates(goal_code),
+                               transfer_penalty=transfer_penalty)
+        return self.alternatives(context, origin_codes, {goal_code}, k,
+                                 max_detour, max_overlap)
+
+    def alternatives(self, context, origin_codes, goal_codes, k=ALTERNATIVES,
+                     max_detour=MAX_DETOUR, max_overlap=MAX_OVERLAP):
+        """
+        Up to k routes from the origins to the goals, cheapest first, each
+        costing at most 1 + max_detour times the cheapest and sharing at most
+        max_overlap of its distance with every cheaper one
+
+        Via edge alternatives: one isochrone from the origins and one against
+        the edges from the goals, both bounded by the detour, give every edge
+        a route through it, along the first search tree to the edge and the
+        second one after it. These are tried in order of their cost without
+        transfers at the edge, after the first tree's own route to the best
+        goal, and replayed to place their transfers as the search would.
+        """
+        network = self.network
+        goals = {network.stop_index[goal_code] for goal_code in goal_codes}
+        forward = self.isochrone(context, origin_codes, goals=goals,
+                                 max_detour=max_detour)
+        best = min(forward.cost[list(goals)].tolist(), default=math.inf)
+        if best == math.inf:
+            raise NoRouteError('No route from {} to {}'.format(
+                ', '.join(origin_codes), ', '.join(sorted(goal_codes))))
+        max_cost = best * (1 + max_detour)
+        backward_context = SearchContext(
+            network, transfer_penalty=context.transfer_penalty,
+            walk_weight=context.walk_weight)
+        backward_context.stats = context.stats
+        # Searched towards the nearest origin stop
+        origins = [network.stop_index[origin_code]
+                   for origin_code in origin_codes]
+        backward_context.to_goal = geo.distance_matrix(
+            network.latitudes[origins], network.longitudes[origins],
+            network.latitudes, network.longitudes).min(axis=0).tolist()
+        backward = self.isochrone(backward_context, goal_codes, max_cost,
+                                  reverse=True)
+
+        start = time.perf_counter()
+        tails = np.repeat(np.arange(network.num_stops),
+                          np.diff(network.indptr))
+        via_costs = forward.cost[tails] + network.distances + \
+            backward.cost[network.indices]
+        vias = np.flatnonzero(via_costs <= max_cost)
+        vias = vias[np.argsort(via_costs[vias], kind='stable')]
+        vias = zip(tails[vias].tolist(), network.indices[vias].tolist(),
+                   network.distances[vias].tolist())
+        # The cheapest route comes first, it is not through any via edge
+        best_goal = min(goals, key=lambda goal: forward.cost[goal])
+        routes = chain([(best_goal, None, None)], vias)
+        parents = forward.parent.tolist()
+        children = backward.parent.tolist()
+        distances = forward.distance.tolist()
+        to_goal = backward.distance.tolist()
+        context.stats.postprocess_time += time.perf_counter() - start
+
+        solutions = []
+        kept = []
+        seen = set()
+        for tail, head, via_distance in routes:
+            start = time.perf_counter()
+            stops = [tail]
+            while parents[stops[-1]] != -1:
+                stops.append(parents[stops[-1]])
+            stops.reverse()
+            if head is not None:
+                stops.append(head)
+                while children[stops[-1]] != -1:
+                    stops.append(children[stops[-1]])
+            key = tuple(stops)
+            if key in seen or len(set(stops)) < len(stops):
+                continue
+            seen.add(key)
+
+            # Distance of each hop, from the search tree it belongs to
+            hops = {}
+            for stop, next_stop in zip(stops, stops[1:]):
+                if parents[next_stop] == stop:
+                    hops[stop, next_stop] = distances[next_stop] - \
+                        distances[stop]
+                elif children[stop] == next_stop:
+                    hops[stop, next_stop] = to_goal[stop] - to_goal[next_stop]
+                else:
+                    hops[stop, next_stop] = via_distance
+            distance = sum(hops.values())
+            context.stats.postprocess_time += time.perf_counter() - start
+            if any(sum(hop_distance for hop, hop_distance in hops.items()
+                       if hop in other) > max_overlap * distance
+                   for other in kept):
+                continue
+
+            solution = self.replay(context, stops)
+            if solution.best_cost > max_cost:
+                continue
+            solutions.append(solution)
+            kept.append(hops)
+            if len(solutions) == k:
+                break
+        solutions.sort(key=lambda solution: solution.best_cost)
+        return solutions
+
+    def replay(self, context, stops):
+        # Route along a known sequence of stops, transfers are placed as the
+        # search would place them
+        return self.finish(self.follow(context, stops))
+
+    def follow(self, context, stops, walked=None):
+        # Replay the stops into a route, walked[i] tells whether stops[i] is
+        # reached on foot, otherwise by bus where a service runs
+        start = time.perf_counter()
+        from_origin = context.from_origin
+        origin_dist = from_origin[stops[0]] if from_origin is not None else 0
+        node = Node(context, stops[0], origin_dist, origin_dist, 0)
+        if walked is None:
+            walked = [False] * len(stops)
+        for stop, next_stop, walk in zip(stops, stops[1:], walked[1:]):
+            for successor, distance, services in self.network.successors(
+                    stop):
+                if successor == next_stop and not walk:
+                    edge = Edge(node, services, Node(context, next_stop),
+                                distance)
+                    break
             else:
-                next_node = Node(next_bus_stop_code)
-                nodes[next_bus_stop_code] = next_node
-                traversal_queue.append(next_node)
+                # No ride between the stops, walked along a footpath
+                distance = dict(self.network.footpaths(stop))[next_stop]
+                edge = Edge(node, 0, Node(context, next_stop), distance, True)
+            node = edge.update_dest_distance_cost_route()
+        context.stats.search_time += time.perf_counter() - start
+        return node
 
-            logging.debug(' ++{}'.format(next_node))
+    def route_many(self, origin_codes, goal_codes,
+                   transfer_penalty=TRANSFER_PENALTY):
+        """
+        Route from the origin stops to each of the goal stops in one search
 
-            # Create edge and relax
-            edge = Edge(current_node, next_bus_stop_info['services'],
-                        next_node, next_bus_stop_info['distance'])
+        Yields (goal code, solution) as each goal is settled and stops once
+        all are, unreachable goals are left out. With more than one goal the
+        search runs without a heuristic, as a one-to-all search would.
+        """
+        goal_codes = list(goal_codes)
+        self.check_codes(list(origin_codes) + goal_codes)
+        goal = None
+        if len(goal_codes) == 1:
+            goal = self.network.coordinates(goal_codes[0])
+        context = self.context(goal, transfer_penalty=transfer_penalty)
+        goals = {self.network.stop_index[goal_code]
+                 for goal_code in goal_codes}
+        for node in self.search(context, origin_codes, goals):
+            goals.discard(node.stop)
+            yield node.bus_stop_code, self.finish(node)
+            if not goals:
+                return
 
-            logging.debug(' -{}'.format(edge))
+    def dijkstra(self, context, origin_codes, goal_codes):
+        goals = {self.network.stop_index[goal_code]
+                 for goal_code in goal_codes}
+        for node in self.search(context, origin_codes, goals):
+            return self.finish(node)
+        raise NoRouteError('No route from {} to {}'.format(
+            ', '.join(origin_codes), ', '.join(sorted(goal_codes))))
 
-        # Store optimal route found for bus stop (Service agnostic)
-        if current_node.bus_stop_code in goal_codes:
-            break
+    def bidirectional(self, context, origin_codes, goal_codes):
+        """
+        Route with a bidirectional A* over the (stop, service) state graph
 
-        # TODO: Could do with a little optimization, currently O(hn)
-        # h = len(heapq), n = len(rt)
-        # Maintain heap property in event node best cost has changed
-        heapq.heapify(traversal_queue)
+        Both directions are keyed on the average of the distances to the
+        goal and from the origins, so they stop together as soon as the two
+        smallest keys add up to the cheapest meeting found. A route boards
+        one more time than it transfers, so its cost is one transfer penalty
+        above the cost of route.py. The stops of the route are replayed into
+        a solution.
+        """
+        network = self.network
+        states = network.states
+        stats = context.stats
+        start = time.perf_counter()
+        num_stops = network.num_stops
+        node_stops = states.node_stops
+        stop_states = states.stop_states
+        penalty = context.transfer_penalty
+        origins = [network.stop_index[code] for code in origin_codes]
+        goals = [network.stop_index[code] for code in goal_codes]
+        from_origin = context.from_origin
+        if not origins or not goals:
+            raise NoRouteError('No route from {} to {}'.format(
+                ', '.join(origin_codes), ', '.join(sorted(goal_codes))))
 
+        # Average potentials keep arc costs non-negative in both directions
+        from_origins = np.min([geo.distances(
+            network.latitudes[origin], network.longitudes[origin],
+            network.latitudes, network.longitudes) for origin in origins],
+            axis=0).tolist()
+        potentials = [(to_goal - from_origin_dist) / 2 for to_goal,
+                      from_origin_dist in zip(context.to_goal, from_origins)]
 
-    # postprocess.latest_transfer(current_node.best_route)
-    # postprocess.earliest_transfer(current_node.best_route)
-    postprocess.permissive_route(current_node.best_route)
-    return current_node
+        num_nodes = states.num_nodes
+        forward = [[math.inf] * num_nodes, [None] * num_nodes, []]
+        backward = [[math.inf] * num_nodes, [None] * num_nodes, []]
+        for origin in origins:
+            dist = from_origin[origin] if from_origin is not None else 0.0
+            if dist < forward[0][origin]:
+                forward[0][origin] = dist
+                heapq.heappush(forward[2],
+                               (dist + potentials[origin], dist, origin))
+        for goal in goals:
+            backward[0][goal] = 0.0
+            heapq.heappush(backward[2], (-potentials[goal], 0.0, goal))
+        best, meeting = math.inf, None
+        for goal in goals:
+            if forward[0][goal] < best:
+                best, meeting = forward[0][goal], goal
 
-def main():
-    global TRANSFER_PENALTY
-    global NEARBY_STOPS_RADIUS
+        popped = expanded = relaxed = 0
+        heuristic = len(forward[2]) + len(backward[2])
+        frontier_max = stats.frontier_max
+        while forward[2] and backward[2]:
+            if forward[2][0][0] + backward[2][0][0] >= best:
+                break
+            # Grow the smaller frontier
+            is_forward = len(forward[2]) <= len(backward[2])
+            dists, parents, queue = forward if is_forward else backward
+            other_dists = (backward if is_forward else forward)[0]
+            sign = 1 if is_forward else -1
+            _, dist, node = heapq.heappop(queue)
+            popped += 1
+            if dist > dists[node]:
+                continue
+            expanded += 1
 
+            if node < num_stops:
+                # Board, or reversed, arrive by alighting
+                arcs = [(state, penalty if is_forward else 0.0)
+                        for state in stop_states[node]]
+            elif is_forward:
+                arcs = states.rides[node - num_stops] + [
+                    (node_stops[node], 0.0)]
+            else:
+                arcs = states.reverse_rides[node - num_stops] + [
+                    (node_stops[node], penalty)]
+            for next_node, cost in arcs:
+                relaxed += 1
+                next_dist = dist + cost
+                if next_dist >= dists[next_node]:
+                    continue
+                dists[next_node] = next_dist
+                parents[next_node] = node
+                heuristic += 1
+                heapq.heappush(queue, (
+                    next_dist + sign * potentials[node_stops[next_node]],
+                    next_dist, next_node))
+                if next_dist + other_dists[next_node] < best:
+                    best = next_dist + other_dists[next_node]
+                    meeting = next_node
+            frontier_max = max(frontier_max,
+                               len(forward[2]) + len(backward[2]))
+
+        stats.popped += popped
+        stats.expanded += expanded
+        stats.relaxed += relaxed
+        stats.heuristic += heuristic
+        stats.frontier_max = frontier_max
+        stats.search_time += time.perf_counter() - start
+        if meeting is None:
+            raise NoRouteError('No route from {} to {}'.format(
+                ', '.join(origin_codes), ', '.join(sorted(goal_codes))))
+
+        # Stops along both halves of the route through the meeting node
+        path = [meeting]
+        while forward[1][path[-1]] is not None:
+            path.append(forward[1][path[-1]])
+        path.reverse()
+        while backward[1][path[-1]] is not None:
+            path.append(backward[1][path[-1]])
+        stops = [node_stops[path[0]]]
+        for node in path[1:]:
+            if node_stops[node] != stops[-1]:
+                stops.append(node_stops[node])
+        return self.replay(context, stops)
+
+    def pareto(self, context, origin_codes, goal_codes,
+               max_transfers=MAX_TRANSFERS):
+        """
+        Route with a multi-criteria A* keeping every (distance, transfers)
+        Pareto optimal route to the goals
+
+        Labels carry the services common to the current leg, and transfer
+        only when none of them runs along the next edge, as Edge does. A
+        label is dominated by one settled earlier at its stop with fewer
+        transfers, or as many and a superset of its services. Returns the
+        solutions from fewest to most transfers, each with the services
+        running its whole leg. The cheapest one for any transfer penalty is
+        among them.
+
+        Footpaths are walked as in the search: not twice in a row, any
+        service may be boarded after them and after a ride they are the
+        transfer. Their distance counts walk_weight times.
+        """
+        network = self.network
+        stats = context.stats
+        start = time.perf_counter()
+        walk_weight = context.walk_weight
+        to_goal = context.to_goal
+        from_origin = context.from_origin
+        goals = {network.stop_index[goal_code] for goal_code in goal_codes}
+
+        # Labels are (distance, transfers, stop, services, parent label),
+        # queued on the distance plus the distance to the goal
+        queue = []
+        tie_breaker = count()
+        for origin_code in origin_codes:
+            stop = network.stop_index[origin_code]
+            dist = from_origin[stop] if from_origin is not None else 0.0
+            # Not yet boarded, every service is common to the first edge
+            heapq.heappush(queue, (dist + to_goal[stop], next(tie_breaker),
+                                   (dist, 0, stop, -1, None)))
+        settled_transfers = [math.inf] * network.num_stops
+        settled_services = [None] * network.num_stops
+        settled_walks = [math.inf] * network.num_stops
+        goal_transfers = max_transfers + 1
+        frontier = []
+        popped = expanded = relaxed = 0
+        frontier_max = len(queue)
+
+        while queue:
+            _, _, label = heapq.heappop(queue)
+            dist, transfers, stop, services, parent = label
+            popped += 1
+            # Settled goals have no more distance, so fewer transfers only
+            if transfers >= goal_transfers:
+                continue
+            walked = services == -1 and parent is not None
+            if walked:
+                # Walking labels board any service but may not walk again,
+                # riding labels dominate them with fewer transfers only and
+                # are never dominated by them
+                if transfers >= settled_walks[stop] or \
+                        transfers > settled_transfers[stop] or \
+                        transfers == settled_transfers[stop] and \
+                        -1 in settled_services[stop]:
+                    continue
+                settled_walks[stop] = transfers
+            elif transfers > settled_transfers[stop]:
+                continue
+            elif transfers == settled_transfers[stop]:
+                if any(services | settled == settled for settled in
+                       settled_services[stop]):
+                    continue
+                settled_services[stop].append(services)
+            else:
+                settled_transfers[stop] = transfers
+                settled_services[stop] = [services]
+            expanded += 1
+
+            if stop in goals:
+                frontier.append(label)
+                goal_transfers = transfers
+                if transfers == 0:
+                    break
+                continue
+
+            for next_stop, distance, edge_services in network.successors(
+                    stop):
+                next_services = services & edge_services
+                next_transfers = transfers
+                if not next_services:
+                    next_services = edge_services
+                    next_transfers += 1
+                if next_transfers >= goal_transfers or \
+                        next_transfers > settled_transfers[next_stop]:
+                    continue
+                if next_transfers == settled_transfers[next_stop] and any(
+                        next_services | settled == settled
+                        for settled in settled_services[next_stop]):
+                    continue
+                relaxed += 1
+                next_dist = dist + distance
+                heapq.heappush(queue, (
+                    next_dist + to_goal[next_stop], next(tie_breaker),
+                    (next_dist, next_transfers, next_stop, next_services,
+                     label)))
+
+            # Labels arriving on foot run every service, as origins do
+            footpaths = () if walked else network.footpaths(stop)
+            next_transfers = transfers + (services != -1)
+            for next_stop, distance in footpaths:
+                if next_transfers >= goal_transfers or \
+                        next_transfers >= settled_walks[next_stop] or \
+                        next_transfers > settled_transfers[next_stop]:
+                    continue
+                if next_transfers == settled_transfers[next_stop] and \
+                        -1 in settled_services[next_stop]:
+                    continue
+                relaxed += 1
+                next_dist = dist + distance * walk_weight
+                heapq.heappush(queue, (
+                    next_dist + to_goal[next_stop], next(tie_breaker),
+                    (next_dist, next_transfers, next_stop, -1, label)))
+            if len(queue) > frontier_max:
+                frontier_max = len(queue)
+
+        stats.popped += popped
+        stats.expanded += expanded
+        stats.relaxed += relaxed
+        stats.heuristic += relaxed + len(origin_codes)
+        stats.frontier_max = max(stats.frontier_max, frontier_max)
+        stats.search_time += time.perf_counter() - start
+        if not frontier:
+            raise NoRouteError('No route from {} to {}'.format(
+                ', '.join(origin_codes), ', '.join(sorted(goal_codes))))
+        return [self.finish_labels(context, label)
+                for label in reversed(frontier)]
+
+    def finish_labels(self, context, label):
+        # Solution along a label's parents, each leg running the services
+        # common to all of its edges
+        labels = []
+        while label is not None:
+            labels.append(label)
+            label = label[4]
+        labels.reverse()
+        node = self.follow(
+            context, [label[2] for label in labels],
+            [label[3] == -1 and label[4] is not None for label in labels])
+
+        start = time.perf_counter()
+        route = node.best_route
+        services = labels[-1][3]
+        for edge, label, previous in zip(reversed(route), reversed(labels),
+                                         reversed(labels[:-1])):
+            edge.services = set() if edge.walk else \
+                self.network.decode_services(services)
+            if label[1] > previous[1]:
+                services = previous[3]
+        node.best_route = route
+        context.stats.postprocess_time += time.perf_counter() - start
+        return node
+
+    def finish(self, node):
+        # Postprocess a copy of the route, its edges are shared with the
+        # routes to other stops settled by the same search
+        start = time.perf_counter()
+        node.best_route = [copy.copy(edge) for edge in node.best_route]
+
+        # Refine the service bitmasks of the rides between walks, then expand
+        # them for the solution
+        rides = []
+        for edge in node.best_route + [None]:
+            if edge is not None and not edge.walk:
+                rides.append(edge)
+                continue
+            if rides:
+                # postprocess.refine_route(rides, postprocess.LATEST_TRANSFER)
+                # postprocess.refine_route(rides,
+                #                          postprocess.EARLIEST_TRANSFER)
+                postprocess.refine_route(rides, postprocess.PERMISSIVE)
+            rides = []
+        for edge in node.best_route:
+            edge.services = self.network.decode_services(edge.services)
+        node.context.stats.postprocess_time += time.perf_counter() - start
+        return node
+
+    def search(self, context, origin_codes, goals):
+        # Yields the node of each goal stop as it is settled
+        network = self.network
+        stats = context.stats
+        start = time.perf_counter()
+        # Per node logging is decided once, not formatted on every expansion
+        log_info = logging.getLogger().isEnabledFor(logging.INFO)
+        log_debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        # Frontier of (metric, tie-breaker, node) labels with lazy deletion:
+        # improved labels are pushed anew and superseded ones skipped when
+        # popped
+        traversal_queue = []
+        tie_breaker = count()
+        nodes = [None] * network.num_stops
+        optimal_nodes = bytearray(network.num_stops)
+        from_origin = context.from_origin
+        walk_weight = context.walk_weight
+        # Counters are kept in locals and added to stats before yielding
+        popped = expanded = relaxed = heuristic = 0
+        frontier_max = stats.frontier_max
+
+        # Initialize origin nodes
+        for origin_code in origin_codes:
+            stop = network.stop_index[origin_code]
+            origin_dist = from_origin[stop] if from_origin is not None else 0
+            origin = Node(context, stop, origin_dist, origin_dist, 0)
+            heuristic += 1
+            if nodes[stop] is not None and nodes[stop] <= origin:
+                continue
+            nodes[stop] = origin
+            heapq.heappush(traversal_queue,
+                           (origin.best_metric, next(tie_breaker), origin))
+        frontier_max = max(frontier_max, len(traversal_queue))
+
+        # Dijkstra iterations
+        while traversal_queue:
+            _, _, current_node = heapq.heappop(traversal_queue)
+            current_stop = current_node.stop
+            popped += 1
+
+            # Stale label, a better one has since been pushed or settled
+            if nodes[current_stop] is not current_node or \
+                    optimal_nodes[current_stop]:
+                continue
+            optimal_nodes[current_stop] = 1
+            expanded += 1
+
+            if log_info:
+                logging.info(current_node)
+
+            # Relax edges to next nodes
+            for next_stop, distance, services in network.successors(
+                    current_stop):
+                # Already optimal, ignore
+                if optimal_nodes[next_stop]:
+                    continue
+                relaxed += 1
+
+                # Check if node already exists, skip edges that cannot
+                # improve it even without a transfer before allocating them
+                next_node = nodes[next_stop]
+                if next_node is None:
+                    next_node = Node(context, next_stop)
+                    heuristic += 1
+                elif current_node.best_cost + distance + next_node.h_dist >= \
+                        next_node.best_metric:
+                    continue
+
+                if log_debug:
+                    logging.debug(' ++%s', next_node)
+
+                # Create edge and relax
+                edge = Edge(current_node, services, next_node, distance)
+                next_node = edge.update_dest_distance_cost_route()
+                if next_node is not None:
+                    nodes[next_stop] = next_node
+                    heapq.heappush(traversal_queue,
+                                   (next_node.best_metric, next(tie_breaker),
+                                    next_node))
+
+                if log_debug:
+                    logging.debug(' -%s', edge)
+
+            # Walk to nearby stops, but not straight after another walk
+            if current_node.edge is not None and current_node.edge.walk:
+                footpaths = ()
+            else:
+                footpaths = network.footpaths(current_stop)
+            for next_stop, distance in footpaths:
+                if optimal_nodes[next_stop]:
+                    continue
+                relaxed += 1
+                next_node = nodes[next_stop]
+                if next_node is None:
+                    next_node = Node(context, next_stop)
+                    heuristic += 1
+                elif current_node.best_cost + distance * walk_weight + \
+                        next_node.h_dist >= next_node.best_metric:
+                    continue
+                edge = Edge(current_node, 0, next_node, distance, True)
+                next_node = edge.update_dest_distance_cost_route()
+                if next_node is not None:
+                    nodes[next_stop] = next_node
+                    heapq.heappush(traversal_queue,
+                                   (next_node.best_metric, next(tie_breaker),
+                                    next_node))
+
+                if log_debug:
+                    logging.debug(' -%s', edge)
+            if len(traversal_queue) > frontier_max:
+                frontier_max = len(traversal_queue)
+
+            # Store optimal route found for bus stop (Service agnostic)
+            if current_stop in goals:
+                stats.popped += popped
+                stats.expanded += expanded
+                stats.relaxed += relaxed
+                stats.heuristic += heuristic
+                stats.frontier_max = frontier_max
+                stats.search_time += time.perf_counter() - start
+                popped = expanded = relaxed = heuristic = 0
+                yield current_node
+                start = time.perf_counter()
+
+        stats.popped += popped
+        stats.expanded += expanded
+        stats.relaxed += relaxed
+        stats.heuristic += heuristic
+        stats.frontier_max = frontier_max
+        stats.search_time += time.perf_counter() - start
+
+def serialize_route(solution):
+    return {
+        'goal': solution.bus_stop_code,
+        'distance': solution.best_dist,
+        'cost': solution.best_cost,
+        'edges': [{
+            'from': edge.source.bus_stop_code,
+            'to': edge.dest.bus_stop_code,
+            'distance': edge.distance,
+            'cost': edge.cost,
+            'transfer': edge.has_transferred,
+            'walk': edge.walk,
+            'services': sorted(edge.services),
+        } for edge in solution.best_route],
+    }
+
+def _route_group(origin_codes, goal_codes, transfer_penalty, walk_weight):
+    # Batch worker answering every goal of one origin set
+    return list(_iter_group(origin_codes, goal_codes, transfer_penalty,
+                            walk_weight))
+
+def _iter_group(origin_codes, goal_codes, transfer_penalty, walk_weight):
+    group_router = Router(router.network, router.patterns, router.load_time,
+                          walk_weight, router.cost_matrix)
+    reached = set()
+    try:
+        for goal_code, solution in group_router.route_many(
+                origin_codes, goal_codes, transfer_penalty):
+            reached.add(goal_code)
+            yield {'origin': origin_codes, 'goal': goal_code,
+                   'result': serialize_route(solution)}
+    except NoRouteError as e:
+        error = str(e)
+    else:
+        error = None
+    for goal_code in goal_codes:
+        if goal_code not in reached:
+            yield {'origin': origin_codes, 'goal': goal_code,
+                   'error': error or 'No route from {} to {}'.format(
+                       ', '.join(origin_codes), goal_code)}
+
+def route_batch(pairs, transfer_penalty=TRANSFER_PENALTY, workers=1,
+                walk_weight=WALK_WEIGHT):
+    """
+    Route (origin codes, goal code) pairs, yielding result dicts as they
+    complete
+
+    Pairs sharing an origin set are answered by one search, distinct origin
+    sets are spread over a process pool when workers > 1.
+    """
+    groups = OrderedDict()
+    for origin_codes, goal_code in pairs:
+        goal_codes = groups.setdefault(tuple(origin_codes), [])
+        if goal_code not in goal_codes:
+            goal_codes.append(goal_code)
+
+    if workers <= 1 or len(groups) <= 1:
+        for origin_codes, goal_codes in groups.items():
+            yield from _iter_group(list(origin_codes), goal_codes,
+                                   transfer_penalty, walk_weight)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_route_group, list(origin_codes),
+                                   goal_codes, transfer_penalty, walk_weight)
+                   for origin_codes, goal_codes in groups.items()]
+        for future in as_completed(futures):
+            yield from future.result()
+
+def read_pairs(f, file_format):
+    # (origin codes, goal code) pairs from JSON lines or CSV rows, several
+    # origin codes are space separated
+    if file_format == 'jsonl':
+        for line in f:
+            if line.strip():
+                pair = json.loads(line)
+                origin_codes = pair['origin']
+                if isinstance(origin_codes, str):
+                    origin_codes = origin_codes.split()
+                yield origin_codes, pair['goal']
+    else:
+        for row in csv.DictReader(f):
+            yield row['origin'].split(), row['goal']
+
+def load_patterns(network, path=patterns.PATTERNS_PATH):
+    # Transfer patterns at path if they were built from network, else None.
+    # They only ride buses, so graphs with footpaths are searched instead
+    if not os.path.exists(path):
+        return None
+    if network.num_footpaths:
+        return None
+    transfer_patterns = patterns.load(path)
+    if transfer_patterns.version != network.version:
+        logging.warning('Ignoring %s built for another dataset', path)
+        return None
+    return transfer_patterns
+
+def load_matrix(network, walk_weight=WALK_WEIGHT, path=matrix.MATRIX_PATH):
+    # Cost matrix at path if it was built from network with walk_weight,
+    # else None
+    if not os.path.exists(path):
+        return None
+    cost_matrix = matrix.load(path)
+    if cost_matrix.version != network.version:
+        logging.warning('Ignoring %s built for another dataset', path)
+        return None
+    if cost_matrix.walk_weight != walk_weight:
+        logging.warning('Ignoring %s built for walk weight %s', path,
+                        cost_matrix.walk_weight)
+        return None
+    return cost_matrix
+
+# Router over the default graph
+router = Router(network, load_patterns(network), load_time,
+                cost_matrix=load_matrix(network))
+
+def reload():
+    """
+    Swap in the graph, transfer patterns and cost matrix if their files were
+    replaced, so a running process serves an updated dataset without a
+    restart
+
+    Returns whether the dataset version changed.
+    """
+    global dataset_files, network, router, load_time
+    files = _dataset_files()
+    if files == dataset_files:
+        return False
+    dataset_files = files
+    start = time.perf_counter()
+    new_network = graph.load()
+    changed = new_network.version != network.version
+    if changed:
+        network = new_network
+        load_time = time.perf_counter() - start
+    router = Router(network, load_patterns(network), load_time,
+                    cost_matrix=load_matrix(network))
+    return changed
+
+def main():
     # No transfers      : 19051 -> 18111
     # Single transfer   : 19051 -> 18129
     # Equally optimal   : 59039 -> 54589
@@ -237,6 +1364,40 @@ def main():
     parser.add_argument(
         '-t', '--transfer-penalty', default=TRANSFER_PENALTY, type=float,
         help="distance in km equivalent to the time & effort a transfer requires")
+    parser.add_argument(
+        '-b', '--bidirectional', action='store_true',
+        help="search from both ends of coords and codes queries over the "
+             "(stop, service) states, exact in transfers")
+    parser.add_argument(
+        '-p', '--pareto', action='store_true',
+        help="list every route that no other beats on both distance and "
+             "transfers, from one search")
+    parser.add_argument(
+        '--max-transfers', default=MAX_TRANSFERS, type=int,
+        help="most transfers of the routes listed by --pareto")
+    parser.add_argument(
+        '-k', '--alternatives', type=int, metavar='K',
+        help="list up to K distinct routes of coords and codes queries, "
+             "from one search in each direction")
+    parser.add_argument(
+        '--max-detour', default=MAX_DETOUR, type=float,
+        help="fraction alternative routes may cost above the cheapest")
+    parser.add_argument(
+        '--max-overlap', default=MAX_OVERLAP, type=float,
+        help="fraction of its distance an alternative route may share with "
+             "a cheaper one")
+    parser.add_argument(
+        '--walk-weight', default=WALK_WEIGHT, type=float,
+        help="cost per km walked between nearby bus stops")
+    parser.add_argument(
+        '--stats', action='store_true',
+        help="print search counters and the time spent in each stage")
+    parser.add_argument(
+        '--profile', choices=profiling.PROFILERS,
+        help="profile the query with cProfile or a sampling profiler")
+    parser.add_argument(
+        '--profile-output', metavar='PATH',
+        help="save cProfile stats to PATH")
     subparsers = parser.add_subparsers(help='mode', dest='mode')
     subparsers.required = True
 
@@ -263,6 +1424,41 @@ def main():
         help="origin bus stop codes")
     codeparser.add_argument(
         '-g', '--goal', default=DEBUG_GOAL_STOP, help="destination bus stop code")
+    codeparser.add_argument(
+        '--patterns', action='store_true',
+        help="follow the table of patterns.py build instead of searching")
+
+    # Route many pairs
+    batchparser = subparsers.add_parser(
+        'batch', help='find the shortest bus routes between many pairs of '
+                      'bus stop codes, as JSON lines on stdout')
+    batchparser.add_argument(
+        'pairs', nargs='?', default='-',
+        help="CSV with origin and goal columns or JSONL of origin and goal "
+             "objects, '-' for stdin")
+    batchparser.add_argument(
+        '-f', '--format', choices=['csv', 'jsonl'],
+        help="input format, detected from the file extension by default")
+    batchparser.add_argument(
+        '-w', '--workers', default=1, type=int,
+        help="number of worker processes across distinct origins")
+
+    # Reach every stop from one origin
+    isoparser = subparsers.add_parser(
+        'isochrone', help='find the cost of reaching every bus stop from '
+                          'the origin bus stop codes')
+    isoparser.add_argument(
+        '-o', '--origin', default=DEBUG_ORIGIN_STOPS, nargs='+',
+        metavar='ORIGIN', help="origin bus stop codes")
+    isoparser.add_argument(
+        '-c', '--max-cost', default=math.inf, type=float,
+        help="leave stops costing more than MAX_COST unreached")
+    isoparser.add_argument(
+        '--output', metavar='PATH',
+        help="save the per stop arrays to PATH as .npz")
+    isoparser.add_argument(
+        '--grid-cell', type=float, metavar='KM',
+        help="also save the least cost in each square cell of KM km")
 
     args = parser.parse_args()
 
@@ -276,31 +1472,93 @@ def main():
     logging.basicConfig(level=LOG_LEVEL, datefmt='%H:%M:%S',
                         format='%(asctime)s %(message)s')
 
-    TRANSFER_PENALTY = args.transfer_penalty
-    origin = args.origin
-    goal = args.goal
+    # Queries run on a router of their own walk weight, the shared one is
+    # left as loaded
+    router = Router(network, load_patterns(network), load_time,
+                    args.walk_weight,
+                    load_matrix(network, args.walk_weight))
 
-    if args.mode == 'coords':
-        NEARBY_STOPS_RADIUS = args.radius
-        origin_lat, origin_lon = origin
-        goal_lat, goal_lon = goal
-        precalculate_distances(origin_lat, origin_lon, dest_key=FROM_ORIGIN_KEY)
-        precalculate_distances(goal_lat, goal_lon, dest_key=TO_GOAL_KEY)
-        origin_codes = find_nearby_stops(bs, FROM_ORIGIN_KEY,
-                                         NEARBY_STOPS_RADIUS)
-        goal_codes = find_nearby_stops(bs, TO_GOAL_KEY, NEARBY_STOPS_RADIUS)
-        goal_codes = set(goal_codes)
-    elif args.mode == 'codes':
-        origin_codes = origin
-        precalculate_distances(
-            bs[goal]['Latitude'], bs[goal]['Longitude'], dest_key=TO_GOAL_KEY)
-        goal_codes = set([goal])
+    if args.mode == 'batch':
+        file_format = args.format or (
+            'jsonl' if args.pairs.endswith(('.jsonl', '.json')) else 'csv')
+        f = sys.stdin if args.pairs == '-' else open(args.pairs, newline='')
+        with f:
+            pairs = list(read_pairs(f, file_format))
+        for result in route_batch(pairs, args.transfer_penalty,
+                                  args.workers, args.walk_weight):
+            print(json.dumps(result), flush=True)
+        return
 
     # Run algorithm
-    solution = dijkstra(origin_codes, goal_codes)
+    profiler = contextlib.nullcontext()
+    if args.profile:
+        profiler = profiling.profile(args.profile, args.profile_output)
+    try:
+        with profiler:
+            if args.mode == 'isochrone':
+                isochrone = router.isochrone_codes(
+                    args.origin, args.transfer_penalty, args.max_cost)
+            elif args.alternatives:
+                if args.mode == 'coords':
+                    frontier = router.alternatives_coords(
+                        args.origin, args.goal, args.radius,
+                        args.transfer_penalty, args.alternatives,
+                        args.max_detour, args.max_overlap)
+                else:
+                    frontier = router.alternatives_codes(
+                        args.origin, args.goal, args.transfer_penalty,
+                        args.alternatives, args.max_detour, args.max_overlap)
+            elif args.pareto:
+                if args.mode == 'coords':
+                    frontier = router.frontier_coords(
+                        args.origin, args.goal, args.radius,
+                        args.transfer_penalty, args.max_transfers)
+                else:
+                    frontier = router.frontier_codes(
+                        args.origin, args.goal, args.transfer_penalty,
+                        args.max_transfers)
+            elif args.mode == 'coords':
+                solution = router.route_coords(args.origin, args.goal,
+                                               args.radius,
+                                               args.transfer_penalty,
+                                               args.bidirectional)
+            elif args.mode == 'codes':
+                solution = router.route_codes(args.origin, args.goal,
+                                              args.transfer_penalty,
+                                              args.bidirectional,
+                                              args.patterns)
+    except (NoRouteError, ValueError) as e:
+        exit(str(e))
+    if args.mode == 'isochrone':
+        reached = isochrone.cost < math.inf
+        print('{} of {} stops reached | cost p50 {:.1f} | max {:.1f}'.format(
+            reached.sum(), len(reached), np.median(isochrone.cost[reached]),
+            isochrone.cost[reached].max()))
+        if args.output:
+            arrays = isochrone._asdict()
+            del arrays['stats']
+            if args.grid_cell:
+                arrays['latitudes'], arrays['longitudes'], arrays['grid'] = \
+                    geo.rasterize(network.latitudes, network.longitudes,
+                                  isochrone.cost, args.grid_cell)
+            np.savez(args.output, stop_codes=list(network.stop_codes),
+                     **arrays)
+        if args.stats:
+            print(isochrone.stats)
+        return
+    if args.pareto or args.alternatives:
+        for solution in frontier:
+            print('{} transfers | {:.1f}km | cost {:.1f}'.format(
+                solution.transfers, solution.best_dist, solution.best_cost))
+            pprint(solution.best_route)
+        if args.stats and frontier:
+            print(frontier[0].stats)
+        return
     print('Solution')
     pprint(solution.best_route)
     print('{} | {} stops'.format(solution, len(solution.best_route)))
+    if args.stats:
+        print(solution.stats)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,270 @@
+from argparse import ArgumentParser
+import asyncio
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+import time
+import traceback
+
+import cache
+import route
+
+# Options
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+# Upper bounds in ms of the latency histogram buckets, the last is unbounded
+LATENCY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+
+class LatencyHistogram:
+    """
+    Fixed bucket latency histogram, percentiles are reported as the upper
+    bound of the bucket they fall in
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, elapsed_ms):
+        self.counts[bisect_left(self.bounds, elapsed_ms)] += 1
+        self.count += 1
+        self.total += elapsed_ms
+
+    def percentile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+    def to_dict(self):
+        labels = ['<={}'.format(bound) for bound in self.bounds] + [
+            '>{}'.format(self.bounds[-1])]
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'buckets': dict(zip(labels, self.counts)),
+        }
+
+
+def handle_cost(query):
+    """
+    Answer a cost query, from the cost matrix when it was built for the
+    transfer penalty. The route is only searched for when asked for, with
+    the search the matrix is built with, and its own cost is returned.
+    """
+    transfer_penalty = float(query.get('transfer_penalty',
+                                       route.TRANSFER_PENALTY))
+    if query.get('route'):
+        solution = route.router.expand_codes(query['origin'], query['goal'],
+                                             transfer_penalty)
+        return {'cost': solution.best_cost, 'transfers': solution.transfers,
+                'route': route.serialize_route(solution)}
+    cost, transfers = route.router.cost_codes(query['origin'], query['goal'],
+                                              transfer_penalty)
+    return {'cost': cost, 'transfers': transfers}
+
+
+def handle_query(query):
+    """
+    Answer a coords, codes or cost query, runs in a worker process
+    """
+    route.reload()
+    transfer_penalty = float(query.get('transfer_penalty',
+                                       route.TRANSFER_PENALTY))
+    mode = query.get('mode')
+    if mode == 'coords':
+        solution = route.router.route_coords(
+            query['origin'], query['goal'],
+            float(query.get('radius', route.NEARBY_STOPS_RADIUS)),
+            transfer_penalty)
+    elif mode == 'codes':
+        solution = route.router.route_codes(query['origin'], query['goal'],
+                                            transfer_penalty)
+    elif mode == 'cost':
+        return handle_cost(query)
+    else:
+        raise ValueError('Unknown mode {!r}'.format(mode))
+    return route.serialize_route(solution)
+
+
+def cache_key(route_cache, query):
+    mode = query.get('mode')
+    radius = None
+    if mode == 'coords':
+        radius = float(query.get('radius', route.NEARBY_STOPS_RADIUS))
+    return route_cache.key(
+        mode, query['origin'], query['goal'],
+        query.get('transfer_penalty', route.TRANSFER_PENALTY), radius)
+
+
+class RouteServer:
+    """
+    Line delimited JSON routing server
+
+    Each request line is a JSON object with an optional 'id' echoed back in
+    the response. Searches run in a process pool forked after the graph has
+    been loaded, so responses may arrive out of order. Routes found are
+    kept in an optional RouteCache in front of the pool.
+    """
+
+    def __init__(self, workers=None, route_cache=None):
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+        self.route_cache = route_cache
+        self.latencies = {}
+
+    def stats(self):
+        stats = {mode: histogram.to_dict()
+                 for mode, histogram in self.latencies.items()}
+        if self.route_cache is not None:
+            stats['cache'] = self.route_cache.stats()
+        return stats
+
+    async def route(self, query):
+        # Workers reload an updated dataset on their next query, drop the
+        # routes cached for the old one
+        if route.reload() and self.route_cache is not None:
+            self.route_cache.reset(route.network.version)
+
+        # Matrix lookups are cheaper than a round trip to the pool, queries
+        # the matrix cannot answer are searched for there
+        if query.get('mode') == 'cost' and not query.get('route') and \
+                route.router.matches_matrix(float(query.get(
+                    'transfer_penalty', route.TRANSFER_PENALTY))):
+            return handle_cost(query)
+
+        key = None
+        if self.route_cache is not None and query.get('mode') in [
+                'coords', 'codes']:
+            key = cache_key(self.route_cache, query)
+            result = self.route_cache.get(key)
+            if result is not None:
+                return result
+
+        loop = asyncio.get_event_loop()
+        result = await loop.run_in_executor(self.pool, handle_query, query)
+        if key is not None:
+            self.route_cache.put(key, result)
+        return result
+
+    async def respond(self, line):
+        start = time.perf_counter()
+        query_id = None
+        try:
+            query = json.loads(line)
+            if not isinstance(query, dict):
+                raise TypeError('Query must be a JSON object')
+            query_id = query.get('id')
+            mode = query.get('mode')
+            if mode == 'stats':
+                result = self.stats()
+            else:
+                result = await self.route(query)
+                elapsed_ms = (time.perf_counter() - start) * 1000
+                self.latencies.setdefault(
+                    mode, LatencyHistogram()).record(elapsed_ms)
+            response = {'id': query_id, 'result': result}
+        except (route.NoRouteError, KeyError, TypeError, ValueError) as e:
+            response = {'id': query_id, 'error': str(e)}
+        except Exception as e:
+            # Any other failure still gets a reply, or the client would wait
+            # on it forever
+            traceback.print_exc()
+            response = {'id': query_id,
+                        'error': '{}: {}'.format(type(e).__name__, e)}
+        return json.dumps(response) + '\n'
+
+    async def handle_connection(self, reader, writer):
+        lock = asyncio.Lock()
+        tasks = set()
+
+        async def reply(line):
+            response = await self.respond(line)
+            async with lock:
+                writer.write(response.encode('utf-8'))
+                await writer.drain()
+
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if line.strip():
+                task = asyncio.ensure_future(reply(line.decode('utf-8')))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks)
+        writer.close()
+
+    def close(self):
+        self.pool.shutdown()
+        if self.route_cache is not None:
+            self.route_cache.close()
+
+
+def main():
+    parser = ArgumentParser(
+        description='Serves shortest bus route queries as line delimited JSON')
+    parser.add_argument(
+        '--host', default=DEFAULT_HOST, help="TCP host to listen on")
+    parser.add_argument(
+        '-p', '--port', default=DEFAULT_PORT, type=int,
+        help="TCP port to listen on")
+    parser.add_argument(
+        '-u', '--unix', metavar='PATH',
+        help="listen on a unix socket instead of TCP")
+    parser.add_argument(
+        '-w', '--workers', default=os.cpu_count(), type=int,
+        help="number of search worker processes")
+    parser.add_argument(
+        '-c', '--cache-size', default=cache.DEFAULT_MAXSIZE, type=int,
+        help="number of routes kept in memory, 0 disables caching")
+    parser.add_argument(
+        '--cache-path', metavar='PATH',
+        help="sqlite file to persist cached routes across restarts")
+    args = parser.parse_args()
+
+    # Build the lazy lookups before the workers fork so they share them
+    route.network.stop_index
+    route.network.grid
+
+    route_cache = None
+    if args.cache_size > 0:
+        route_cache = cache.RouteCache(route.network.version, args.cache_size,
+                                       args.cache_path)
+
+    server = RouteServer(args.workers, route_cache)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    if args.unix:
+        listener = loop.run_until_complete(asyncio.start_unix_server(
+            server.handle_connection, path=args.unix))
+    else:
+        listener = loop.run_until_complete(asyncio.start_server(
+            server.handle_connection, host=args.host, port=args.port))
+    print('Serving {} stops on {}'.format(
+        route.network.num_stops, args.unix or '{}:{}'.format(args.host,
+                                                             args.port)))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        loop.run_until_complete(listener.wait_closed())
+        server.close()
+
+if __name__ == '__main__':
+    main()
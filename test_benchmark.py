@@ -0,0 +1,55 @@
+import unittest
+
+import benchmark
+
+
+def results(p50, p95, nodes=None):
+    stages = {'search': {'count': 1, 'p50': p50, 'p95': p95}}
+    if nodes is not None:
+        stages['search']['nodes'] = {'p50': nodes, 'p95': nodes}
+    return {'stages': stages}
+
+class PercentileTestCase(unittest.TestCase):
+    def test_nearest_rank(self):
+        samples = list(range(1, 101))
+        self.assertEqual(benchmark.percentile(samples, 50), 50)
+        self.assertEqual(benchmark.percentile(samples, 95), 95)
+        self.assertEqual(benchmark.percentile([3, 1, 2], 99), 3)
+        self.assertEqual(benchmark.percentile([7], 50), 7)
+
+    def test_summarize(self):
+        summary = benchmark.summarize([4, 1, 3, 2])
+        self.assertEqual(summary['count'], 4)
+        self.assertEqual(summary['mean'], 2.5)
+        self.assertEqual(summary['p50'], 2)
+        self.assertEqual(summary['p99'], 4)
+        self.assertIsNone(benchmark.summarize([])['p50'])
+
+class CompareTestCase(unittest.TestCase):
+    def test_within_tolerance(self):
+        self.assertEqual(benchmark.compare(
+            results(10.5, 20, 100), results(10, 20, 100), 0.1), [])
+
+    def test_regressions(self):
+        self.assertEqual(benchmark.compare(
+            results(12, 20, 120), results(10, 20, 100), 0.1),
+            [('search', 'p50', 10, 12), ('search', 'nodes p50', 100, 120),
+             ('search', 'nodes p95', 100, 120)])
+
+    def test_startup_rss(self):
+        current, baseline = results(10, 20), results(10, 20)
+        current['stages']['startup bundle'] = {'count': 1, 'p50': 1,
+                                               'p95': 1, 'rss_mb': 60}
+        baseline['stages']['startup bundle'] = {'count': 1, 'p50': 1,
+                                                'p95': 1, 'rss_mb': 50}
+        self.assertEqual(benchmark.compare(current, baseline, 0.1),
+                         [('startup bundle', 'rss_mb', 50, 60)])
+
+    def test_missing_stages(self):
+        current = results(12, 20)
+        current['stages']['startup pickle'] = {'count': 1, 'p50': 1, 'p95': 1}
+        self.assertEqual(benchmark.compare(current, results(12, 20)), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
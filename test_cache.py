@@ -0,0 +1,77 @@
+import os
+import tempfile
+import unittest
+
+import cache
+
+class RouteCacheTestCase(unittest.TestCase):
+    def test_lru_eviction(self):
+        route_cache = cache.RouteCache('v1', maxsize=2)
+        keys = [route_cache.key('codes', [code], '03381', 5)
+                for code in ['19051', '18111', '07319']]
+        route_cache.put(keys[0], {'goal': 0})
+        route_cache.put(keys[1], {'goal': 1})
+        self.assertEqual(route_cache.get(keys[0]), {'goal': 0})
+        route_cache.put(keys[2], {'goal': 2})
+        self.assertIsNone(route_cache.get(keys[1]))
+        self.assertEqual(route_cache.get(keys[0]), {'goal': 0})
+        self.assertEqual((route_cache.hits, route_cache.misses), (2, 1))
+
+    def test_key(self):
+        route_cache = cache.RouteCache('v1')
+        self.assertEqual(
+            route_cache.key('codes', ['18111', '19051', '18111'], '03381', 5),
+            route_cache.key('codes', ['19051', '18111'], '03381', 5.0))
+        self.assertNotEqual(
+            route_cache.key('codes', ['19051'], '03381', 5),
+            cache.RouteCache('v2').key('codes', ['19051'], '03381', 5))
+
+    def test_persisted_versions(self):
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        try:
+            route_cache = cache.RouteCache('v1', path=path)
+            key = route_cache.key('codes', ['19051'], '03381', 5)
+            route_cache.put(key, {'goal': '03381'})
+            route_cache.close()
+
+            route_cache = cache.RouteCache('v1', path=path)
+            self.assertEqual(route_cache.get(key), {'goal': '03381'})
+            route_cache.close()
+
+            # A new dataset version drops the stored entries
+            cache.RouteCache('v2', path=path).close()
+            route_cache = cache.RouteCache('v1', path=path)
+            self.assertIsNone(route_cache.get(key))
+            route_cache.close()
+        finally:
+            os.remove(path)
+
+    def test_reset(self):
+        route_cache = cache.RouteCache('v1')
+        key = route_cache.key('codes', ['19051'], '03381', 5)
+        route_cache.put(key, {'goal': '03381'})
+        route_cache.reset('v2')
+        self.assertNotEqual(route_cache.key('codes', ['19051'], '03381', 5),
+                            key)
+        self.assertIsNone(route_cache.get(key))
+        self.assertEqual(route_cache.stats()['version'], 'v2')
+
+    def test_put_after_reset(self):
+        # A route of the old dataset finishing after a reset is not stored
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        try:
+            route_cache = cache.RouteCache('v1', path=path)
+            key = route_cache.key('codes', ['19051'], '03381', 5)
+            route_cache.reset('v2')
+            route_cache.put(key, {'goal': '03381'})
+            self.assertEqual(route_cache.stats()['size'], 0)
+            self.assertEqual(route_cache.db.execute(
+                'SELECT COUNT(*) FROM routes').fetchone(), (0,))
+            route_cache.close()
+        finally:
+            os.remove(path)
+
+if __name__ == '__main__':
+    unittest.main()
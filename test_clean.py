@@ -0,0 +1,58 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import pandas as pd
+from sqlalchemy import create_engine
+
+import clean
+
+class CleanRoutesTestCase(unittest.TestCase):
+    def test_chunks(self):
+        rt = pd.DataFrame(
+            [('10', 1, 'A', 0.0), ('10', 2, 'B', None), ('10', 3, 'X', 4.0),
+             ('20', 1, 'C', 0.0), ('20', 2, 'A', 2.5)],
+            columns=['ServiceNo', 'StopSequence', 'BusStopCode', 'Distance'])
+        rejected = []
+        chunks = list(clean.clean_routes(
+            (rt[i:i + 2] for i in range(0, len(rt), 2)), {'A', 'B', 'C'},
+            rejected))
+
+        self.assertEqual(len(chunks), 3)
+        cleaned = pd.concat(chunks)
+        self.assertEqual(cleaned.BusStopCode.tolist(), ['A', 'B', 'C', 'A'])
+        self.assertEqual(cleaned.Distance.tolist(), [0.0, 0.0, 0.0, 2.5])
+        self.assertEqual(pd.concat(rejected).BusStopCode.tolist(), ['X'])
+
+    def test_without_rejected(self):
+        rt = pd.DataFrame({'BusStopCode': ['A', 'X'], 'Distance': [1.0, 2.0]})
+        cleaned = pd.concat(clean.clean_routes([rt], {'A'}))
+        self.assertEqual(cleaned.BusStopCode.tolist(), ['A'])
+
+class MainTestCase(unittest.TestCase):
+    def test_in_place(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = 'sqlite:///' + os.path.join(tmp, 'test.db')
+            db_conn = create_engine(db_path)
+            pd.DataFrame({'BusStopCode': ['A', 'B']}).to_sql(
+                name='bus_stops', con=db_conn, index=False)
+            pd.DataFrame(
+                [('10', 1, 'A', 0.0), ('10', 2, 'X', 1.0),
+                 ('10', 3, 'B', None)],
+                columns=['ServiceNo', 'StopSequence', 'BusStopCode',
+                         'Distance']).to_sql(name='bus_routes', con=db_conn,
+                                             index=False)
+            with mock.patch('clean.DB_PATH', db_path), \
+                    mock.patch('sys.argv', ['clean.py', '-c', '1']), \
+                    mock.patch('builtins.print') as print_:
+                clean.main()
+            rt = pd.read_sql_table('bus_routes', con=db_conn)
+            db_conn.dispose()
+        self.assertEqual(rt.BusStopCode.tolist(), ['A', 'B'])
+        self.assertEqual(rt.Distance.tolist(), [0.0, 0.0])
+        print_.assert_called_with('Kept 2 rows, rejected 1')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+import requests
+from sqlalchemy import create_engine, inspect
+
+import downloader
+
+PAGE_SIZE = 2
+
+# Canned DataMall tables, each served PAGE_SIZE rows at a time
+TABLES = {
+    'BusStops': [{'BusStopCode': '{:05d}'.format(i), 'Latitude': 1.3,
+                  'Longitude': 103.8} for i in range(7)],
+    'BusRoutes': [{'ServiceNo': '10', 'StopSequence': i + 1,
+                   'BusStopCode': '{:05d}'.format(i), 'Distance': i * 0.5}
+                  for i in range(4)],
+}
+
+class DataMallHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        api_path = url.path.rsplit('/', 1)[-1]
+        skip = int(parse_qs(url.query)['$skip'][0])
+        with server.lock:
+            server.requests.append((api_path, skip))
+            failures = server.failures.get((api_path, skip))
+            status = failures.pop(0) if failures else 200
+        if status != 200:
+            self.send_response(status)
+            self.end_headers()
+            return
+        body = json.dumps({'value': TABLES[api_path][
+            skip:skip + PAGE_SIZE]}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class DownloadTableTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), DataMallHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.failures = {}
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url_format = 'http://127.0.0.1:{}/ltaodataservice/{{}}'.format(
+            self.server.server_port)
+
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.db_conn = create_engine('sqlite:///' + self.path)
+        self.session = downloader.make_session('key', workers=3, retries=2,
+                                               backoff_factor=0)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.session.close()
+        self.db_conn.dispose()
+        os.remove(self.path)
+
+    def download(self, api_path='BusStops', db_table='bus_stops'):
+        return downloader.download_table(
+            self.session, self.db_conn, api_path, db_table, workers=3,
+            url_format=self.url_format, page_size=PAGE_SIZE)
+
+    def table(self, db_table='bus_stops'):
+        return pd.read_sql_table(db_table, self.db_conn).to_dict(
+            orient='records')
+
+    def test_download(self):
+        self.assertEqual(self.download(), 7)
+        self.assertEqual(self.table(), TABLES['BusStops'])
+        self.assertEqual(self.download('BusRoutes', 'bus_routes'), 4)
+        self.assertEqual(self.table('bus_routes'), TABLES['BusRoutes'])
+
+    def test_retries(self):
+        self.server.failures[('BusStops', 2)] = [503, 500]
+        self.download()
+        self.assertEqual(self.table(), TABLES['BusStops'])
+        self.assertEqual(self.server.requests.count(('BusStops', 2)), 3)
+
+    def test_resume(self):
+        self.server.failures[('BusStops', 4)] = [404]
+        with self.assertRaises(requests.HTTPError):
+            self.download()
+        self.assertFalse(inspect(self.db_conn).has_table('bus_stops'))
+
+        del self.server.requests[:]
+        self.download()
+        self.assertEqual(self.table(), TABLES['BusStops'])
+        self.assertNotIn(('BusStops', 0), self.server.requests)
+        self.assertEqual(downloader.load_checkpoint(self.db_conn, 'BusStops'),
+                         {})
+
+    def test_stale_checkpoint(self):
+        # Pages checkpointed before DataMall may have updated are fetched
+        # again rather than mixed with fresh ones
+        self.server.failures[('BusStops', 4)] = [404]
+        with mock.patch('time.time', return_value=0), \
+                self.assertRaises(requests.HTTPError):
+            self.download()
+
+        del self.server.requests[:]
+        with mock.patch('builtins.print'):
+            self.download()
+        self.assertEqual(self.table(), TABLES['BusStops'])
+        self.assertIn(('BusStops', 0), self.server.requests)
+
+    def test_replaces_table(self):
+        self.download()
+        self.download()
+        self.assertEqual(self.table(), TABLES['BusStops'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,4 @@
+import random
 import unittest
 
 import geo
@@ -25,5 +26,78 @@ class KnownVincentyDistanceTestCase(unittest.TestCase):
                 self.point1_lat, self.point1_lon,
                 self.point2_lat, self.point2_lon), self.distance, delta=0.02)
 
+class VectorizedDistanceTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        rng = random.Random(1)
+        cls.latitudes = [rng.uniform(1.2, 1.5) for _ in range(50)]
+        cls.longitudes = [rng.uniform(103.6, 104.0) for _ in range(50)]
+
+    def test_haversine_parity(self):
+        distances = geo._haversine_array(
+            self.latitudes[0], self.longitudes[0], self.latitudes,
+            self.longitudes)
+        for lat, lon, d in zip(self.latitudes, self.longitudes, distances):
+            self.assertAlmostEqual(d, geo._haversine(
+                self.latitudes[0], self.longitudes[0], lat, lon), places=9)
+
+    def test_equirectangular_parity(self):
+        distances = geo._equirectangular_array(
+            self.latitudes[0], self.longitudes[0], self.latitudes,
+            self.longitudes)
+        for lat, lon, d in zip(self.latitudes, self.longitudes, distances):
+            self.assertAlmostEqual(d, geo._equirectangular(
+                self.latitudes[0], self.longitudes[0], lat, lon), places=9)
+
+    def test_distance_matrix(self):
+        matrix = geo.distance_matrix(self.latitudes[:3], self.longitudes[:3],
+                                     self.latitudes, self.longitudes)
+        self.assertEqual(matrix.shape, (3, 50))
+        for i in range(3):
+            self.assertEqual(matrix[i].tolist(), geo.distances(
+                self.latitudes[i], self.longitudes[i], self.latitudes,
+                self.longitudes).tolist())
+
+class GridIndexTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        rng = random.Random(0)
+        cls.latitudes = [rng.uniform(1.2, 1.5) for _ in range(2000)]
+        cls.longitudes = [rng.uniform(103.6, 104.0) for _ in range(2000)]
+        cls.grid = geo.GridIndex(cls.latitudes, cls.longitudes)
+
+    def brute_force(self, lat, lon, radius):
+        return {i for i, (stop_lat, stop_lon) in enumerate(
+            zip(self.latitudes, self.longitudes))
+            if geo.distance(lat, lon, stop_lat, stop_lon) <= radius}
+
+    def test_within_vs_brute_force(self):
+        for lat, lon, radius in [(1.3, 103.8, 0.3), (1.2, 103.6, 1.0),
+                                 (1.45, 103.95, 2.5), (1.35, 103.8, 0.0)]:
+            with self.subTest(lat=lat, lon=lon, radius=radius):
+                self.assertEqual(
+                    {i for i, _ in self.grid.within(lat, lon, radius)},
+                    self.brute_force(lat, lon, radius))
+
+    def test_within_inclusive(self):
+        lat, lon = self.latitudes[0], self.longitudes[0]
+        radius = geo.distance(lat, lon, self.latitudes[1], self.longitudes[1])
+        nearby = dict(self.grid.within(lat, lon, radius))
+        self.assertIn(1, nearby)
+        self.assertEqual(nearby[0], 0)
+
+class RasterizeTestCase(unittest.TestCase):
+    def test_rasterize(self):
+        # Two points share the first 1km cell, the third is 2.2km north east
+        latitudes, longitudes, grid = geo.rasterize(
+            [1.300, 1.301, 1.320], [103.800, 103.801, 103.820],
+            [5.0, 3.0, 7.0], cell_size=1.0)
+        self.assertEqual(grid.shape, (3, 3))
+        self.assertEqual(grid[0, 0], 3.0)
+        self.assertEqual(grid[2, 2], 7.0)
+        self.assertEqual(int((grid < float('inf')).sum()), 2)
+        self.assertLess(abs(latitudes[0] - 1.3045), 0.001)
+        self.assertLess(abs(longitudes[2] - 103.8225), 0.001)
+
 if __name__ == '__main__':
     unittest.main()
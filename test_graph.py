@@ -0,0 +1,208 @@
+import os
+import tempfile
+import unittest
+
+import fixtures
+import graph
+
+class CompileGraphTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Service 10 runs A -> B -> C, service 20 runs A -> B and 30 runs C -> A
+        rows = [('10', 1, 'A', 0.0), ('10', 2, 'B', 1.5), ('10', 3, 'C', 4.0),
+                ('20', 1, 'A', 0.0), ('20', 2, 'B', 1.5),
+                ('30', 1, 'C', 0.0), ('30', 2, 'A', 3.0)]
+        cls.rt_idx, cls.rt_bs = fixtures.route_tables(rows)
+        cls.bs = {'A': {'Latitude': 1.30, 'Longitude': 103.80},
+                  'B': {'Latitude': 1.31, 'Longitude': 103.81},
+                  'C': {'Latitude': 1.32, 'Longitude': 103.82}}
+        cls.graph = graph.compile_graph(cls.rt_idx, cls.rt_bs, cls.bs)
+
+    def successors(self, bus_stop_code):
+        stop = self.graph.stop_index[bus_stop_code]
+        return {self.graph.stop_codes[next_stop]:
+                (distance, self.graph.decode_services(services))
+                for next_stop, distance, services in self.graph.successors(
+                    stop)}
+
+    def test_successors(self):
+        self.assertEqual(self.successors('A'), {'B': (1.5, {'10', '20'})})
+        self.assertEqual(self.successors('B'), {'C': (2.5, {'10'})})
+        self.assertEqual(self.successors('C'), {'A': (3.0, {'30'})})
+
+    def test_predecessors(self):
+        stop_index = self.graph.stop_index
+        self.assertEqual(
+            self.graph.predecessors(stop_index['B']),
+            [(stop_index['A'], 1.5, self.graph.encode_services({'10', '20'}))])
+        self.assertEqual([previous_stop for previous_stop, _, _ in
+                          self.graph.predecessors(stop_index['A'])],
+                         [stop_index['C']])
+
+    def test_csr_shape(self):
+        self.assertEqual(self.graph.num_stops, 3)
+        self.assertEqual(self.graph.num_edges, 3)
+        self.assertEqual(self.graph.indptr.tolist(), [0, 1, 2, 3])
+
+    def test_services_round_trip(self):
+        services = {'10', '30'}
+        self.assertEqual(self.graph.decode_services(
+            self.graph.encode_services(services)), services)
+
+    def test_coordinates(self):
+        self.assertEqual(self.graph.coordinates('B'), (1.31, 103.81))
+
+    def test_states(self):
+        states = self.graph.states
+        self.assertEqual(states.num_nodes, 3 + 7)
+
+        def label(node):
+            return self.graph.stop_codes[states.node_stops[node]]
+
+        rides = sorted(
+            (label(tail), label(head), distance)
+            for tail in range(states.num_stops, states.num_nodes)
+            for head, distance in states.rides[tail - states.num_stops])
+        self.assertEqual(rides, [('A', 'B', 1.5), ('A', 'B', 1.5),
+                                 ('B', 'C', 2.5), ('C', 'A', 3.0)])
+        reverse_rides = sorted(
+            (label(tail), label(head), distance)
+            for head in range(states.num_stops, states.num_nodes)
+            for tail, distance in states.reverse_rides[
+                head - states.num_stops])
+        self.assertEqual(reverse_rides, rides)
+        self.assertEqual([len(states.stop_states[stop]) for stop in
+                          range(3)], [3, 2, 2])
+
+class CompileRoutesTestCase(CompileGraphTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        rows = [cls.rt_idx[idx] for idx in sorted(cls.rt_idx)]
+        stop_codes = sorted(cls.bs)
+        cls.compiled = cls.graph
+        cls.graph = graph.compile_routes(
+            stop_codes, [cls.bs[code]['Latitude'] for code in stop_codes],
+            [cls.bs[code]['Longitude'] for code in stop_codes],
+            *([row[column] for row in rows] for column in [
+                'BusStopCode', 'ServiceNo', 'StopSequence', 'Distance']))
+
+    def test_matches_compile_graph(self):
+        self.assertEqual(self.graph.version, self.compiled.version)
+
+    def test_chunks(self):
+        # Successors across chunk boundaries and empty chunks are kept
+        rows = [self.rt_idx[idx] for idx in sorted(self.rt_idx)]
+        stop_codes = sorted(self.bs)
+        columns = [[row[column] for row in rows] for column in [
+            'BusStopCode', 'ServiceNo', 'StopSequence', 'Distance']]
+        chunks = [[column[i:i + 2] for column in columns]
+                  for i in range(0, len(rows), 2)]
+        network = graph.compile_route_chunks(
+            stop_codes, [self.bs[code]['Latitude'] for code in stop_codes],
+            [self.bs[code]['Longitude'] for code in stop_codes],
+            chunks[:1] + [[[]] * 4] + chunks[1:])
+        self.assertEqual(network.version, self.compiled.version)
+
+    def test_skips_unknown_stops(self):
+        network = graph.compile_routes(
+            ['A', 'C'], [1.30, 1.32], [103.80, 103.82], ['A', 'B', 'C'],
+            ['10', '10', '10'], [1, 2, 3], [0.0, 1.5, 4.0])
+        self.assertEqual(network.num_edges, 0)
+        self.assertEqual(network.indptr.tolist(), [0, 0, 0])
+
+class PatchRoutesTestCase(unittest.TestCase):
+    def compile(self, rows, stop_codes):
+        return graph.compile_routes(
+            stop_codes, [1.3] * len(stop_codes), [103.8] * len(stop_codes),
+            *zip(*rows))
+
+    def test_matches_rebuild(self):
+        # Rows are (BusStopCode, ServiceNo, StopSequence, Distance)
+        rows = [('A', '10', 1, 0.0), ('B', '10', 2, 1.5), ('C', '10', 3, 4.0),
+                ('A', '20', 1, 0.0), ('B', '20', 2, 1.5),
+                ('C', '30', 1, 0.0), ('A', '30', 2, 3.0)]
+        network = self.compile(rows, ['A', 'B', 'C'])
+
+        # 10 now skips B, 20 is withdrawn, 40 is new and stop D is added
+        changed = [('A', '10', 1, 0.0), ('C', '10', 2, 3.5),
+                   ('D', '40', 1, 0.0), ('C', '40', 2, 2.0)]
+        patched = graph.patch_routes(
+            network, ['A', 'B', 'C', 'D'], [1.3] * 4, [103.8] * 4,
+            *zip(*changed), removed_service_nos={'20'})
+        expected = self.compile(rows[5:] + changed, ['A', 'B', 'C', 'D'])
+        self.assertEqual(patched.version, expected.version)
+        self.assertEqual(patched.service_nos, ['10', '30', '40'])
+
+    def test_removed_stop(self):
+        rows = [('A', '10', 1, 0.0), ('B', '10', 2, 1.5),
+                ('B', '20', 1, 0.0), ('C', '20', 2, 1.0)]
+        patched = graph.patch_routes(self.compile(rows, ['A', 'B', 'C']),
+                                     ['B', 'C'], [1.3] * 2, [103.8] * 2,
+                                     [], [], [], [])
+        self.assertEqual(patched.version,
+                         self.compile(rows[1:], ['B', 'C']).version)
+
+class FootpathsTestCase(CompileGraphTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Consecutive stops are about 1.6km apart, A and C twice that
+        cls.walking = graph.with_footpaths(cls.graph, 2.0)
+
+    def footpaths(self, bus_stop_code):
+        stop = self.walking.stop_index[bus_stop_code]
+        return [self.walking.stop_codes[next_stop]
+                for next_stop, _ in self.walking.footpaths(stop)]
+
+    def test_footpaths(self):
+        self.assertEqual(self.footpaths('A'), ['B'])
+        self.assertEqual(self.footpaths('B'), ['A', 'C'])
+        self.assertEqual(self.walking.num_footpaths, 4)
+        self.assertEqual(self.graph.num_footpaths, 0)
+        self.assertNotEqual(self.walking.version, self.graph.version)
+
+    def test_bundle(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'graph.bin')
+            graph.save_bundle(self.walking, path)
+            loaded = graph.load(path)
+            self.assertEqual(loaded.walk_radius, 2.0)
+            self.assertEqual(loaded.footpaths(1), self.walking.footpaths(1))
+            self.assertEqual(loaded.version, self.walking.version)
+            del loaded
+
+class BundleTestCase(CompileGraphTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        fd, cls.path = tempfile.mkstemp(suffix='.bin')
+        os.close(fd)
+        graph.save_bundle(cls.graph, cls.path)
+        cls.compiled = cls.graph
+        cls.graph = graph.load(cls.path)
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.graph
+        os.remove(cls.path)
+
+    def test_string_tables(self):
+        self.assertEqual(list(self.graph.stop_codes),
+                         self.compiled.stop_codes)
+        self.assertEqual(list(self.graph.service_nos),
+                         self.compiled.service_nos)
+        self.assertEqual(self.graph.stop_codes[-1], 'C')
+
+    def test_version(self):
+        self.assertEqual(self.graph.version, self.compiled.version)
+
+    def test_bad_magic(self):
+        with tempfile.NamedTemporaryFile(suffix='.bin') as f:
+            f.write(b'XXXX' + bytes(graph.BUNDLE_HEADER.size))
+            f.flush()
+            with self.assertRaises(ValueError):
+                graph.load_bundle(f.name)
+
+if __name__ == '__main__':
+    unittest.main()
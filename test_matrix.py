@@ -0,0 +1,95 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import fixtures
+import matrix
+import route
+
+class CostMatrixTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Service 10 runs A -> B, 20 runs B -> C and 30 runs A -> C directly,
+        # nothing reaches A
+        rows = [('10', 1, 'A', 0.0), ('10', 2, 'B', 1.0),
+                ('20', 1, 'B', 0.0), ('20', 2, 'C', 1.0),
+                ('30', 1, 'A', 0.0), ('30', 2, 'C', 3.0)]
+        bs = {'A': {'Latitude': 1.3000, 'Longitude': 103.8000},
+              'B': {'Latitude': 1.3100, 'Longitude': 103.8100},
+              'C': {'Latitude': 1.3200, 'Longitude': 103.8200}}
+        cls.network = fixtures.make_network(rows, bs)
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.path = os.path.join(cls.tmp.name, 'matrix')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def build(self):
+        with mock.patch('matrix.SHARD_SIZE', 2), \
+                mock.patch('builtins.print'):
+            matrix.build(self.network, 0, route.WALK_WEIGHT, self.path, 1)
+        return matrix.load(self.path)
+
+    def test_lookup(self):
+        cost_matrix = self.build()
+        self.assertEqual(cost_matrix.version, self.network.version)
+        self.assertEqual(cost_matrix.lookup([0], 2), (2.0, 1))
+        self.assertEqual(cost_matrix.lookup([0, 1], 2), (1.0, 0))
+        self.assertIsNone(cost_matrix.lookup([2], 0))
+        self.assertEqual(cost_matrix.costs.dtype, np.float32)
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+    def test_resume(self):
+        # A checkpointed first shard of origins A and B is not searched again
+        tmp_path = self.path + '.tmp'
+        os.makedirs(tmp_path)
+        np.save(os.path.join(tmp_path, matrix.COSTS_FILE),
+                np.full((3, 3), 7, dtype='<f4'))
+        np.save(os.path.join(tmp_path, matrix.TRANSFERS_FILE),
+                np.zeros((3, 3), dtype='u1'))
+        with open(os.path.join(tmp_path, matrix.META_FILE), 'w') as f:
+            json.dump({'version': self.network.version,
+                       'transfer_penalty': 0,
+                       'walk_weight': route.WALK_WEIGHT}, f)
+        open(matrix._shard_done(tmp_path, 0), 'w').close()
+        cost_matrix = self.build()
+        self.assertEqual(cost_matrix.costs[0].tolist(), [7, 7, 7])
+        self.assertEqual(cost_matrix.costs[2].tolist(),
+                         [float('inf'), float('inf'), 0])
+
+    def test_router(self):
+        router = route.Router(self.network, cost_matrix=self.build())
+        self.assertEqual(router.cost_codes(['A'], 'C', 0), (2.0, 1))
+        with self.assertRaises(route.NoRouteError):
+            router.cost_codes(['C'], 'A', 0)
+        # Other transfer penalties are searched for
+        self.assertEqual(router.cost_codes(['A'], 'C', 5), (3.0, 0))
+        solution = router.expand_codes(['A'], 'C', 0)
+        self.assertEqual((solution.best_cost, solution.transfers), (2.0, 1))
+
+    def test_load_matrix(self):
+        # Matrices of another walk weight are ignored, their costs would not
+        # match the router's searches
+        self.build()
+        self.assertIsNotNone(route.load_matrix(
+            self.network, route.WALK_WEIGHT, self.path))
+        with self.assertLogs(level='WARNING'):
+            self.assertIsNone(route.load_matrix(
+                self.network, route.WALK_WEIGHT + 1, self.path))
+
+    def test_router_walk_weight(self):
+        # The matrix only answers a router of its own walk weight
+        router = route.Router(self.network, walk_weight=route.WALK_WEIGHT + 1,
+                              cost_matrix=self.build())
+        self.assertFalse(router.matches_matrix(0))
+        with mock.patch.object(router.cost_matrix, 'lookup') as lookup:
+            self.assertEqual(router.cost_codes(['A'], 'C', 0), (2.0, 1))
+        lookup.assert_not_called()
+
+if __name__ == '__main__':
+    unittest.main()
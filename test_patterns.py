@@ -0,0 +1,82 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import fixtures
+import patterns
+import route
+
+class TransferPatternsTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Service 10 runs A -> B -> D, 20 runs B -> C and 30 runs A -> C
+        rows = [('10', 1, 'A', 0.0), ('10', 2, 'B', 1.0), ('10', 3, 'D', 2.0),
+                ('20', 1, 'B', 0.0), ('20', 2, 'C', 1.0),
+                ('30', 1, 'A', 0.0), ('30', 2, 'C', 3.0)]
+        bs = {code: {'Latitude': 1.3 + i / 10000,
+                     'Longitude': 103.8 + i / 10000}
+              for i, code in enumerate('ABCD')}
+        cls.network = fixtures.make_network(rows, bs)
+        cls.tmp = tempfile.TemporaryDirectory()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def load(self, transfer_penalty):
+        path = os.path.join(self.tmp.name, str(transfer_penalty))
+        patterns.build(self.network, transfer_penalty, path)
+        return patterns.load(path)
+
+    def stops(self, router, transfer_penalty, origin='A', goal='C'):
+        solution = router.route_codes(
+            [origin], goal, transfer_penalty,
+            use_patterns=router.patterns is not None)
+        return [edge.dest.bus_stop_code for edge in solution.best_route]
+
+    def test_matches_search(self):
+        plain = route.Router(self.network)
+        for transfer_penalty in [0, 5]:
+            router = route.Router(self.network, self.load(transfer_penalty))
+            for origin, goal in [('A', 'C'), ('A', 'D'), ('B', 'D')]:
+                self.assertEqual(
+                    router.route_codes([origin], goal, transfer_penalty,
+                                       use_patterns=True).best_cost,
+                    plain.route_codes([origin], goal,
+                                      transfer_penalty).best_cost)
+                self.assertEqual(
+                    self.stops(router, transfer_penalty, origin, goal),
+                    self.stops(plain, transfer_penalty, origin, goal))
+
+    def test_legs(self):
+        transfer_patterns = self.load(0)
+        index = self.network.stop_index
+        service_index = self.network.service_index
+        self.assertEqual(transfer_patterns.legs(index['A'], index['C']),
+                         [(index['A'], service_index['10'], index['B']),
+                          (index['B'], service_index['20'], index['C'])])
+        self.assertEqual(transfer_patterns.stops(self.network, index['A'],
+                                                 index['D']),
+                         [index['A'], index['B'], index['D']])
+
+    def test_unreachable(self):
+        router = route.Router(self.network, self.load(5))
+        with self.assertRaises(route.NoRouteError):
+            router.route_codes(['C'], 'A', 5, use_patterns=True)
+
+    def test_other_penalty_raises(self):
+        router = route.Router(self.network, self.load(5))
+        with self.assertRaises(ValueError):
+            self.stops(router, 0)
+
+    def test_opt_in(self):
+        # The table is only followed when asked for
+        router = route.Router(self.network, self.load(5))
+        with mock.patch.object(router.patterns, 'stops') as stops:
+            router.route_codes(['A'], 'C', 5)
+        stops.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
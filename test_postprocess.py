@@ -0,0 +1,54 @@
+import random
+import unittest
+from types import SimpleNamespace
+
+import postprocess
+
+SET_POLICIES = {
+    postprocess.LATEST_TRANSFER: postprocess.latest_transfer,
+    postprocess.EARLIEST_TRANSFER: postprocess.earliest_transfer,
+    postprocess.PERMISSIVE: postprocess.permissive_route,
+}
+
+def random_route(rng, num_services=8):
+    route = []
+    for i in range(rng.randint(1, 12)):
+        services = {service for service in range(num_services)
+                    if rng.random() < 0.4} or {rng.randrange(num_services)}
+        route.append((services, i > 0 and rng.random() < 0.3))
+    return route
+
+def to_mask(services):
+    return sum(1 << service for service in services)
+
+def to_set(mask):
+    return {service for service in range(mask.bit_length())
+            if mask >> service & 1}
+
+class RefineRouteTestCase(unittest.TestCase):
+    def test_matches_set_passes(self):
+        rng = random.Random(0)
+        for _ in range(2000):
+            route = random_route(rng)
+            for policy, set_pass in SET_POLICIES.items():
+                with self.subTest(route=route, policy=policy):
+                    expected = [SimpleNamespace(services=set(services),
+                                                has_transferred=transferred)
+                                for services, transferred in route]
+                    set_pass(expected)
+                    refined = [SimpleNamespace(services=to_mask(services),
+                                               has_transferred=transferred)
+                               for services, transferred in route]
+                    postprocess.refine_route(refined, policy)
+                    self.assertEqual(
+                        [to_set(edge.services) for edge in refined],
+                        [edge.services for edge in expected])
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            postprocess.refine_route(
+                [SimpleNamespace(services=1, has_transferred=False)], 'any')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import io
+import os
+import pstats
+import tempfile
+import time
+import unittest
+
+import profiling
+
+
+def busy(seconds):
+    end = time.process_time() + seconds
+    while time.process_time() < end:
+        pass
+
+class ProfileTestCase(unittest.TestCase):
+    def test_cprofile(self):
+        stream = io.StringIO()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'query.prof')
+            with profiling.profile('cprofile', path, stream=stream):
+                busy(0.01)
+            self.assertIn('busy', ''.join(
+                function for _, _, function in pstats.Stats(path).stats))
+        self.assertIn('busy', stream.getvalue())
+
+    def test_sample(self):
+        stream = io.StringIO()
+        with profiling.profile('sample', stream=stream) as sampler:
+            busy(0.05)
+        self.assertGreater(sampler.samples, 0)
+        self.assertIn('(busy)', stream.getvalue())
+
+    def test_unknown_profiler(self):
+        with self.assertRaises(ValueError):
+            with profiling.profile('perf'):
+                pass
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,37 +1,278 @@
+from concurrent.futures import ThreadPoolExecutor
+import io
+import os
+import tempfile
 import unittest
+from unittest import mock
 
+import fixtures
+import graph
 import route
 
-class NearbyStopsTestCase(unittest.TestCase):
+class RouterTestCase(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
-        cls.test_dist = 200
-        distances = [0, 0.1, cls.test_dist, cls.test_dist - 0.1,
-                     cls.test_dist + 0.1]
-        keys = ['{:05d}'.format(i) for i in range(len(distances))]
-        cls.dist_key = 'Distance'
-        cls.bs = {key: {cls.dist_key: dist} for key, dist in zip(keys,
-                                                                 distances)}
-
-    def test_within_dist(self):
-        nearby_stops = route.find_nearby_stops(self.bs, self.dist_key,
-                                               self.test_dist)
-
-        for bus_stop_code, bus_stop_dict in self.bs.items():
-            # True Positive subtest: Correct bus stops included
-            with self.subTest(bus_stop_code=bus_stop_code):
-                if bus_stop_dict[self.dist_key] <= self.test_dist:
-                    self.assertIn(
-                        bus_stop_code, nearby_stops,
-                        msg='False negative.\nTest: <= {}  Excluded: {}'.format(
-                            self.test_dist, bus_stop_dict[self.dist_key]))
-            # True Negative subtest: Wrong bus stops excluded
-            with self.subTest(bus_stop_code=bus_stop_code):
-                if bus_stop_dict[self.dist_key] > self.test_dist:
-                    self.assertNotIn(
-                        bus_stop_code, nearby_stops,
-                        msg='False positive.\nTest: <= {}  Included: {}'.format(
-                            self.test_dist, bus_stop_dict[self.dist_key]))
+        # Service 10 runs A -> B, 20 runs B -> C and 30 runs A -> C directly
+        rows = [('10', 1, 'A', 0.0), ('10', 2, 'B', 1.0),
+                ('20', 1, 'B', 0.0), ('20', 2, 'C', 1.0),
+                ('30', 1, 'A', 0.0), ('30', 2, 'C', 3.0)]
+        bs = {'A': {'Latitude': 1.3000, 'Longitude': 103.8000},
+              'B': {'Latitude': 1.3001, 'Longitude': 103.8001},
+              'C': {'Latitude': 1.3002, 'Longitude': 103.8002}}
+        cls.router = route.Router(fixtures.make_network(rows, bs))
+
+    def stops(self, transfer_penalty):
+        solution = self.router.route_codes(['A'], 'C', transfer_penalty)
+        return [edge.dest.bus_stop_code for edge in solution.best_route]
+
+    def test_transfer_penalty(self):
+        self.assertEqual(self.stops(0), ['B', 'C'])
+        self.assertEqual(self.stops(5), ['C'])
+
+    def test_concurrent_queries(self):
+        penalties = [0, 5] * 50
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(self.stops, penalties))
+        for transfer_penalty, stops in zip(penalties, results):
+            self.assertEqual(stops, self.stops(transfer_penalty))
+
+    def test_route_coords(self):
+        solution = self.router.route_coords((1.3000, 103.8000),
+                                            (1.3002, 103.8002), radius=0.01)
+        self.assertEqual(solution.bus_stop_code, 'C')
+        self.assertEqual(solution.best_route[0].source.bus_stop_code, 'A')
+
+    def test_route_many(self):
+        solutions = dict(self.router.route_many(['A'], ['B', 'C'], 0))
+        self.assertEqual(set(solutions), {'B', 'C'})
+        self.assertEqual(solutions['C'].best_cost, 2)
+        self.assertEqual(solutions['B'].best_route[0].services, {'10'})
+        self.assertEqual(solutions['C'].best_route[-1].services, {'20'})
+
+    def test_isochrone(self):
+        network = self.router.network
+        for transfer_penalty in [0, 5]:
+            isochrone = self.router.isochrone_codes(['A'], transfer_penalty)
+            for code, solution in self.router.route_many(
+                    ['A'], ['B', 'C'], transfer_penalty):
+                stop = network.stop_index[code]
+                self.assertEqual(isochrone.cost[stop], solution.best_cost)
+                self.assertEqual(isochrone.transfers[stop],
+                                 solution.transfers)
+                self.assertEqual(
+                    isochrone.parent[stop],
+                    solution.best_route[-1].source.stop)
+        isochrone = self.router.isochrone_codes(['A'], 5, max_cost=2.5)
+        self.assertEqual(isochrone.cost.tolist(), [0, 1, float('inf')])
+        self.assertEqual(isochrone.parent.tolist(), [-1, 0, -1])
+        self.assertEqual(isochrone.stats.expanded, 2)
+
+    def test_alternatives(self):
+        def stops(solution):
+            return [edge.dest.bus_stop_code for edge in solution.best_route]
+
+        solutions = self.router.alternatives_codes(['A'], 'C', 0, k=3,
+                                                   max_detour=0.6)
+        self.assertEqual([stops(solution) for solution in solutions],
+                         [['B', 'C'], ['C']])
+        self.assertEqual([solution.best_cost for solution in solutions],
+                         [2, 3])
+        self.assertEqual(len(self.router.alternatives_codes(['A'], 'C', 0)),
+                         1)
+        with self.assertRaises(route.NoRouteError):
+            self.router.alternatives_codes(['C'], 'A')
+
+    def test_alternatives_start_cheapest(self):
+        for transfer_penalty in [0, 1.5, 5]:
+            for origin, goal in [('A', 'B'), ('A', 'C'), ('B', 'C')]:
+                solution = self.router.route_codes([origin], goal,
+                                                   transfer_penalty)
+                solutions = self.router.alternatives_codes(
+                    [origin], goal, transfer_penalty)
+                self.assertLessEqual(solutions[0].best_cost,
+                                     solution.best_cost)
+        solutions = self.router.alternatives_codes(['A'], 'A')
+        self.assertEqual([solution.best_cost for solution in solutions], [0])
+        self.assertEqual(solutions[0].best_route, [])
+
+        # Through edge A -> B, D -> C on service 20 is cheaper without the
+        # transfer, and overlaps the cheapest route A -> B -> C too much
+        rows = [('10', 1, 'A', 0.0), ('10', 2, 'B', 3.0), ('10', 3, 'C', 4.0),
+                ('20', 1, 'B', 0.0), ('20', 2, 'D', 0.5), ('20', 3, 'C', 0.9)]
+        bs = {code: {'Latitude': 1.3, 'Longitude': 103.8 + i / 10000}
+              for i, code in enumerate('ABCD')}
+        router = route.Router(fixtures.make_network(rows, bs))
+        solutions = router.alternatives_codes(['A'], 'C', 0.5)
+        self.assertEqual(solutions[0].best_cost,
+                         router.route_codes(['A'], 'C', 0.5).best_cost)
+
+    def test_parent_pointers(self):
+        solution = self.router.route_codes(['A'], 'C', 0)
+        route = solution.best_route
+        self.assertEqual(solution.hops, 2)
+        self.assertIs(solution.edge.source, route[-1].source)
+        self.assertIsNone(route[0].source.edge)
+        self.assertFalse(hasattr(solution, '__dict__'))
+
+    def test_bidirectional(self):
+        for transfer_penalty in [0, 5]:
+            forward = self.router.route_codes(['A'], 'C', transfer_penalty)
+            solution = self.router.route_codes(['A'], 'C', transfer_penalty,
+                                               bidirectional=True)
+            self.assertEqual(solution.best_cost, forward.best_cost)
+            self.assertEqual(
+                [edge.dest.bus_stop_code for edge in solution.best_route],
+                self.stops(transfer_penalty))
+        solution = self.router.route_coords(
+            (1.3000, 103.8000), (1.3002, 103.8002), radius=0.01,
+            bidirectional=True)
+        self.assertEqual(solution.bus_stop_code, 'C')
+        self.assertEqual(self.router.route_codes(
+            ['A'], 'A', bidirectional=True).best_route, [])
+        with self.assertRaises(route.NoRouteError):
+            self.router.route_codes(['C'], 'A', bidirectional=True)
+        # No stops near the origin coordinates
+        with self.assertRaises(route.NoRouteError):
+            self.router.route_coords((1.0, 100.0), (1.3002, 103.8002),
+                                     radius=0.01, bidirectional=True)
+
+    def test_pareto(self):
+        frontier = self.router.frontier_codes(['A'], 'C')
+        self.assertEqual([(solution.best_dist, solution.transfers)
+                          for solution in frontier], [(3.0, 0), (2.0, 1)])
+        self.assertEqual([edge.services for edge in frontier[1].best_route],
+                         [{'10'}, {'20'}])
+        self.assertEqual(len(self.router.frontier_codes(
+            ['A'], 'C', max_transfers=0)), 1)
+        frontier = self.router.frontier_coords(
+            (1.3000, 103.8000), (1.3002, 103.8002), radius=0.01)
+        self.assertEqual(frontier[0].bus_stop_code, 'C')
+        with self.assertRaises(route.NoRouteError):
+            self.router.frontier_codes(['C'], 'A')
+
+    def test_stats(self):
+        stats = self.router.route_codes(['A'], 'C', 0).stats
+        self.assertEqual(stats.expanded, 3)
+        self.assertGreaterEqual(stats.popped, stats.expanded)
+        self.assertEqual(stats.relaxed, 3)
+        self.assertEqual(stats.heuristic, 3)
+        self.assertEqual(stats.frontier_max, 2)
+        self.assertGreater(stats.search_time, 0)
+        self.assertGreater(stats.postprocess_time, 0)
+        self.assertEqual(set(stats.as_dict()),
+                         set(route.SearchStats.__slots__))
+
+    def test_unknown_stop(self):
+        with self.assertRaises(route.NoRouteError):
+            self.router.route_codes(['A'], 'D')
+
+class WalkTestCase(unittest.TestCase):
+    def test_walk(self):
+        # Service 10 runs A -> B and 20 runs C -> D, B and C are 56m apart
+        rows = [('10', 1, 'A', 0.0), ('10', 2, 'B', 2.0),
+                ('20', 1, 'C', 0.0), ('20', 2, 'D', 2.0)]
+        bs = {'A': {'Latitude': 1.2900, 'Longitude': 103.8000},
+              'B': {'Latitude': 1.3000, 'Longitude': 103.8000},
+              'C': {'Latitude': 1.3005, 'Longitude': 103.8000},
+              'D': {'Latitude': 1.3100, 'Longitude': 103.8000}}
+        network = fixtures.make_network(rows, bs)
+        with self.assertRaises(route.NoRouteError):
+            route.Router(network).route_codes(['A'], 'D')
+
+        router = route.Router(graph.with_footpaths(network), walk_weight=3)
+        solution = router.route_codes(['A'], 'D', 5)
+        self.assertEqual([edge.walk for edge in solution.best_route],
+                         [False, True, False])
+        self.assertEqual([edge.services for edge in solution.best_route],
+                         [{'10'}, set(), {'20'}])
+        walk = solution.best_route[1]
+        self.assertEqual(solution.transfers, 1)
+        self.assertAlmostEqual(solution.best_cost,
+                               4 + 5 + walk.distance * 3)
+        # The ride only states of -b cannot walk
+        with self.assertRaises(ValueError):
+            router.route_codes(['A'], 'D', 5, True)
+        with self.assertRaises(ValueError):
+            router.route_codes(['A'], 'D', 5, use_patterns=True)
+        with mock.patch.object(route, 'router', router):
+            result, = route.route_batch([(['A'], 'D')], 5, walk_weight=3)
+        self.assertAlmostEqual(result['result']['cost'], solution.best_cost)
+        with mock.patch.object(route, 'router', route.Router(router.network)):
+            result, = route.route_batch([(['A'], 'D')], 5, walk_weight=3)
+        self.assertAlmostEqual(result['result']['cost'], solution.best_cost)
+        frontier = router.frontier_codes(['A'], 'D', 5)
+        self.assertEqual(len(frontier), 1)
+        self.assertEqual([edge.services for edge in frontier[0].best_route],
+                         [{'10'}, set(), {'20'}])
+        self.assertEqual(frontier[0].best_cost, solution.best_cost)
+        isochrone = router.isochrone_codes(['A'], 5)
+        self.assertEqual(isochrone.cost[3], solution.best_cost)
+        self.assertEqual(isochrone.parent.tolist(), [-1, 0, 1, 2])
+
+    def test_walk_beside_ride(self):
+        # Service 30 also runs from B to C, the long way round
+        rows = [('10', 1, 'A', 0.0), ('10', 2, 'B', 2.0),
+                ('30', 1, 'B', 0.0), ('30', 2, 'C', 5.0),
+                ('20', 1, 'C', 0.0), ('20', 2, 'D', 2.0)]
+        bs = {'A': {'Latitude': 1.2900, 'Longitude': 103.8000},
+              'B': {'Latitude': 1.3000, 'Longitude': 103.8000},
+              'C': {'Latitude': 1.3005, 'Longitude': 103.8000},
+              'D': {'Latitude': 1.3100, 'Longitude': 103.8000}}
+        router = route.Router(graph.with_footpaths(
+            fixtures.make_network(rows, bs)))
+        solution = router.route_codes(['A'], 'D', 5)
+        frontier = router.frontier_codes(['A'], 'D', 5)
+        self.assertEqual(len(frontier), 1)
+        # The walk is replayed as a walk, not as the ride between its stops
+        self.assertEqual([edge.walk for edge in frontier[0].best_route],
+                         [False, True, False])
+        self.assertEqual(frontier[0].best_cost, solution.best_cost)
+
+class ReloadTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'graph.bin')
+        self.loaded = route.dataset_files, route.network, route.router
+        patchers = [
+            mock.patch.object(route.graph, 'default_path',
+                              return_value=self.path),
+            mock.patch.object(route.patterns, 'PATTERNS_PATH',
+                              os.path.join(self.tmp.name, 'patterns'))]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        route.dataset_files, route.network, route.router = self.loaded
+        self.tmp.cleanup()
+
+    def save(self, distance):
+        rows = [('10', 1, 'A', 0.0), ('10', 2, 'B', distance)]
+        bs = {'A': {'Latitude': 1.3000, 'Longitude': 103.8000},
+              'B': {'Latitude': 1.3001, 'Longitude': 103.8001}}
+        graph.save_bundle(fixtures.make_network(rows, bs), self.path)
+
+    def test_reload(self):
+        self.save(1.0)
+        self.assertTrue(route.reload())
+        self.assertFalse(route.reload())
+        self.assertEqual(route.router.route_codes(['A'], 'B').best_cost, 1.0)
+
+        self.save(2.0)
+        self.assertTrue(route.reload())
+        self.assertEqual(route.router.route_codes(['A'], 'B').best_cost, 2.0)
+
+class ReadPairsTestCase(unittest.TestCase):
+    def test_csv(self):
+        f = io.StringIO('origin,goal\n19051 18111,03381\n07319,57111\n')
+        self.assertEqual(list(route.read_pairs(f, 'csv')),
+                         [(['19051', '18111'], '03381'), (['07319'], '57111')])
+
+    def test_jsonl(self):
+        f = io.StringIO('{"origin": ["19051", "18111"], "goal": "03381"}\n'
+                        '\n{"origin": "07319", "goal": "57111"}\n')
+        self.assertEqual(list(route.read_pairs(f, 'jsonl')),
+                         [(['19051', '18111'], '03381'), (['07319'], '57111')])
 
 
 if __name__ == '__main__':
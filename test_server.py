@@ -0,0 +1,137 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import unittest
+from unittest import mock
+
+import server
+
+class LatencyHistogramTestCase(unittest.TestCase):
+    def test_percentiles(self):
+        histogram = server.LatencyHistogram([1, 10, 100])
+        for elapsed_ms in [0.5, 0.7, 3, 50, 500]:
+            histogram.record(elapsed_ms)
+        self.assertEqual(histogram.counts, [2, 1, 1, 1])
+        self.assertEqual(histogram.percentile(0.4), 1)
+        self.assertEqual(histogram.percentile(0.6), 10)
+        self.assertEqual(histogram.percentile(0.99), float('inf'))
+
+    def test_empty(self):
+        self.assertIsNone(server.LatencyHistogram().to_dict()['p50'])
+
+class HandleQueryTestCase(unittest.TestCase):
+    def test_cost(self):
+        router = mock.Mock()
+        router.cost_codes.return_value = (2.0, 1)
+        with mock.patch('route.router', router):
+            result = server.handle_query(
+                {'mode': 'cost', 'origin': ['A'], 'goal': 'C'})
+        self.assertEqual(result, {'cost': 2.0, 'transfers': 1})
+        router.route_codes.assert_not_called()
+
+    def test_cost_route(self):
+        # The route's own cost is returned, not the matrix lookup
+        router = mock.Mock()
+        router.cost_codes.return_value = (2.0, 1)
+        solution = router.expand_codes.return_value
+        solution.best_cost, solution.transfers = 2.5, 0
+        with mock.patch('route.router', router), \
+                mock.patch('route.serialize_route', return_value={}):
+            result = server.handle_query(
+                {'mode': 'cost', 'origin': ['A'], 'goal': 'C', 'route': True})
+        self.assertEqual(result, {'cost': 2.5, 'transfers': 0, 'route': {}})
+        router.expand_codes.assert_called_once_with(['A'], 'C', 5.0)
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            server.handle_query({'mode': 'walk'})
+
+class RouteTestCase(unittest.TestCase):
+    def route(self, router, query):
+        # Route the query with workers run in a thread, return the result
+        # and the queries sent to them
+        server_ = server.RouteServer(workers=1)
+        server_.close()
+        server_.pool = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(server_.pool.shutdown)
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        with mock.patch('route.router', router), \
+                mock.patch('route.reload', return_value=False), \
+                mock.patch('server.handle_query',
+                           return_value='pool') as handle_query:
+            result = loop.run_until_complete(server_.route(query))
+        return result, handle_query.call_args_list
+
+    def test_cost_matrix(self):
+        router = mock.Mock()
+        router.matches_matrix.return_value = True
+        router.cost_codes.return_value = (2.0, 1)
+        result, calls = self.route(
+            router, {'mode': 'cost', 'origin': ['A'], 'goal': 'C'})
+        self.assertEqual(result, {'cost': 2.0, 'transfers': 1})
+        self.assertEqual(calls, [])
+        router.matches_matrix.assert_called_once_with(5.0)
+
+    def test_cost_search(self):
+        # A matrix of another transfer penalty or walk weight is left to
+        # the pool rather than searched on the event loop
+        router = mock.Mock()
+        router.matches_matrix.return_value = False
+        query = {'mode': 'cost', 'origin': ['A'], 'goal': 'C'}
+        result, calls = self.route(router, query)
+        self.assertEqual(result, 'pool')
+        self.assertEqual(calls, [mock.call(query)])
+        router.cost_codes.assert_not_called()
+
+class HandleConnectionTestCase(unittest.TestCase):
+    def exchange(self, lines, router):
+        # Send the lines to a served connection, return the replies
+        async def run():
+            handled = asyncio.get_event_loop().create_future()
+
+            async def handle_connection(reader, writer):
+                await server_.handle_connection(reader, writer)
+                handled.set_result(None)
+
+            listener = await asyncio.start_server(
+                handle_connection, host='127.0.0.1', port=0)
+            port = listener.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(''.join(line + '\n' for line in lines).encode())
+            await writer.drain()
+            replies = [json.loads(await asyncio.wait_for(reader.readline(), 5))
+                       for _ in lines]
+            writer.close()
+            # The connection closes once the server reads to the end
+            await asyncio.wait_for(handled, 5)
+            listener.close()
+            await listener.wait_closed()
+            return replies
+
+        server_ = server.RouteServer(workers=1)
+        self.addCleanup(server_.close)
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        with mock.patch('route.router', router), \
+                mock.patch('route.reload', return_value=False), \
+                mock.patch('traceback.print_exc'):
+            return loop.run_until_complete(run())
+
+    def test_replies(self):
+        router = mock.Mock()
+        router.matches_matrix.return_value = True
+        router.cost_codes.side_effect = [(2.0, 1), RuntimeError('broken')]
+        replies = self.exchange([
+            '[1, 2]', '"x"', '{',
+            '{"id": 1, "mode": "cost", "origin": ["A"], "goal": "C"}',
+            '{"id": 2, "mode": "cost", "origin": ["A"], "goal": "C"}'],
+            router)
+        self.assertEqual(len([reply for reply in replies if 'error' in reply
+                              and reply['id'] is None]), 3)
+        replies = {reply['id']: reply for reply in replies}
+        self.assertEqual(replies[1]['result'], {'cost': 2.0, 'transfers': 1})
+        self.assertEqual(replies[2]['error'], 'RuntimeError: broken')
+
+if __name__ == '__main__':
+    unittest.main()
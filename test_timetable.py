@@ -0,0 +1,92 @@
+import datetime
+import os
+import tempfile
+import unittest
+
+import graph
+import timetable
+
+# Service 10 runs A -> B -> C, 20 runs B -> D and 30 runs A -> D directly
+# but only from 06:00 to 07:00
+ROWS = [('10', 1, 'A', 0.0, '0600', '2330'),
+        ('10', 2, 'B', 5.0, '0600', '2330'),
+        ('10', 3, 'C', 10.0, '0600', '2330'),
+        ('20', 1, 'B', 0.0, '0600', '2330'),
+        ('20', 2, 'D', 5.0, '0600', '2330'),
+        ('30', 1, 'A', 0.0, '0600', '0700'),
+        ('30', 2, 'D', 10.0, '0600', '0700')]
+
+class TimetableTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        service_nos, sequences, stop_codes, distances, firsts, lasts = zip(
+            *ROWS)
+        cls.network = graph.compile_routes(
+            ['A', 'B', 'C', 'D'], [1.30, 1.31, 1.32, 1.33],
+            [103.80, 103.81, 103.82, 103.83], list(stop_codes),
+            list(service_nos), sequences, distances)
+        cls.timetable = timetable.compile_timetable(
+            cls.network, stop_codes, service_nos, [1] * len(ROWS), sequences,
+            distances, {day: firsts for day in timetable.DAY_TYPES},
+            {day: lasts for day in timetable.DAY_TYPES}, headway=10,
+            speed=20)
+
+    def test_chunks(self):
+        chunks = []
+        for i in range(0, len(ROWS), 3):
+            service_nos, sequences, stop_codes, distances, firsts, lasts = \
+                zip(*ROWS[i:i + 3])
+            chunks.append((stop_codes, service_nos, [1] * len(stop_codes),
+                           sequences, distances,
+                           {day: firsts for day in timetable.DAY_TYPES},
+                           {day: lasts for day in timetable.DAY_TYPES}))
+        chunked = timetable.compile_timetable_chunks(self.network, chunks,
+                                                     headway=10, speed=20)
+        for field in timetable.FIELDS:
+            self.assertEqual(getattr(chunked, field).tolist(),
+                             getattr(self.timetable, field).tolist())
+
+    def query(self, departure, **kwargs):
+        return self.timetable.earliest_arrival(
+            self.network, ['A'], 'D', timetable.parse_time(departure),
+            **kwargs)
+
+    def test_transfer(self):
+        journey = self.query('07:55')
+        self.assertEqual(journey.legs, [
+            timetable.Leg('10', 1, 'A', 'B', 480, 495),
+            timetable.Leg('20', 1, 'B', 'D', 500, 515)])
+        self.assertEqual(journey.arrival, 515)
+
+    def test_direct_service_window(self):
+        journey = self.query('06:00')
+        self.assertEqual(journey.legs, [
+            timetable.Leg('30', 1, 'A', 'D', 360, 390)])
+
+    def test_no_journey(self):
+        self.assertIsNone(self.query('23:40'))
+        self.assertIsNone(self.query('07:55', max_rounds=1))
+
+    def test_save_load(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'timetable.npz')
+            timetable.save(self.timetable, path)
+            loaded = timetable.load(path)
+        self.assertEqual(loaded.version, self.network.version)
+        self.assertEqual(loaded.earliest_arrival(
+            self.network, ['A'], 'D', 475).legs, self.query('07:55').legs)
+
+class TimesTestCase(unittest.TestCase):
+    def test_parse_times(self):
+        self.assertEqual(timetable.parse_times(
+            ['0600', '2330', '-', None]).tolist(), [360, 1410, -1, -1])
+        self.assertEqual(timetable.parse_time('08:05'), 485)
+        self.assertEqual(timetable.format_time(485), '08:05')
+
+    def test_day_type(self):
+        self.assertEqual([timetable.day_type(datetime.date(2024, 1, day))
+                          for day in [5, 6, 7]], ['WD', 'SAT', 'SUN'])
+
+
+if __name__ == '__main__':
+    unittest.main()
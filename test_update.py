@@ -0,0 +1,100 @@
+import os
+import tempfile
+import unittest
+
+import pandas as pd
+from sqlalchemy import create_engine
+
+import graph
+import timetable
+import update
+
+def with_times(rt):
+    # Every row runs in direction 1 from 06:00 to 23:30 every day
+    rt = rt.copy()
+    for column in timetable.COLUMNS:
+        rt[column] = 1 if column == 'Direction' else (
+            '0600' if 'First' in column else '2330')
+    return rt
+
+def compile_tables(rt, bs):
+    bs = bs.sort_values('BusStopCode')
+    return graph.compile_routes(
+        bs.BusStopCode.tolist(), bs.Latitude.to_numpy(),
+        bs.Longitude.to_numpy(), rt.BusStopCode.tolist(),
+        rt.ServiceNo.tolist(), rt.StopSequence.to_numpy(),
+        rt.Distance.to_numpy())
+
+class UpdateTestCase(unittest.TestCase):
+    def setUp(self):
+        self.rt = with_times(pd.DataFrame(
+            [('10', 1, 'A', 0.0), ('10', 2, 'B', 1.5), ('10', 3, 'C', 4.0),
+             ('20', 1, 'A', 0.0), ('20', 2, 'B', 1.5),
+             ('30', 1, 'C', 0.0), ('30', 2, 'A', 3.0)],
+            columns=['ServiceNo', 'StopSequence', 'BusStopCode', 'Distance']))
+        self.bs = pd.DataFrame(
+            [('A', 1.30, 103.80), ('B', 1.31, 103.81), ('C', 1.32, 103.82)],
+            columns=['BusStopCode', 'Latitude', 'Longitude'])
+
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        fd, self.graph_path = tempfile.mkstemp(suffix='.bin')
+        os.close(fd)
+        fd, self.timetable_path = tempfile.mkstemp(suffix='.npz')
+        os.close(fd)
+        self.db_conn = create_engine('sqlite:///' + self.path)
+        self.rt.to_sql(name='bus_routes', con=self.db_conn, index=False)
+        self.bs.to_sql(name='bus_stops', con=self.db_conn, index=False)
+        self.network = compile_tables(self.rt, self.bs)
+
+    def tearDown(self):
+        self.db_conn.dispose()
+        os.remove(self.path)
+        os.remove(self.graph_path)
+        os.remove(self.timetable_path)
+
+    def stored(self):
+        return (pd.read_sql_table(table_name='bus_routes', con=self.db_conn),
+                pd.read_sql_table(table_name='bus_stops', con=self.db_conn))
+
+    def test_changed_keys(self):
+        new_rt = self.rt.copy()
+        new_rt.loc[2, 'Distance'] = 5.0
+        self.assertEqual(update.changed_keys(self.rt, new_rt, 'ServiceNo'),
+                         {'10'})
+        self.assertEqual(update.changed_keys(self.rt, self.rt[:5],
+                                             'ServiceNo'), {'30'})
+        self.assertEqual(update.changed_keys(self.rt, self.rt, 'ServiceNo'),
+                         set())
+
+    def test_update(self):
+        # 20 is withdrawn, 30 now starts at new stop D and B moves
+        new_rt = pd.concat([self.rt[:3], with_times(pd.DataFrame(
+            [('30', 1, 'D', 0.0), ('30', 2, 'C', 1.0), ('30', 3, 'A', 4.0)],
+            columns=self.rt.columns[:4]))], ignore_index=True)
+        new_bs = pd.concat([self.bs, pd.DataFrame(
+            [('D', 1.33, 103.83)], columns=self.bs.columns)],
+            ignore_index=True)
+        new_bs.loc[1, 'Latitude'] = 1.315
+
+        network, services, stops = update.update(
+            self.db_conn, self.network, new_rt, new_bs, self.graph_path,
+            self.timetable_path)
+        self.assertEqual(services, {'20', '30'})
+        self.assertEqual(stops, {'B', 'D'})
+        rt, bs = self.stored()
+        self.assertEqual(len(rt), 6)
+        self.assertEqual(network.version, compile_tables(rt, bs).version)
+        self.assertEqual(graph.load(self.graph_path).version, network.version)
+        self.assertEqual(timetable.load(self.timetable_path).version,
+                         network.version)
+        self.assertEqual(network.coordinates('B'), (1.315, 103.81))
+
+        network, services, stops = update.update(
+            self.db_conn, network, new_rt, new_bs, self.graph_path,
+            self.timetable_path)
+        self.assertIsNone(network)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,385 @@
+from argparse import ArgumentParser
+from collections import namedtuple
+import datetime
+import math
+import os
+
+import numpy as np
+
+TIMETABLE_PATH = 'timetable.npz'
+
+# Day types of the DataMall first and last bus columns
+DAY_TYPES = ['WD', 'SAT', 'SUN']
+
+# Options
+# BusRoutes has no frequencies, so every route runs at a fixed headway in
+# minutes and at a fixed speed in km/h between its first and last bus
+HEADWAY = 10
+BUS_SPEED = 20
+TRANSFER_TIME = 2
+MAX_ROUNDS = 6
+
+# Timing of a bus route row, minutes after midnight
+NOT_RUNNING = -1
+
+Leg = namedtuple('Leg', ['service_no', 'direction', 'board', 'alight',
+                         'depart', 'arrive'])
+
+
+class Journey:
+    """
+    Earliest arrival at the goal found by a timetable query
+
+    legs holds the bus legs in order, with stop codes and times in minutes
+    after midnight.
+    """
+
+    def __init__(self, departure, legs):
+        self.departure = departure
+        self.legs = legs
+
+    @property
+    def arrival(self):
+        return self.legs[-1].arrive if self.legs else self.departure
+
+    def __repr__(self):
+        lines = ['{} {} -> {} {} | {:>4s} ({})'.format(
+            format_time(leg.depart), leg.board, leg.alight,
+            format_time(leg.arrive), leg.service_no, leg.direction)
+            for leg in self.legs]
+        lines.append('Arrive {} | {:.0f} min, {} transfers'.format(
+            format_time(self.arrival), self.arrival - self.departure,
+            max(0, len(self.legs) - 1)))
+        return '\n'.join(lines)
+
+
+def parse_time(value):
+    # Minutes after midnight of 'HHMM' or 'HH:MM'
+    hours, minutes = divmod(int(value.replace(':', '')), 100)
+    return hours * 60 + minutes
+
+
+def format_time(minutes):
+    hours, minutes = divmod(int(round(minutes)), 60)
+    return '{:02d}:{:02d}'.format(hours, minutes)
+
+
+def day_type(date):
+    # Weekdays, then Saturday and Sunday
+    return DAY_TYPES[max(0, date.weekday() - 4)]
+
+
+def parse_times(values):
+    # Minutes after midnight of each 'HHMM' string, NOT_RUNNING if missing
+    values = np.asarray([value if isinstance(value, str) else ''
+                         for value in values], dtype=str)
+    valid = np.char.isdigit(values) & (np.char.str_len(values) == 4)
+    digits = np.where(valid, values, '0').astype(np.int64)
+    minutes = digits // 100 * 60 + digits % 100
+    minutes[~valid] = NOT_RUNNING
+    return minutes
+
+
+class Timetable:
+    """
+    Bus routes indexed for round-based earliest arrival queries
+
+    Each route is one direction of a service, with its rows, the stops it
+    calls at in order, at route_ptr[r]:route_ptr[r + 1]. row_offsets is the
+    riding time in minutes from the first row of the route, first_buses and
+    last_buses the service window at each row by day type. stop_rows lists
+    the rows calling at each stop at stop_ptr[s]:stop_ptr[s + 1].
+    """
+
+    def __init__(self, version, route_ptr, route_services, route_directions,
+                 route_headways, row_stops, row_offsets, first_buses,
+                 last_buses, stop_ptr, stop_rows):
+        self.version = version
+        self.route_ptr = route_ptr
+        self.route_services = route_services
+        self.route_directions = route_directions
+        self.route_headways = route_headways
+        self.row_stops = row_stops
+        self.row_offsets = row_offsets
+        self.first_buses = first_buses
+        self.last_buses = last_buses
+        self.stop_ptr = stop_ptr
+        self.stop_rows = stop_rows
+        self._lists = None
+
+    @property
+    def num_routes(self):
+        return len(self.route_ptr) - 1
+
+    def lists(self):
+        # Plain lists of the arrays, faster to index in the scan loops
+        if self._lists is None:
+            row_routes = np.repeat(np.arange(self.num_routes),
+                                   np.diff(self.route_ptr))
+            self._lists = (
+                self.route_ptr.tolist(), self.route_headways.tolist(),
+                row_routes.tolist(), self.row_stops.tolist(),
+                self.row_offsets.tolist(), self.first_buses.tolist(),
+                self.last_buses.tolist(), self.stop_ptr.tolist(),
+                self.stop_rows.tolist())
+        return self._lists
+
+    def earliest_arrival(self, network, origin_codes, goal_code, departure,
+                         day='WD', max_rounds=MAX_ROUNDS,
+                         transfer_time=TRANSFER_TIME):
+        """
+        Journey reaching goal_code soonest when leaving any of origin_codes
+        at departure minutes after midnight, None if it cannot be reached
+        within max_rounds buses
+
+        Round k scans only the routes calling at stops improved in round
+        k - 1, boarding the first bus of each route that can be caught, as
+        RAPTOR does over a frequency based timetable.
+        """
+        (route_ptr, headways, row_routes, row_stops, row_offsets,
+         first_buses, last_buses, stop_ptr, stop_rows) = self.lists()
+        first_buses = first_buses[DAY_TYPES.index(day)]
+        last_buses = last_buses[DAY_TYPES.index(day)]
+        goal = network.stop_index[goal_code]
+        origins = {network.stop_index[code] for code in origin_codes}
+
+        best = [math.inf] * network.num_stops
+        for origin in origins:
+            best[origin] = departure
+        # Per round, the (board row, alight row, board time) of each stop
+        # improved in that round
+        labels = [{}]
+        marked = origins
+
+        for k in range(1, max_rounds + 1):
+            # Earliest row of each route calling at a marked stop
+            routes = {}
+            for stop in marked:
+                for row in stop_rows[stop_ptr[stop]:stop_ptr[stop + 1]]:
+                    route = row_routes[row]
+                    if row < routes.get(route, math.inf):
+                        routes[route] = row
+
+            previous = best[:]
+            round_labels = {}
+            marked = set()
+            change = transfer_time if k > 1 else 0
+            for route, start in routes.items():
+                headway = headways[route]
+                reference = math.inf
+                board = board_time = None
+                for row in range(start, route_ptr[route + 1]):
+                    stop = row_stops[row]
+                    offset = row_offsets[row]
+
+                    # Alight from the bus boarded so far
+                    arrival = reference + offset
+                    if arrival < best[stop] and arrival < best[goal]:
+                        best[stop] = arrival
+                        round_labels[stop] = (board, row, board_time)
+                        marked.add(stop)
+
+                    # Catch an earlier bus here if reached in time
+                    ready = previous[stop] + change
+                    if ready >= arrival:
+                        continue
+                    first, last = first_buses[row], last_buses[row]
+                    if first == NOT_RUNNING:
+                        continue
+                    if last < first:
+                        last += 24 * 60
+                    if ready <= first:
+                        depart = first
+                    else:
+                        depart = first + math.ceil(
+                            (ready - first) / headway) * headway
+                    if depart > last:
+                        continue
+                    if depart - offset < reference:
+                        reference = depart - offset
+                        board = row
+                        board_time = depart
+            labels.append(round_labels)
+            if not marked:
+                break
+
+        if best[goal] == math.inf:
+            return None
+        return Journey(departure, self.legs(network, labels, origins, goal))
+
+    def legs(self, network, labels, origins, goal):
+        # Walk the round labels back from the goal to an origin
+        legs = []
+        stop = goal
+        k = max(k for k, round_labels in enumerate(labels)
+                if goal in round_labels) if goal not in origins else 0
+        while k > 0:
+            board, alight, board_time = labels[k][stop]
+            route = int(np.searchsorted(self.route_ptr, board,
+                                        side='right')) - 1
+            board_stop = int(self.row_stops[board])
+            legs.append(Leg(
+                network.service_nos[int(self.route_services[route])],
+                int(self.route_directions[route]),
+                network.stop_codes[board_stop], network.stop_codes[stop],
+                board_time, board_time + float(
+                    self.row_offsets[alight] - self.row_offsets[board])))
+            stop = board_stop
+            k = max([j for j in range(k) if stop in labels[j]], default=0)
+        return legs[::-1]
+
+
+def compile_timetable(network, route_stop_codes, route_service_nos,
+                      route_directions, route_sequences, route_distances,
+                      first_buses, last_buses, headway=HEADWAY,
+                      speed=BUS_SPEED):
+    """
+    Index bus route columns against network into a Timetable
+
+    A route runs for as long as consecutive rows continue the stop sequence
+    of one service and direction. first_buses and last_buses map each day
+    type to its column of 'HHMM' strings.
+    """
+    return compile_timetable_chunks(
+        network, [(route_stop_codes, route_service_nos, route_directions,
+                   route_sequences, route_distances, first_buses,
+                   last_buses)], headway, speed)
+
+
+def _timetable_rows(network, route_stop_codes, route_service_nos,
+                    route_directions, route_sequences, route_distances,
+                    first_buses, last_buses):
+    # Columns of the route rows at stops of network, with parsed times
+    stops = np.fromiter((network.stop_index.get(code, -1) for code in
+                         route_stop_codes), dtype=np.int64,
+                        count=len(route_stop_codes))
+    rows = np.flatnonzero(stops >= 0)
+    return (
+        stops[rows], np.asarray(route_service_nos, dtype=str)[rows],
+        np.asarray(route_directions, dtype=np.int64)[rows],
+        np.asarray(route_sequences, dtype=np.int64)[rows],
+        np.asarray(route_distances, dtype=np.float64)[rows],
+        np.array([parse_times(np.asarray(first_buses[day], dtype=object)[
+            rows]) for day in DAY_TYPES], dtype=np.int16),
+        np.array([parse_times(np.asarray(last_buses[day], dtype=object)[
+            rows]) for day in DAY_TYPES], dtype=np.int16))
+
+
+def compile_timetable_chunks(network, chunks, headway=HEADWAY,
+                             speed=BUS_SPEED):
+    """
+    Index chunks of bus route columns into a Timetable, as
+    compile_timetable() does their concatenation
+
+    Each chunk is reduced to stop indices and parsed times before the next
+    is read.
+    """
+    rows = [_timetable_rows(network, *chunk) for chunk in chunks]
+    stops, service_nos, directions, sequences, distances = [
+        np.concatenate(columns) for columns in list(zip(*rows))[:5]]
+    first_buses, last_buses = [
+        np.concatenate(columns, axis=1) for columns in list(zip(*rows))[5:]]
+
+    starts = np.ones(len(stops), dtype=bool)
+    starts[1:] = ~((sequences[1:] == sequences[:-1] + 1) &
+                   (service_nos[1:] == service_nos[:-1]) &
+                   (directions[1:] == directions[:-1]))
+    route_starts = np.flatnonzero(starts)
+    route_ptr = np.append(route_starts, len(stops)).astype(np.int32)
+    row_routes = np.cumsum(starts) - 1
+    offsets = (distances - distances[route_starts][row_routes]) / speed * 60
+
+    order = np.argsort(stops, kind='stable')
+    stop_ptr = np.zeros(network.num_stops + 1, dtype=np.int32)
+    stop_ptr[1:] = np.cumsum(np.bincount(stops,
+                                         minlength=network.num_stops))
+
+    return Timetable(
+        network.version, route_ptr,
+        np.array([network.service_index[service_no] for service_no in
+                  service_nos[route_starts]], dtype=np.int32),
+        directions[route_starts].astype(np.int8),
+        np.full(len(route_starts), headway, dtype=np.int16),
+        stops.astype(np.int32), offsets, first_buses, last_buses,
+        stop_ptr, order.astype(np.int32))
+
+
+def compile_table(network, rt, headway=HEADWAY, speed=BUS_SPEED):
+    # Timetable of a bus routes table with the DataMall columns
+    return compile_table_chunks(network, [rt], headway, speed)
+
+
+def compile_table_chunks(network, chunks, headway=HEADWAY, speed=BUS_SPEED):
+    # Timetable of bus routes table chunks with the DataMall columns
+    return compile_timetable_chunks(network, (
+        (rt.BusStopCode.tolist(), rt.ServiceNo.tolist(),
+         rt.Direction.to_numpy(), rt.StopSequence.to_numpy(),
+         rt.Distance.to_numpy(),
+         {day: rt[day + '_FirstBus'].tolist() for day in DAY_TYPES},
+         {day: rt[day + '_LastBus'].tolist() for day in DAY_TYPES})
+        for rt in chunks), headway, speed)
+
+
+# Columns of the bus routes table the timetable needs
+COLUMNS = ['Direction'] + ['{}_{}Bus'.format(day, end) for day in DAY_TYPES
+                           for end in ['First', 'Last']]
+
+FIELDS = ['route_ptr', 'route_services', 'route_directions', 'route_headways',
+          'row_stops', 'row_offsets', 'first_buses', 'last_buses', 'stop_ptr',
+          'stop_rows']
+
+
+def save(timetable, path=TIMETABLE_PATH):
+    # Write to a temporary file first so readers never see a partial file
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, version=np.array(timetable.version), **{
+            field: getattr(timetable, field) for field in FIELDS})
+    os.replace(tmp_path, path)
+
+
+def load(path=TIMETABLE_PATH):
+    with np.load(path) as data:
+        return Timetable(str(data['version']),
+                         *[data[field] for field in FIELDS])
+
+
+def main():
+    import route
+
+    parser = ArgumentParser(
+        description='Finds the earliest arrival leaving at a given time')
+    parser.add_argument(
+        '-o', '--origin', default=['19051'], nargs='+', metavar='ORIGIN',
+        help="origin bus stop codes")
+    parser.add_argument(
+        '-g', '--goal', default='03381', help="destination bus stop code")
+    parser.add_argument(
+        '-d', '--depart', default=datetime.datetime.now().strftime('%H:%M'),
+        help="departure time as HH:MM, now by default")
+    parser.add_argument(
+        '--day', choices=DAY_TYPES, default=day_type(datetime.date.today()),
+        help="day type of the service windows, today's by default")
+    parser.add_argument(
+        '-r', '--rounds', default=MAX_ROUNDS, type=int,
+        help="maximum number of buses taken")
+    args = parser.parse_args()
+
+    network = route.network
+    if not os.path.exists(TIMETABLE_PATH):
+        exit('No timetable, run to-pickle.py')
+    timetable = load()
+    if timetable.version != network.version:
+        exit('{} was built for another dataset, run to-pickle.py'.format(
+            TIMETABLE_PATH))
+    route.router.check_codes(args.origin + [args.goal])
+    journey = timetable.earliest_arrival(
+        network, args.origin, args.goal, parse_time(args.depart), args.day,
+        args.rounds)
+    if journey is None:
+        exit('No journey from {} to {} leaving at {}'.format(
+            ', '.join(args.origin), args.goal, args.depart))
+    print(journey)
+
+if __name__ == '__main__':
+    main()
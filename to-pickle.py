@@ -1,35 +1,95 @@
-from collections import defaultdict
-import pickle
-from pprint import pprint
+from argparse import ArgumentParser
+from contextlib import contextmanager
+import time
 
 import pandas as pd
 from sqlalchemy import create_engine
 
-print('Loading tables')
-db_conn = create_engine('sqlite:///sg-bus-router.db')
-rt = pd.read_sql_table(table_name='bus_routes', con=db_conn)
-bs = pd.read_sql_table(table_name='bus_stops', con=db_conn)
+import clean
+import graph
+import timetable
 
-print('Setting Bus Stop index')
-bs.set_index('BusStopCode', inplace=True)
+STOP_COLUMNS = ['BusStopCode', 'Latitude', 'Longitude']
+ROUTE_COLUMNS = ['ServiceNo', 'StopSequence', 'BusStopCode', 'Distance']
 
-print('Generating Bus Routes index dict')
-rt_idx_dict = rt.to_dict(orient='index')
-rt_bus_stop_dict = defaultdict(dict)
+@contextmanager
+def stage(name):
+    # Report how long a preprocessing stage takes
+    print(name, end='... ', flush=True)
+    start = time.perf_counter()
+    yield
+    print('{:.2f}s'.format(time.perf_counter() - start))
 
-print('Populating Bus Routes stops dict')
-for bus_stop_code, _ in bs.iterrows():
-    rt_bus_stop_dict[bus_stop_code] = rt[(rt.BusStopCode == bus_stop_code)].to_dict(orient='index')
+def route_chunks(db_conn, columns, stop_codes, rejected=None):
+    # Cleaned chunks of the bus routes table, read one at a time
+    return clean.clean_routes(
+        pd.read_sql_table(table_name='bus_routes', con=db_conn,
+                          columns=columns, chunksize=clean.CHUNK_SIZE),
+        stop_codes, rejected)
 
-print('Generating Bus Stops dict')
-bs_bus_stop_dict = bs.to_dict(orient='index')
+def main():
+    parser = ArgumentParser(
+        description='Compiles the downloaded dataset into a routing graph')
+    parser.add_argument(
+        '-f', '--format', default=['bundle'], nargs='+',
+        choices=['bundle', 'pickle'],
+        help="output formats, a memory-mapped bundle and/or a pickle")
+    parser.add_argument(
+        '-w', '--walk-radius', default=0.0, type=float,
+        help="km between bus stops joined by footpaths, none by default as "
+             "-b and transfer patterns do not walk, {} is "
+             "typical".format(graph.WALK_RADIUS))
+    args = parser.parse_args()
+    start = time.perf_counter()
 
-print('Pickling dicts')
-with open('rt_idx.pkl', 'wb') as f:
-    pickle.dump(rt_idx_dict, f)
+    with stage('Loading Bus Stops'):
+        db_conn = create_engine(clean.DB_PATH)
+        bs = pd.read_sql_table(table_name='bus_stops', con=db_conn,
+                               columns=STOP_COLUMNS).sort_values(
+                                   'BusStopCode')
 
-with open('rt_bs.pkl', 'wb') as f:
-    pickle.dump(rt_bus_stop_dict, f)
+    # Each cleaned chunk is reduced to its edges before the next is read, so
+    # the routes table is never held whole. Successors are the following
+    # bus route row, so rows keep their order
+    stop_codes = set(bs.BusStopCode)
+    with stage('Cleaning Bus Routes and compiling graph'):
+        rejected = []
+        network = graph.compile_route_chunks(
+            bs.BusStopCode.tolist(), bs.Latitude.to_numpy(),
+            bs.Longitude.to_numpy(),
+            ((rt.BusStopCode.tolist(), rt.ServiceNo.tolist(),
+              rt.StopSequence.to_numpy(), rt.Distance.to_numpy())
+             for rt in route_chunks(db_conn, ROUTE_COLUMNS, stop_codes,
+                                    rejected)))
+    if rejected:
+        print('Rejected {} rows at unknown bus stops'.format(
+            sum(len(chunk) for chunk in rejected)))
+    print('{} stops, {} edges, {} services'.format(
+        network.num_stops, network.num_edges, len(network.service_nos)))
 
-with open('bs.pkl', 'wb') as f:
-    pickle.dump(bs_bus_stop_dict, f)
+    # Walking transfers between nearby stops are found once here, not per
+    # search
+    with stage('Indexing footpaths'):
+        network = graph.with_footpaths(network, args.walk_radius)
+    print('{} footpaths'.format(network.num_footpaths))
+
+    # First and last buses are indexed by route for timed queries, from a
+    # second pass over the chunks
+    with stage('Indexing timetable'):
+        table = timetable.compile_table_chunks(network, route_chunks(
+            db_conn, ROUTE_COLUMNS + timetable.COLUMNS, stop_codes))
+        timetable.save(table)
+    print('{} routes'.format(table.num_routes))
+
+    if 'bundle' in args.format:
+        with stage('Writing graph bundle'):
+            graph.save_bundle(network, graph.BUNDLE_PATH)
+
+    if 'pickle' in args.format:
+        with stage('Pickling graph'):
+            graph.save(network, graph.GRAPH_PATH)
+
+    print('Total {:.2f}s'.format(time.perf_counter() - start))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+from argparse import ArgumentParser
+import time
+
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+import clean
+import downloader
+import graph
+import timetable
+
+# Downloaded tables are staged under their name plus this suffix
+STAGING_SUFFIX = '_new'
+
+
+def changed_keys(old, new, key):
+    """
+    Values of the key column whose rows were added, removed or changed
+    between the old and new tables, compared in row order
+    """
+    def signatures(table):
+        hashes = pd.util.hash_pandas_object(
+            table.reindex(columns=sorted(table.columns)), index=False)
+        return hashes.groupby(table[key].to_numpy(), sort=False).agg(
+            tuple).to_dict()
+
+    old_signatures, new_signatures = signatures(old), signatures(new)
+    return {value for value in set(old_signatures) | set(new_signatures)
+            if old_signatures.get(value) != new_signatures.get(value)}
+
+
+def update(db_conn, network, new_rt, new_bs, path=graph.BUNDLE_PATH,
+           timetable_path=timetable.TIMETABLE_PATH):
+    """
+    Apply downloaded bus route and stop tables to the stored tables, the
+    graph at path and the timetable at timetable_path
+
+    Only the services and stops that changed are recompiled and rewritten.
+    The footpaths and timetable are reindexed in full, they take well under
+    a second.
+    The graph is replaced before the tables are committed, so an update
+    interrupted in between is redone by the next one. Returns the patched
+    graph, None if nothing changed, with the changed services and stops.
+    """
+    old_rt = pd.read_sql_table(table_name='bus_routes', con=db_conn)
+    old_bs = pd.read_sql_table(table_name='bus_stops', con=db_conn)
+    new_rt = pd.concat(clean.clean_routes([new_rt],
+                                          set(new_bs.BusStopCode)))
+    new_rt = new_rt.reindex(columns=old_rt.columns)
+    new_bs = new_bs.reindex(columns=old_bs.columns)
+
+    services = changed_keys(old_rt, new_rt, 'ServiceNo')
+    stops = changed_keys(old_bs, new_bs, 'BusStopCode')
+    if not services and not stops:
+        return None, services, stops
+
+    bs = new_bs.sort_values('BusStopCode')
+    routes = new_rt[new_rt.ServiceNo.isin(services)]
+    walk_radius = network.walk_radius
+    network = graph.patch_routes(
+        network, bs.BusStopCode.tolist(), bs.Latitude.to_numpy(),
+        bs.Longitude.to_numpy(), routes.BusStopCode.tolist(),
+        routes.ServiceNo.tolist(), routes.StopSequence.to_numpy(),
+        routes.Distance.to_numpy(), services - set(new_rt.ServiceNo))
+    network = graph.with_footpaths(network, walk_radius)
+    graph.save_bundle(network, path)
+    timetable.save(timetable.compile_table(network, new_rt), timetable_path)
+
+    with db_conn.begin() as conn:
+        for table, key, values, rows in [
+                ('bus_routes', 'ServiceNo', services, routes),
+                ('bus_stops', 'BusStopCode', stops,
+                 new_bs[new_bs.BusStopCode.isin(stops)])]:
+            if values:
+                conn.execute(text('DELETE FROM {} WHERE {} = :value'.format(
+                    table, key)), [{'value': value} for value in values])
+            rows.to_sql(name=table, con=conn, if_exists='append',
+                        index=False)
+    return network, services, stops
+
+
+def main():
+    from keys import api_key
+
+    parser = ArgumentParser(
+        description='Updates the dataset and graph with changed routes only')
+    parser.add_argument(
+        '-w', '--workers', default=downloader.WORKERS, type=int,
+        help="number of pages fetched concurrently")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    db_conn = create_engine(downloader.DB_PATH)
+    session = downloader.make_session(api_key, args.workers)
+    tables = {}
+    for api_path, db_table in zip(downloader.API_PATHS, downloader.DB_TABLES):
+        downloader.download_table(session, db_conn, api_path,
+                                  db_table + STAGING_SUFFIX, args.workers)
+        tables[db_table] = pd.read_sql_table(
+            table_name=db_table + STAGING_SUFFIX, con=db_conn)
+
+    network, services, stops = update(
+        db_conn, graph.load(), tables['bus_routes'], tables['bus_stops'])
+    with db_conn.begin() as conn:
+        for db_table in downloader.DB_TABLES:
+            conn.execute(text('DROP TABLE {}'.format(
+                db_table + STAGING_SUFFIX)))
+
+    if network is None:
+        print('Dataset is up to date')
+    else:
+        print('Updated {} services and {} stops to version {} in '
+              '{:.2f}s'.format(len(services), len(stops), network.version,
+                               time.perf_counter() - start))
+
+if __name__ == '__main__':
+    main()
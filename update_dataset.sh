@@ -1,7 +1,11 @@
 #!/bin/bash
 
-rm *.pkl
-rm *.db
-python downloader.py
-python clean.py
-python to-pickle.py
+# Apply only changed routes once a dataset has been built
+if [ -f sg-bus-router.db ] && [ -f graph.bin ]; then
+    python update.py
+else
+    python downloader.py
+    python to-pickle.py
+fi
+python patterns.py build
+python matrix.py build